@@ -30,9 +30,11 @@ import traceback
 import sys
 import os
 import glob
-import subprocess
-from threading import Timer
+import queue
 import logging
+import concurrent.futures
+
+from k8s_netem.caller import TcBatch
 
 logger = logging.getLogger('flexe.packet')
 exporter_logger = logging.getLogger('flexe.exporter')
@@ -256,32 +258,17 @@ class ClientHandle(net.Network):
         self.interfaces = 0  # bitmask of interfaces configured
         logger.info('Got client %s peer=%s sock=%s', self.id, peername, sockname)
 
-    def _tc_run(self, command, timeout=5):
-        ''' Run sub-process with a time limit.
+    def _tc_run(self, batch, command):
+        ''' Queue a tc command.
+
+        The commands of a batch are streamed to the shared tc process
+        when the batch is committed.
 
         Args:
-            command: Sub-process command.
-            timeout: Value in seconds.
+            batch: TcBatch collecting the commands.
+            command: tc command line.
         '''
-        def kill_proc(p):
-            p.kill()
-
-        logger.debug('Run: %s', command)
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, shell=True)
-
-        timer = Timer(timeout, kill_proc, [proc])
-        timer.start()
-        out, err = proc.communicate()
-        timer.cancel()
-
-        logger.debug('Run after: %s, err: %s', command, err)
-
-        send_to_all(CLIENTS, {'id': TCCOMMAND,
-                              'cmd': command,
-                              'out': out.decode('UTF-8'),
-                              'err': err.decode('UTF-8'),
-                              'stamp': time.time()})
+        batch.add(command, check=False)
 
     def _tc_filter(self, filter):
         selector = ''
@@ -508,10 +495,13 @@ class ClientHandle(net.Network):
         self.profiles = None
         initialized = 0
 
+        batch = TcBatch()
         for iface in iter(INTERFACES.values()):
             if iface[1] & self.interfaces:
                 initialized |= iface[1]
-                self._tc_run(f'tc qdisc del dev {iface[0]} root')
+                self._tc_run(batch, f'tc qdisc del dev {iface[0]} root')
+
+        TC_WORKER.commit(batch)
 
         self.interfaces = 0
 
@@ -579,6 +569,7 @@ class ClientHandle(net.Network):
         i = 0
         profiles_used = {}
         classes = {}
+        batch = TcBatch()
         for filter in self.filters:
             info = filter[2]
             egress = self.profiles[i][1]
@@ -605,7 +596,10 @@ class ClientHandle(net.Network):
             for iface in iter(INTERFACES.values()):
                 if iface[1] & info.out:
                     if netem:
-                        self._tc_run(f'tc qdisc replace dev {iface[0]} parent 1:{minor:X} handle {i*10:X}: {netem}')
+                        self._tc_run(batch, f'tc qdisc replace dev {iface[0]} parent 1:{minor:X} handle {i*10:X}: {netem}')
+
+        TC_WORKER.commit(batch)
+
         if len(profiles_used) == 0:
             # No profiles left, terminate application cleanly (remove all definitions)
             self.unrun(INTERFACES)
@@ -647,53 +641,57 @@ class ClientHandle(net.Network):
         i = 0
         classes = {}
 
-        for filter in self.filters:
-            info = filter[2]
-            egress = self.profiles[i][1]
-            i += 1
-            if egress:
-                netem = classes.get((egress, info.dir))
-                if netem is None:
-                    data = self._load_profile(egress)
-                    netem = self._tc_netem(data, info.dir)
-                    profiles_used[egress] = data
-                    classes[(egress, info.dir)] = netem
-                minor = 10 + i
-
-            else:
-                minor = 1
-                netem = None
-
-            protocol, selector = self._tc_filter(filter)
-
-            logger.debug('Now protocol = %s and selector = %s, egress = %s, netem = %s', protocol, selector, egress, netem)
-
-            for iface in iter(INTERFACES.values()):
-                if iface[1] & info.out:
-                    fp = f'tc filter add dev {iface[0]}'
-                    if (iface[1] & self.interfaces) == 0:
-                        # Initialize only new interfaces
-                        if (iface[1] & initialized) == 0:
-                            self._tc_run(f'tc qdisc del dev {iface[0]} root')
-                            initialized |= iface[1]
-                        self.interfaces |= iface[1]
-                        self._tc_run(f'tc qdisc add dev {iface[0]} handle 1: root htb')
-                        self._tc_run(f'tc class add dev {iface[0]} parent 1: classid 1:1 htb rate 1000Mbps')
-
-                        # The following commands are run only when filter protocol is IP
-                        if protocol == 'ip':
-                            self._tc_run(f'{fp} parent 1: protocol ip handle 4: u32 divisor 1')
-                            self._tc_run(f'{fp} parent 1: protocol ipv6 handle 6: u32 divisor 1')
-                            self._tc_run(f'{fp} parent 1: protocol ip u32 ht 800: match u8 0 0 offset at 0 mask 0f00 shift 6 link 4:')
-                            self._tc_run(f'{fp} parent 1: protocol ipv6 u32 ht 800: match u8 0 0 offset plus 40 link 6:')
-                    if netem:
-                        self._tc_run(f'tc class add dev {iface[0]} parent 1:1 classid 1:{minor:X} htb rate 100Mbps')
-                        self._tc_run(f'tc qdisc add dev {iface[0]} parent 1:{minor:X} handle {i*10:X}: {netem}')
+        batch = TcBatch()
+        try:
+            for filter in self.filters:
+                info = filter[2]
+                egress = self.profiles[i][1]
+                i += 1
+                if egress:
+                    netem = classes.get((egress, info.dir))
+                    if netem is None:
+                        data = self._load_profile(egress)
+                        netem = self._tc_netem(data, info.dir)
+                        profiles_used[egress] = data
+                        classes[(egress, info.dir)] = netem
+                    minor = 10 + i
 
-                    if protocol == 'fw':
-                        self._tc_run(f'{fp} {selector} {protocol} classid 1:{minor:X}')
-                    else:
-                        self._tc_run(f'{fp} protocol {protocol} prio {i} {selector} flowid 1:{minor:X}')
+                else:
+                    minor = 1
+                    netem = None
+
+                protocol, selector = self._tc_filter(filter)
+
+                logger.debug('Now protocol = %s and selector = %s, egress = %s, netem = %s', protocol, selector, egress, netem)
+
+                for iface in iter(INTERFACES.values()):
+                    if iface[1] & info.out:
+                        fp = f'tc filter add dev {iface[0]}'
+                        if (iface[1] & self.interfaces) == 0:
+                            # Initialize only new interfaces
+                            if (iface[1] & initialized) == 0:
+                                self._tc_run(batch, f'tc qdisc del dev {iface[0]} root')
+                                initialized |= iface[1]
+                            self.interfaces |= iface[1]
+                            self._tc_run(batch, f'tc qdisc add dev {iface[0]} handle 1: root htb')
+                            self._tc_run(batch, f'tc class add dev {iface[0]} parent 1: classid 1:1 htb rate 1000Mbps')
+
+                            # The following commands are run only when filter protocol is IP
+                            if protocol == 'ip':
+                                self._tc_run(batch, f'{fp} parent 1: protocol ip handle 4: u32 divisor 1')
+                                self._tc_run(batch, f'{fp} parent 1: protocol ipv6 handle 6: u32 divisor 1')
+                                self._tc_run(batch, f'{fp} parent 1: protocol ip u32 ht 800: match u8 0 0 offset at 0 mask 0f00 shift 6 link 4:')
+                                self._tc_run(batch, f'{fp} parent 1: protocol ipv6 u32 ht 800: match u8 0 0 offset plus 40 link 6:')
+                        if netem:
+                            self._tc_run(batch, f'tc class add dev {iface[0]} parent 1:1 classid 1:{minor:X} htb rate 100Mbps')
+                            self._tc_run(batch, f'tc qdisc add dev {iface[0]} parent 1:{minor:X} handle {i*10:X}: {netem}')
+
+                        if protocol == 'fw':
+                            self._tc_run(batch, f'{fp} {selector} {protocol} classid 1:{minor:X}')
+                        else:
+                            self._tc_run(batch, f'{fp} protocol {protocol} prio {i} {selector} flowid 1:{minor:X}')
+        finally:
+            TC_WORKER.commit(batch)
 
         return profiles_used
 
@@ -892,6 +890,60 @@ def send_to_all(clients, msg, butone=None):
             c.send(msg)
 
 
+class TcWorker:
+    ''' Commit tc batches without blocking the exporter loop.
+
+    Batches are committed one after another by a single thread, so they
+    are applied in order. Committed batches are handed back through a
+    pipe, which is watched by the exporter loop. Their results are then
+    sent to all clients from the loop.
+    '''
+
+    isserver = False
+
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='tc')
+        self.done = queue.SimpleQueue()
+        self.rfd, self.wfd = os.pipe()
+
+    def fileno(self):
+        return self.rfd
+
+    def commit(self, batch):
+        self.executor.submit(self._commit, batch)
+
+    def _commit(self, batch):
+        try:
+            batch.commit()
+        except Exception as e:
+            logger.error('Failed to run tc commands: %s', e)
+
+        self.done.put(batch)
+        os.write(self.wfd, b'.')
+
+    def report(self):
+        ''' Send the results of all committed batches to all clients. '''
+        os.read(self.rfd, 4096)
+
+        while True:
+            try:
+                batch = self.done.get_nowait()
+            except queue.Empty:
+                break
+
+            for command, out, err in batch.results():
+                logger.debug('Run after: %s, err: %s', command, err)
+
+                send_to_all(CLIENTS, {'id': TCCOMMAND,
+                                      'cmd': command,
+                                      'out': out,
+                                      'err': err,
+                                      'stamp': time.time()})
+
+
+TC_WORKER = TcWorker()
+
+
 def exporter():
     exporter_logger.info('PID=%d', os.getpid())
     wss = ServerHandle()
@@ -903,7 +955,7 @@ def exporter():
     running = None
 
     # WARNING: Queue _reader as select works only in linux!
-    WATCHED = [wss]
+    WATCHED = [wss, TC_WORKER]
     busy = True
     cycles = 0
     timeout = 2
@@ -970,7 +1022,9 @@ def exporter():
                 send_to_all(CLIENTS, reply, butone=running)
 
         for rdy in sread:
-            if rdy.isserver:
+            if rdy is TC_WORKER:
+                TC_WORKER.report()
+            elif rdy.isserver:
                 (conn, addr) = rdy.socket().accept()
                 client = ClientHandle(addr, conn)
                 WATCHED.append(client)
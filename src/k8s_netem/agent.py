@@ -0,0 +1,335 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List
+
+import os
+import sys
+import time
+import logging
+import threading
+
+from kubernetes import client, config
+
+from k8s_netem.aggregate import TOPOLOGY
+from k8s_netem.cache import POD_CACHE
+from k8s_netem.coalesce import Coalescer
+from k8s_netem.informer import Informer
+from k8s_netem.reconciler import Reconciler
+from k8s_netem.profile import Profile, ProfileInformer
+from k8s_netem.plan import PlanInformer, PlanTracker, LABEL_POD_UID
+from k8s_netem.config import NODE_NAME, USE_PLANS, RESYNC_INTERVAL, NODE_CIDR_AGGREGATION
+from k8s_netem.sidecar import init_nftables
+from k8s_netem import netns, nftables, classifier, marks, tc, caller, buffers
+
+from k8s_netem.controllers.builtin import BuiltinController  # noqa F041
+from k8s_netem.controllers.script import ScriptController  # noqa F041
+
+import k8s_netem.log as log
+
+LOGGER = logging.getLogger('agent')
+
+# These controllers depend on processes running inside the pod
+UNSUPPORTED_TYPES = ['Flexe']
+
+
+class Target:
+    """ A pod on this node whose network namespace is managed by the agent
+
+    All nftables and tc changes are made from within the network namespace
+    of the pod. The existing controllers and the reconciler are reused.
+    """
+
+    def __init__(self, pod, ns: netns.NetNS):
+        self.logger = logging.getLogger(f'target:{pod.metadata.namespace}/{pod.metadata.name}')
+
+        self.pod = pod
+        self.netns = ns
+
+        self.lock = threading.Lock()
+        self.reconciler = Reconciler(pod)
+
+        # Only used with USE_PLANS
+        self.tracker = PlanTracker()
+
+    def init(self, events: Iterable[Dict]):
+        self.logger.info('Managing network namespace %s', self.netns)
+
+        with self.lock, self.netns.enter():
+            init_nftables()
+
+            self._apply(events)
+
+    def deinit(self):
+        self.logger.info('Releasing network namespace %s', self.netns)
+
+        with self.lock:
+            self.reconciler.desired = {}
+
+            try:
+                with self.netns.enter():
+                    self.reconciler.reconcile()
+            except OSError as e:
+                self.logger.warn('Failed to clean up network namespace: %s', e)
+
+                # Stop peer subscriptions of the profiles which could not be removed
+                for profile in self.reconciler.applied.values():
+                    for direction in [profile.ingress, profile.egress]:
+                        for rule in direction.rules.values() if direction else []:
+                            for peer in rule.peers:
+                                peer.deinit()
+
+                            rule.pod_events.cancel()
+
+            nftables.forget(self.netns)
+            classifier.forget(self.netns)
+            marks.forget(self.netns)
+            tc.forget(self.netns)
+            caller.forget(self.netns)
+            buffers.forget(self.netns)
+
+            self.netns.close()
+
+    def apply(self, events: Iterable[Dict]):
+        with self.lock, self.netns.enter():
+            self._apply(events)
+
+    def resync(self):
+        """ Observe the kernel state of the pod and repair drifted state """
+
+        with self.lock, self.netns.enter():
+            self.reconciler.reconcile(full=True)
+
+    def update_pod(self, pod):
+        """ Re-match all profiles after the labels of the pod have changed """
+
+        self.pod = pod
+
+        with self.lock, self.netns.enter():
+            self.reconciler.update_pod(pod)
+            self.reconciler.reconcile()
+
+    def _apply(self, events: Iterable[Dict]):
+        for event in events:
+            # Profiles are constructed within the namespace
+            # in order to resolve the interfaces of the pod
+            try:
+                profile = Profile(event['object'])
+            except RuntimeError as e:
+                self.logger.error('Invalid profile: %s', e)
+                continue
+
+            type = event['type']
+            if profile.type in UNSUPPORTED_TYPES:
+                self.logger.error('Profiles of type %s are not supported by the agent', profile.type)
+                type = 'DELETED'
+
+            self.reconciler.handle_event({
+                **event,
+                'type': type,
+                'profile': profile
+            })
+
+        self.reconciler.reconcile()
+
+
+class Agent:
+    """ Manage the network namespaces of all pods of a node
+
+    The agent runs once per node instead of a sidecar per pod. It keeps a
+    single profile watch and a single watch for the pods of its node.
+    Peer pods are resolved by the shared pod cache.
+    """
+
+    def __init__(self, node: str):
+        self.logger = logging.getLogger('agent')
+
+        self.node = node
+
+        # Pod uid -> Target
+        self.targets: Dict[str, Target] = {}
+        self.lock = threading.Lock()
+
+        v1 = client.CoreV1Api()
+
+        # Either all profiles or only the plans of the pods of this node are watched
+        if USE_PLANS:
+            self.profiles = PlanInformer(node=node)
+        else:
+            self.profiles = ProfileInformer(resolve=False)
+
+        self.pods = Informer('pods:local', v1.list_pod_for_all_namespaces,
+                             field_selector=f'spec.nodeName={node}')
+
+    def profile_events(self, target: Target) -> List[Dict]:
+        objs = list(self.profiles.store.values())
+
+        if USE_PLANS:
+            plan = next((p for p in objs if p['metadata'].get('labels', {}).get(LABEL_POD_UID) == target.pod.metadata.uid), None)
+
+            return target.tracker.events(plan)
+
+        return [{'type': 'ADDED', 'object': obj} for obj in objs]
+
+    def run(self):
+        self.profiles.list()
+
+        # Without an event loop, the peers of a target would start the shared
+        # watches within its network namespace, and all of them would run over
+        # the impaired interface of that pod. So they are started from here.
+        if not USE_PLANS:
+            POD_CACHE.init()
+
+            if NODE_CIDR_AGGREGATION:
+                TOPOLOGY.init()
+
+        for event in self.pods.list():
+            self.handle_pod_event(event)
+
+        thread = threading.Thread(target=self.watch_pods, daemon=True)
+        thread.start()
+
+        thread = threading.Thread(target=self.resync, daemon=True)
+        thread.start()
+
+        # Bursts of events are collected and applied with a single reconciliation per pod
+        if USE_PLANS:
+            coalescer = Coalescer('plans', lambda events: self.apply_plans(events.values()))
+        else:
+            coalescer = Coalescer('profiles', lambda events: self.apply(events.values()))
+
+        for event in self.profiles.watch():
+            obj = event['object']
+
+            self.logger.debug('%s %s %s',
+                              event['type'].capitalize(),
+                              obj['kind'],
+                              obj['metadata']['name'])
+
+            coalescer.put(obj['metadata']['uid'], event)
+
+        coalescer.flush()
+
+        self.pods.stop()
+
+        with self.lock:
+            for target in self.targets.values():
+                target.deinit()
+
+        POD_CACHE.deinit()
+        TOPOLOGY.deinit()
+
+    def watch_pods(self):
+        for event in self.pods.watch():
+            self.handle_pod_event(event)
+
+    def resync(self):
+        while True:
+            time.sleep(RESYNC_INTERVAL)
+
+            with self.lock:
+                targets = list(self.targets.values())
+
+            for target in targets:
+                try:
+                    target.resync()
+                except OSError as e:
+                    target.logger.error('Failed to enter network namespace: %s', e)
+
+    def apply(self, events: Iterable[Dict]):
+        events = list(events)
+
+        with self.lock:
+            targets = list(self.targets.values())
+
+        for target in targets:
+            try:
+                target.apply(events)
+            except OSError as e:
+                target.logger.error('Failed to enter network namespace: %s', e)
+
+    def apply_plans(self, events: Iterable[Dict]):
+        for event in events:
+            plan = event['object']
+            uid = plan['metadata'].get('labels', {}).get(LABEL_POD_UID)
+
+            with self.lock:
+                target = self.targets.get(uid)
+
+            if target is None:
+                continue
+
+            try:
+                target.apply(target.tracker.events(plan if event['type'] != 'DELETED' else None))
+            except OSError as e:
+                target.logger.error('Failed to enter network namespace: %s', e)
+
+    def handle_pod_event(self, event):
+        pod = event['object']
+        uid = pod.metadata.uid
+
+        with self.lock:
+            target = self.targets.get(uid)
+
+            if event['type'] == 'DELETED':
+                if target is not None:
+                    del self.targets[uid]
+                    target.deinit()
+
+                return
+
+            # Changes would affect the whole node
+            if pod.spec.host_network:
+                return
+
+            # Network of the pod sandbox is not ready yet
+            if pod.status.pod_ip is None:
+                return
+
+            # The pod sandbox has been recreated
+            if target is not None and target.pod.status.pod_ip not in [None, pod.status.pod_ip]:
+                del self.targets[uid]
+                target.deinit()
+                target = None
+
+            if target is None:
+                ns = netns.find_pod_netns(uid)
+                if ns is None:
+                    self.logger.debug('No process of pod %s/%s found yet', pod.metadata.namespace, pod.metadata.name)
+                    return
+
+                target = Target(pod, ns)
+
+                try:
+                    target.init(self.profile_events(target))
+                except OSError as e:
+                    target.logger.error('Failed to enter network namespace: %s', e)
+                    ns.close()
+                    return
+
+                self.targets[uid] = target
+
+            elif target.pod.metadata.labels != pod.metadata.labels:
+                try:
+                    target.update_pod(pod)
+                except OSError as e:
+                    target.logger.error('Failed to enter network namespace: %s', e)
+
+            else:
+                target.pod = pod
+
+
+def main():
+    log.setup()
+
+    LOGGER.info('Started netem agent')
+
+    if NODE_NAME is None:
+        LOGGER.error('NODE_NAME is not set')
+        sys.exit(1)
+
+    if os.environ.get('KUBECONFIG'):
+        config.load_kube_config()
+    else:
+        config.load_incluster_config()
+
+    agent = Agent(NODE_NAME)
+    agent.run()
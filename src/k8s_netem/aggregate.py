@@ -0,0 +1,315 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import bisect
+import ipaddress
+import logging
+import threading
+
+from kubernetes import client
+
+from k8s_netem.aio import Watcher
+from k8s_netem.cache import POD_CACHE
+from k8s_netem.informer import Informer
+
+Network = ipaddress.IPv4Network
+
+
+def sibling(net: Network) -> Network:
+    """ Get the other half of the supernet of a network """
+
+    supernet = net.supernet()
+    lower, upper = supernet.subnets()
+
+    return upper if net == lower else lower
+
+
+class Topology:
+    """ Pod CIDRs of all nodes and the pod IPs allocated from them
+
+    A node CIDR may only be used in place of the individual pod IPs if no
+    other pod has an address out of it. Listeners get notified with the
+    node CIDR whenever its occupancy changes.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('topology')
+
+        self.lock = threading.Lock()
+        self.init_lock = threading.Lock()
+
+        # Node uid -> CIDR
+        self.node_cidrs: Dict[str, Network] = {}
+
+        # Pod uid -> IP
+        self.pod_ips: Dict[str, Network] = {}
+
+        # IP -> Number of pods with it
+        self.ip_refs: Dict[Network, int] = {}
+
+        # Node CIDR -> IPs of all pods out of it
+        self.occupancy: Dict[Network, Set[Network]] = {}
+
+        self.listeners: List[Callable[[Network], None]] = []
+
+        self.watcher: Watcher = None
+
+    def init(self):
+        # Rules might start the topology concurrently
+        with self.init_lock:
+            if self.watcher is not None:
+                return
+
+            v1 = client.CoreV1Api()
+
+            nodes = Informer('nodes', v1.list_node)
+
+            # Node CIDRs must be known before pods can be assigned to them
+            for event in nodes.list():
+                self.handle_node_event(event)
+
+            self.watcher = Watcher(nodes, self.handle_node_event)
+            self.watcher.start()
+
+            # Pods are taken from the informer shared with the peers
+            POD_CACHE.add_listener(self.handle_pod_event)
+
+    def deinit(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def add_listener(self, listener: Callable[[Network], None]):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Network], None]):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def notify(self, cidr: Network):
+        for listener in list(self.listeners):
+            listener(cidr)
+
+    def node_cidr(self, ip: Network) -> Optional[Network]:
+        with self.lock:
+            return self._node_cidr(ip)
+
+    def _node_cidr(self, ip: Network) -> Optional[Network]:
+        for prefixlen in range(ip.prefixlen, -1, -1):
+            cidr = ip.supernet(new_prefix=prefixlen)
+            if cidr in self.occupancy:
+                return cidr
+
+        return None
+
+    def occupied(self, cidr: Network) -> Optional[Set[Network]]:
+        """ Get the IPs of all pods out of a node CIDR or None if the CIDR is unknown """
+
+        with self.lock:
+            occupancy = self.occupancy.get(cidr)
+
+            return set(occupancy) if occupancy is not None else None
+
+    def handle_node_event(self, event):
+        node = event['object']
+        uid = node.metadata.uid
+
+        cidrs = [Network(c) for c in (node.spec.pod_cid_rs or [node.spec.pod_cidr]) if c is not None]
+        cidr = next((c for c in cidrs if c.version == 4), None)
+
+        with self.lock:
+            old_cidr = self.node_cidrs.pop(uid, None)
+            if old_cidr is not None:
+                self.occupancy.pop(old_cidr, None)
+
+            if event['type'] != 'DELETED' and cidr is not None:
+                self.node_cidrs[uid] = cidr
+                self.occupancy[cidr] = {ip for ip in self.pod_ips.values() if ip.subnet_of(cidr)}
+
+        for changed in {old_cidr, cidr} - {None}:
+            self.notify(changed)
+
+    def handle_pod_event(self, event):
+        pod = event['object']
+        uid = pod.metadata.uid
+
+        ip = None
+        if event['type'] != 'DELETED' and pod.status.pod_ip is not None and not pod.spec.host_network:
+            ip = Network(pod.status.pod_ip)
+            if ip.version != 4:
+                ip = None
+
+        with self.lock:
+            old_ip = self.pod_ips.pop(uid, None)
+            if old_ip == ip:
+                if ip is not None:
+                    self.pod_ips[uid] = ip
+                return
+
+            changed = set()
+
+            if old_ip is not None:
+                refs = self.ip_refs.pop(old_ip) - 1
+                if refs > 0:
+                    self.ip_refs[old_ip] = refs
+
+                old_cidr = self._node_cidr(old_ip)
+                if old_cidr is not None and refs == 0:
+                    self.occupancy[old_cidr].discard(old_ip)
+                    changed.add(old_cidr)
+
+            if ip is not None:
+                self.pod_ips[uid] = ip
+                self.ip_refs[ip] = self.ip_refs.get(ip, 0) + 1
+
+                cidr = self._node_cidr(ip)
+                if cidr is not None:
+                    self.occupancy[cidr].add(ip)
+                    changed.add(cidr)
+
+        for cidr in changed:
+            self.notify(cidr)
+
+
+TOPOLOGY = Topology()
+
+
+class NetAggregator:
+    """ Collapse pod IPs into the smallest set of covering prefixes
+
+    Each prefix keeps the number of member addresses it covers. Adjacent
+    prefixes are merged as soon as they form their common supernet, and a
+    prefix is split into the collapsed remainder once a member leaves it.
+    If a topology is given, all pods of a node CIDR being members
+    lets the node CIDR replace their individual prefixes.
+    """
+
+    def __init__(self, topology: Topology = None):
+        self.topology = topology
+
+        # Address -> Reference count
+        self.members: Dict[Network, int] = {}
+
+        # Sorted integers of all member addresses for finding the members of a prefix
+        self.addrs: List[int] = []
+
+        # Prefix -> Number of member addresses
+        self.prefixes: Dict[Network, int] = {}
+
+    def __iter__(self):
+        return iter(self.prefixes)
+
+    def covering(self, addr: Network) -> Optional[Network]:
+        """ Find the prefix containing an address """
+
+        for prefixlen in range(addr.prefixlen, -1, -1):
+            net = addr.supernet(new_prefix=prefixlen)
+            if net in self.prefixes:
+                return net
+
+        return None
+
+    def add(self, addr: Network):
+        refs = self.members.get(addr, 0)
+        self.members[addr] = refs + 1
+
+        if refs > 0:
+            return
+
+        bisect.insort(self.addrs, int(addr.network_address))
+
+        prefix = self.covering(addr)
+        if prefix is not None:
+            self.prefixes[prefix] += 1
+        else:
+            self._insert(addr, 1)
+
+        self._refresh_addr(addr)
+
+    def remove(self, addr: Network):
+        refs = self.members.get(addr, 0)
+        if refs > 1:
+            self.members[addr] = refs - 1
+            return
+        elif refs == 0:
+            return
+
+        del self.members[addr]
+        del self.addrs[bisect.bisect_left(self.addrs, int(addr.network_address))]
+
+        prefix = self.covering(addr)
+        if prefix is None:
+            return
+
+        count = self.prefixes.pop(prefix) - 1
+        if count > 0:
+            self._split(prefix)
+
+        self._refresh_addr(addr)
+
+    def _insert(self, prefix: Network, count: int):
+        # Merge with complete siblings into their supernet
+        while prefix.prefixlen > 0:
+            other = sibling(prefix)
+
+            other_count = self.prefixes.get(other)
+            if other_count is None or other_count != other.num_addresses:
+                break
+
+            del self.prefixes[other]
+
+            count += other_count
+            prefix = prefix.supernet()
+
+        self.prefixes[prefix] = count
+
+    def _range(self, prefix: Network) -> Tuple[int, int]:
+        """ Get the slice of the sorted addresses which are members of a prefix """
+
+        return (bisect.bisect_left(self.addrs, int(prefix.network_address)),
+                bisect.bisect_right(self.addrs, int(prefix.broadcast_address)))
+
+    def _members(self, prefix: Network) -> List[Network]:
+        start, end = self._range(prefix)
+
+        return [Network(addr) for addr in self.addrs[start:end]]
+
+    def _split(self, prefix: Network):
+        for net in ipaddress.collapse_addresses(self._members(prefix)):
+            start, end = self._range(net)
+
+            self.prefixes[net] = end - start
+
+    def _refresh_addr(self, addr: Network):
+        if self.topology is None:
+            return
+
+        cidr = self.topology.node_cidr(addr)
+        if cidr is not None:
+            self.refresh(cidr)
+
+    def refresh(self, cidr: Network):
+        """ Use or release a node CIDR depending on the pods out of it """
+
+        if self.topology is None:
+            return
+
+        occupied = self.topology.occupied(cidr)
+        selected = self._members(cidr)
+
+        complete = occupied is not None and len(selected) > 0 and occupied <= set(selected)
+
+        if complete and cidr not in self.prefixes:
+            # Prefixes within the CIDR cover at least one of its members
+            covering = {self.covering(m) for m in selected}
+
+            for prefix in [p for p in covering if p.subnet_of(cidr)]:
+                del self.prefixes[prefix]
+
+            self.prefixes[cidr] = len(selected)
+
+        elif not complete and cidr in self.prefixes and self.prefixes[cidr] < cidr.num_addresses:
+            del self.prefixes[cidr]
+
+            self._split(cidr)
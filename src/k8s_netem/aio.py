@@ -0,0 +1,143 @@
+from __future__ import annotations
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+
+from k8s_netem.informer import Informer
+
+LOGGER = logging.getLogger('aio')
+
+# All nftables and tc changes are serialized by a single worker
+KERNEL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='kernel')
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def set_loop(loop: Optional[asyncio.AbstractEventLoop]):
+    """ Register the event loop which drives all watches and coalescers of the process """
+
+    global _loop
+    _loop = loop
+
+
+def get_loop() -> Optional[asyncio.AbstractEventLoop]:
+    return _loop
+
+
+async def kernel(func: Callable, *args):
+    """ Run a blocking nftables or tc operation on the kernel executor """
+
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(KERNEL, functools.partial(func, *args))
+
+
+async def blocking(func: Callable, *args):
+    """ Run a blocking API request without stalling the event loop """
+
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+def offload(func: Callable, *args):
+    """ Run a blocking API request of a synchronous caller without stalling it
+
+    This is the counterpart of blocking() for the kernel executor, e.g. for
+    hooks of committed batches. Without an event loop, func is run right away.
+    """
+
+    loop = get_loop()
+    if loop is None:
+        func(*args)
+        return
+
+    def run():
+        try:
+            func(*args)
+        except Exception as e:
+            LOGGER.exception('Failed to run %s: %s', func, e)
+
+    loop.call_soon_threadsafe(loop.run_in_executor, None, run)
+
+
+async def watch(informer: Informer) -> AsyncIterator[Dict]:
+    """ Turn the blocking watch of an informer into an async stream
+
+    The synchronous Kubernetes client can only be read by a blocking
+    thread. Events are handed over to the loop one by one, so that all
+    processing happens on the loop. Closing the stream stops the informer.
+    """
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def pump():
+        try:
+            for event in informer.watch():
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    reader = loop.run_in_executor(None, pump)
+
+    try:
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+
+            yield event
+    finally:
+        informer.stop()
+
+        # Unblocks once the informer has closed its response
+        await asyncio.shield(reader)
+
+
+class Watcher:
+    """ Dispatch the events of an informer to a handler
+
+    With an event loop registered, events are consumed by a task on the
+    loop. Otherwise a dedicated thread is used. stop() stops the informer
+    and waits for the consumer to finish.
+    """
+
+    def __init__(self, informer: Informer, handler: Callable[[Dict], None]):
+        self.informer = informer
+        self.handler = handler
+
+        self.task: Optional[concurrent.futures.Future] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        loop = get_loop()
+
+        if loop is not None:
+            self.task = asyncio.run_coroutine_threadsafe(self.consume(), loop)
+        else:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        for event in self.informer.watch():
+            self.handler(event)
+
+    async def consume(self):
+        async for event in watch(self.informer):
+            try:
+                self.handler(event)
+            except Exception as e:
+                LOGGER.exception('Failed to handle event: %s', e)
+
+    def stop(self, timeout: float = 5):
+        self.informer.stop()
+
+        if self.task is not None:
+            self.task.cancel()
+        elif self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
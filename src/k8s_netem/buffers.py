@@ -0,0 +1,99 @@
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+
+import logging
+import math
+import threading
+
+from k8s_netem.config import NETEM_PACKET_SIZE, NETEM_LIMIT_RATE, NETEM_LIMIT_POD_BYTES, NETEM_LIMIT_NODE_BYTES
+from k8s_netem.tc import parse_rate
+from k8s_netem import netns
+
+LOGGER = logging.getLogger('buffers')
+
+# Lower bound of derived netem limits in packets
+LIMIT_MIN = 128
+
+# Room for bursts above the bandwidth-delay product
+HEADROOM = 1.5
+
+
+def bdp_limit(delay: float = 0, jitter: float = 0, rate: Optional[float] = None) -> int:
+    """ Derive the netem limit in packets from the bandwidth-delay product
+
+    netem holds every packet for the delay plus jitter. At the given rate
+    in bit/s, the queue must hold that many seconds worth of packets.
+    Otherwise it drops packets which look like emulated loss.
+    """
+
+    if rate is None:
+        rate = parse_rate(NETEM_LIMIT_RATE)
+
+    packets = (delay + jitter) * rate / 8 / NETEM_PACKET_SIZE
+
+    return max(LIMIT_MIN, math.ceil(packets * HEADROOM))
+
+
+class BufferBudget:
+    """ Account the memory held by netem queues against the caps of pods and the node
+
+    A pod is represented by its network namespace. The node cap applies
+    across all pods managed by this process. This covers all pods of the
+    node only with the agent.
+    """
+
+    def __init__(self, pod_cap: int, node_cap: int):
+        self.pod_cap = pod_cap
+        self.node_cap = node_cap
+
+        self.lock = threading.Lock()
+
+        # Network namespace -> Owner -> Bytes
+        self.pods: Dict[Optional[int], Dict[str, int]] = {}
+
+    def reserve(self, owner: str, wanted: int, minimum: int = 0) -> int:
+        """ Reserve up to wanted bytes and return the granted amount
+
+        A previous reservation of the owner is replaced. At least minimum
+        bytes are granted, even if they exceed the caps.
+        """
+
+        key = netns.current().key
+
+        with self.lock:
+            pod = self.pods.setdefault(key, {})
+            pod.pop(owner, None)
+
+            pod_used = sum(pod.values())
+            node_used = sum(sum(p.values()) for p in self.pods.values())
+
+            granted = max(minimum, min(wanted, self.pod_cap - pod_used, self.node_cap - node_used))
+
+            pod[owner] = granted
+
+        return granted
+
+    def release(self, owner: str):
+        key = netns.current().key
+
+        with self.lock:
+            self.pods.get(key, {}).pop(owner, None)
+
+    def forget(self, ns: netns.NetNS):
+        with self.lock:
+            self.pods.pop(ns.key, None)
+
+    def usage(self) -> Tuple[int, int]:
+        """ Get the reserved bytes of the pod of the calling thread and the node """
+
+        key = netns.current().key
+
+        with self.lock:
+            return sum(self.pods.get(key, {}).values()), sum(sum(p.values()) for p in self.pods.values())
+
+
+BUDGET = BufferBudget(NETEM_LIMIT_POD_BYTES, NETEM_LIMIT_NODE_BYTES)
+
+
+def forget(ns: netns.NetNS):
+    BUDGET.forget(ns)
@@ -0,0 +1,293 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+import logging
+import threading
+
+from kubernetes import client
+
+from k8s_netem.aio import Watcher
+from k8s_netem.informer import Informer
+from k8s_netem.match import LabelSelector
+
+if TYPE_CHECKING:
+    from k8s_netem.peer import Peer
+
+SelectionKey = Tuple[str, Optional[str]]
+
+
+def selection_key(pod_selector: Dict, namespace_selector: Optional[Dict]) -> SelectionKey:
+    return (LabelSelector.compile(pod_selector).digest,
+            LabelSelector.compile(namespace_selector).digest if namespace_selector is not None else None)
+
+
+class Selection:
+    """ Pods matched by a distinct combination of pod and namespace selector
+
+    All peers with identical selectors share a single selection, so each
+    pod event is only matched once per distinct selector.
+    """
+
+    def __init__(self, pod_selector: Dict, namespace_selector: Optional[Dict]):
+        self.pod_selector = LabelSelector.compile(pod_selector)
+        self.namespace_selector = LabelSelector.compile(namespace_selector) if namespace_selector is not None else None
+
+        self.subscribers: List[Peer] = []
+
+        # Uid -> Pod
+        self.pods: Dict[str, object] = {}
+
+    def match(self, pod, namespace) -> bool:
+        if not self.pod_selector.match(pod.metadata.labels or {}):
+            return False
+
+        # Without a namespaceSelector, pods of all watched namespaces are selected
+        if self.namespace_selector is None:
+            return True
+
+        return namespace is not None and self.namespace_selector.match(namespace.metadata.labels or {})
+
+    def match_many(self, pods: List, namespaces: Dict[str, object]) -> List[bool]:
+        matches = self.pod_selector.match_many([pod.metadata.labels for pod in pods])
+
+        if self.namespace_selector is None:
+            return matches
+
+        # Each namespace is only matched once
+        namespace_matches = {name: self.namespace_selector.match(ns.metadata.labels) for name, ns in namespaces.items()}
+
+        return [match and namespace_matches.get(pod.metadata.namespace, False) for pod, match in zip(pods, matches)]
+
+    def evaluate(self, pod, namespace, deleted: bool = False) -> Optional[Dict]:
+        """ Get the event for the subscribers after a pod or its namespace has changed """
+
+        uid = pod.metadata.uid
+
+        if not deleted and self.match(pod, namespace):
+            type = 'MODIFIED' if uid in self.pods else 'ADDED'
+            self.pods[uid] = pod
+        elif uid in self.pods:
+            type = 'DELETED'
+            del self.pods[uid]
+        else:
+            return None
+
+        return {
+            'type': type,
+            'object': pod
+        }
+
+
+class PodCache:
+    """ A single pod and namespace informer shared by all peers of a sidecar
+
+    Pod changes are dispatched to the peers of every selection which
+    selects the pod. The number of watches does not depend on the number
+    of peers or selected namespaces.
+
+    The cache can be restricted to the pods of some namespaces. Each of
+    them is watched separately then instead of the pods of the whole cluster.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('cache')
+
+        self.lock = threading.RLock()
+
+        # Namespace name -> Namespace
+        self.namespaces: Dict[str, object] = {}
+
+        # Namespace name -> Uid -> Pod
+        self.pods: Dict[str, Dict[str, object]] = {}
+
+        self.selections: Dict[SelectionKey, Selection] = {}
+
+        # Get all pod and namespace events regardless of any selection
+        self.listeners: List[Callable[[Dict], None]] = []
+        self.namespace_listeners: List[Callable[[Dict], None]] = []
+
+        self.watchers: List[Watcher] = []
+
+        # Names of the watched namespaces or None for all
+        self.scope: Optional[List[str]] = None
+
+    def restrict(self, namespaces: Optional[List[str]]):
+        """ Only watch the pods of the given namespaces """
+
+        with self.lock:
+            if len(self.watchers) > 0:
+                raise RuntimeError('The pod cache has already been started')
+
+            self.scope = namespaces
+
+    def init(self):
+        with self.lock:
+            if len(self.watchers) > 0:
+                return
+
+            v1 = client.CoreV1Api()
+
+            namespaces = Informer('namespaces', v1.list_namespace)
+
+            if self.scope is None:
+                pods = [Informer('pods', v1.list_pod_for_all_namespaces)]
+            else:
+                self.logger.info('Watching pods of namespaces %s only', ', '.join(self.scope))
+
+                pods = [Informer(f'pods:{ns}', v1.list_namespaced_pod, namespace=ns) for ns in self.scope]
+
+            # Namespaces must be known before pods can be matched
+            for event in namespaces.list():
+                self.handle_namespace_event(event)
+
+            for informer in pods:
+                for event in informer.list():
+                    self.handle_pod_event(event)
+
+            handlers = [(namespaces, self.handle_namespace_event)] + [(informer, self.handle_pod_event) for informer in pods]
+
+            for informer, handler in handlers:
+                watcher = Watcher(informer, handler)
+                watcher.start()
+
+                self.watchers.append(watcher)
+
+    def deinit(self):
+        for watcher in self.watchers:
+            watcher.stop()
+
+    def add_listener(self, listener: Callable[[Dict], None]):
+        """ Register a listener and replay all known pods to it """
+
+        self.init()
+
+        with self.lock:
+            self.listeners.append(listener)
+
+            for pods in self.pods.values():
+                for pod in pods.values():
+                    listener({'type': 'ADDED', 'object': pod})
+
+    def add_namespace_listener(self, listener: Callable[[Dict], None]):
+        self.init()
+
+        with self.lock:
+            self.namespace_listeners.append(listener)
+
+    def subscribe(self, peer: Peer):
+        self.init()
+
+        pod_selector = peer.spec.get('podSelector', {})
+        namespace_selector = peer.spec.get('namespaceSelector')
+
+        key = selection_key(pod_selector, namespace_selector)
+
+        with self.lock:
+            selection = self.selections.get(key)
+            if selection is None:
+                selection = Selection(pod_selector, namespace_selector)
+                self.selections[key] = selection
+
+                for namespace, pods in self.pods.items():
+                    for pod in pods.values():
+                        selection.evaluate(pod, self.namespaces.get(namespace))
+
+            selection.subscribers.append(peer)
+
+            self.logger.info('Subscribed peer %s to selection with %d pods (%d selections in total)',
+                             peer, len(selection.pods), len(self.selections))
+
+            # All initially selected pods are added with a single transaction
+            peer.handle_pod_events([{'type': 'ADDED', 'object': pod} for pod in selection.pods.values()])
+
+    def select(self, pod_selector: Dict, namespace_selector: Optional[Dict]) -> List:
+        """ Get the cached pods which are matched by a pair of selectors """
+
+        self.init()
+
+        with self.lock:
+            selection = self.selections.get(selection_key(pod_selector, namespace_selector))
+            if selection is None:
+                selection = Selection(pod_selector, namespace_selector)
+
+                for namespace, pods in self.pods.items():
+                    for pod in pods.values():
+                        selection.evaluate(pod, self.namespaces.get(namespace))
+
+            return list(selection.pods.values())
+
+    def unsubscribe(self, peer: Peer):
+        with self.lock:
+            for key, selection in list(self.selections.items()):
+                # Peers with identical specs compare equal
+                subscribers = [p for p in selection.subscribers if p is not peer]
+                if len(subscribers) == len(selection.subscribers):
+                    continue
+
+                selection.subscribers = subscribers
+
+                if len(selection.subscribers) == 0:
+                    del self.selections[key]
+
+    def handle_namespace_event(self, event):
+        ns = event['object']
+        name = ns.metadata.name
+
+        self.logger.debug('%s namespace %s', event['type'].capitalize(), name)
+
+        with self.lock:
+            if event['type'] == 'DELETED':
+                self.namespaces.pop(name, None)
+                namespace = None
+            else:
+                self.namespaces[name] = ns
+                namespace = ns
+
+            for listener in self.namespace_listeners:
+                listener(event)
+
+            pods = list(self.pods.get(name, {}).values())
+
+            # Pods are re-evaluated as the namespace labels might have changed
+            for selection in self.selections.values():
+                if selection.namespace_selector is None:
+                    continue
+
+                events = [selection.evaluate(pod, namespace) for pod in pods]
+                events = [e for e in events if e is not None and e['type'] != 'MODIFIED']
+
+                if len(events) == 0:
+                    continue
+
+                for peer in selection.subscribers:
+                    peer.handle_pod_events(events)
+
+    def handle_pod_event(self, event):
+        pod = event['object']
+        uid = pod.metadata.uid
+        name = pod.metadata.namespace
+
+        deleted = event['type'] == 'DELETED'
+
+        with self.lock:
+            pods = self.pods.setdefault(name, {})
+            if deleted:
+                pods.pop(uid, None)
+            else:
+                pods[uid] = pod
+
+            for listener in self.listeners:
+                listener(event)
+
+            namespace = self.namespaces.get(name)
+
+            for selection in self.selections.values():
+                evt = selection.evaluate(pod, namespace, deleted)
+                if evt is None:
+                    continue
+
+                for peer in selection.subscribers:
+                    peer.handle_pod_event(evt)
+
+
+POD_CACHE = PodCache()
@@ -1,31 +1,294 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+
 import logging
+import os
+import re
+import select
 import subprocess
 import shlex
+import threading
+import time
+
+from k8s_netem.config import TC_BATCH
+from k8s_netem import netns
 
 LOGGER = logging.getLogger('call')
 
+# Is never present, so that its lookup fails and marks the end of a batch
+SYNC_DEVICE = 'k8s-netem-sync'
+
+FAILED = re.compile(r'^Command failed -:(\d+)$')
+
+
+def batchable(command: str) -> bool:
+    """ Check if a command can be passed to the tc coprocess
+
+    Global options are not accepted by the batch mode. The output of
+    show commands is read by the caller and needs its own process.
+    """
+
+    args = shlex.split(command)
+
+    return len(args) > 2 and args[0] == 'tc' and not args[1].startswith('-') and args[2] not in ['show', 'list', 'ls']
+
+
+class TcExecutor:
+    """ A long-lived 'tc -force -batch -' process
+
+    Commands are streamed to the standard input of tc. Failed commands
+    are reported on stderr with their line number, which is mapped back
+    to the command. Every write is followed by a command which always
+    fails. Its report tells us that tc has processed all commands before it.
+
+    The process inherits the network namespace of the thread which
+    started it.
+    """
+
+    def __init__(self, timeout: float = 5):
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+
+        self.proc: Optional[subprocess.Popen] = None
+        self.lineno = 0
+        self.buffer = b''
+
+    def start(self):
+        LOGGER.debug('Starting tc coprocess')
+
+        self.proc = subprocess.Popen(['tc', '-force', '-batch', '-'],
+                                     stdin=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        self.lineno = 0
+        self.buffer = b''
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.proc is None:
+            return
+
+        self.proc.stdin.close()
+
+        try:
+            self.proc.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+        self.proc.stderr.close()
+        self.proc = None
+
+    def run(self, commands: List[str]) -> Dict[int, str]:
+        """ Run commands and return the error messages by index of the failed commands """
+
+        commands = [c[3:] if c.startswith('tc ') else c for c in commands]
+        if len(commands) == 0:
+            return {}
+
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+
+            first = self.lineno + 1
+            self.lineno += len(commands) + 1
+            sync = self.lineno
+
+            script = ''.join(f'{c}\n' for c in commands) + f'qdisc show dev {SYNC_DEVICE}\n'
+
+            for command in commands:
+                LOGGER.info('Run: tc %s', command)
+
+            try:
+                self.proc.stdin.write(script.encode())
+                self.proc.stdin.flush()
+
+                return self._collect(first, sync)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                LOGGER.error('tc coprocess failed: %s', e)
+
+                self.proc.kill()
+                self._close()
+
+                # We can not tell which commands have been applied
+                return {i: f'tc coprocess failed: {e}' for i in range(len(commands))}
+
+    def _collect(self, first: int, sync: int) -> Dict[int, str]:
+        errors: Dict[int, str] = {}
+        messages: List[str] = []
+
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            line = self._readline(deadline)
+
+            m = FAILED.match(line)
+            if m is None:
+                messages.append(line)
+                continue
+
+            lineno = int(m.group(1))
+            if lineno == sync:
+                return errors
+
+            if lineno >= first:
+                errors[lineno - first] = ' '.join(messages)
+
+            messages = []
+
+    def _readline(self, deadline: float) -> str:
+        fd = self.proc.stderr.fileno()
+
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired('tc -batch', self.timeout)
+
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+
+            chunk = os.read(fd, 4096)
+            if len(chunk) == 0:
+                raise OSError('tc coprocess has exited')
+
+            self.buffer += chunk
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+
+        return line.decode(errors='replace').strip()
+
+
+_executors: Dict[Optional[int], TcExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor() -> TcExecutor:
+    """ Get the tc coprocess of the network namespace of the calling thread """
+
+    key = netns.current().key
+
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            executor = _executors[key] = TcExecutor()
+
+    return executor
+
+
+def forget(ns: netns.NetNS):
+    with _executors_lock:
+        executor = _executors.pop(ns.key, None)
+
+    if executor is not None:
+        executor.close()
+
+
+class TcBatch:
+    """ Pass a group of tc commands to the coprocess with a single write
+
+    The commands are run when the context is left without an exception.
+    tc has no transactions. Commands following a failed one are still
+    run. The first failed command which has been added with check=True
+    raises a CalledProcessError.
+    """
+
+    def __init__(self):
+        # Command, Check
+        self.commands: List[Tuple[str, bool]] = []
+
+        # Index -> Error message
+        self.errors: Dict[int, str] = {}
+
+        # Index -> Standard output
+        self.outputs: Dict[int, str] = {}
+
+    def __enter__(self) -> TcBatch:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def add(self, command: str, check: bool = True):
+        self.commands.append((command, check))
+
+    def commit(self):
+        commands = [command for command, _ in self.commands]
+
+        if TC_BATCH and all(batchable(command) for command in commands):
+            self.errors = get_executor().run(commands)
+            self.outputs = {}
+        else:
+            self.errors = {}
+            self.outputs = {}
+            for i, command in enumerate(commands):
+                LOGGER.info('Run: %s', command)
+
+                proc = subprocess.run(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                if proc.returncode != 0:
+                    self.errors[i] = proc.stderr.strip()
+
+                self.outputs[i] = proc.stdout
+
+        for i, (command, check) in enumerate(self.commands):
+            error = self.errors.get(i)
+            if error is None:
+                continue
+
+            LOGGER.debug('Failed: %s: %s', command, error)
+
+            if check:
+                raise subprocess.CalledProcessError(1, command, stderr=error)
+
+    def results(self) -> List[Tuple[str, str, str]]:
+        """ Get all commands with their output and error messages
+
+        Batchable commands only change the kernel state and print nothing.
+        So their output is always empty when passed to the coprocess.
+        """
+
+        return [(command, self.outputs.get(i, ''), self.errors.get(i, '')) for i, (command, _) in enumerate(self.commands)]
+
 
 class Caller:
     @classmethod
     def _call(cls, command: str):
         """Run command."""
-        LOGGER.info('Run: %s', command)
-        subprocess.call(shlex.split(command))
+        call(command)
 
     @classmethod
     def _check_call(cls, command: str):
         """Run command, raising CalledProcessError if it fails."""
-        LOGGER.info('Run: %s', command)
-        subprocess.check_call(shlex.split(command))
+        check_call(command)
+
+    @classmethod
+    def _check_output(cls, command: str) -> str:
+        """Run command and return its output, raising CalledProcessError if it fails."""
+        LOGGER.debug('Run: %s', command)
+        return subprocess.check_output(shlex.split(command), text=True)
 
 
 def call(command: str):
     """Run command."""
+    if TC_BATCH and batchable(command):
+        with TcBatch() as batch:
+            batch.add(command, check=False)
+        return
+
     LOGGER.info('Run: %s', command)
     subprocess.call(shlex.split(command))
 
 
 def check_call(command: str):
     """Run command, raising CalledProcessError if it fails."""
+    if TC_BATCH and batchable(command):
+        with TcBatch() as batch:
+            batch.add(command)
+        return
+
     LOGGER.info('Run: %s', command)
     subprocess.check_call(shlex.split(command))
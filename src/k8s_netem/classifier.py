@@ -0,0 +1,677 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import ipaddress
+import itertools
+import logging
+
+from k8s_netem.config import NFT_TABLE_PREFIX, NFT_CONNTRACK
+from k8s_netem.marks import CT_GENERATION_SHIFT, CT_GENERATION_MASK, CT_GENERATIONS, get_allocator
+from k8s_netem.nftables import NftBatch
+from k8s_netem import netns
+
+# (Interface index, Network, L4 protocol, Port)
+# Protocol and port are wildcards if None
+Key = Tuple[int, ipaddress.IPv4Network, Optional[Union[str, int]], Optional[int]]
+
+TABLE = {
+    'family': 'ip',
+    'table': NFT_TABLE_PREFIX
+}
+
+
+def overlaps(a: Key, b: Key) -> bool:
+    return a[0] == b[0] and \
+        a[1].overlaps(b[1]) and \
+        (a[2] is None or b[2] is None or a[2] == b[2]) and \
+        (a[3] is None or b[3] is None or a[3] == b[3])
+
+
+class Classifier:
+    """ Classification of all profiles with a single base chain and verdict map
+
+    In the compiled nftables mode all profiles share a single table. A
+    single rule per direction looks up the interface, address, L4 protocol
+    and port in a verdict map. The cost of classifying a packet therefore
+    does not depend on the number of profiles.
+
+    The map jumps to a small chain per mark. Like the per-profile tables,
+    it only replaces the bits of NETEM_MARK_MASK so that marks of other
+    components such as the CNI are kept.
+
+    With NFT_CONNTRACK enabled, only the first packet of a connection is
+    looked up in the map. The chain of a match also stores the mark in the
+    conntrack mark together with the current generation of the classifier.
+    Following packets are sent to the same chain by a second verdict map
+    keyed by the stored bits. Connections without a match are looked up
+    again for each packet, so added elements apply to them right away.
+    Only removing or remapping elements bumps the generation so that
+    existing connections get reclassified.
+
+    Elements of the map must not overlap. Traffic which is already mapped by
+    another rule is therefore skipped. Profiles with overlapping rules need
+    to use the per-profile tables mode.
+    """
+
+    def __init__(self, direction: str, mask: int):
+        self.logger = logging.getLogger(f'classifier:{direction}')
+
+        self.direction = direction
+        self.mask = mask
+
+        self.chain_name = direction
+        self.map_name = f'{direction}-marks'
+        self.restore_map_name = f'{direction}-restore'
+
+        # Key -> (Mark, Reference count)
+        self.elements: Dict[Key, Tuple[int, int]] = {}
+
+        # Mark -> Number of elements which jump to its chain
+        self.marks: Dict[int, int] = {}
+
+        # Indices for finding overlapping elements without scanning the whole map
+        # Networks are given by their address and prefix length
+        # (Interface index, Address, Prefix length) -> Keys with exactly this network
+        self.by_net: Dict[Tuple[int, int, int], Set[Key]] = {}
+        # (Interface index, Address, Prefix length) -> Keys with this network or one of its subnets
+        self.by_supernet: Dict[Tuple[int, int, int], Set[Key]] = {}
+
+        # Generation of the classification results stored in conntrack marks
+        self.generation = 1
+        self.bumped_batch: NftBatch = None
+
+        # The map still contains the elements of a previous run
+        self.stale = False
+
+        # Mark chains which are not referenced by the maps anymore
+        self.stale_chains: Set[str] = set()
+
+    def mark_chain_name(self, mark: int) -> str:
+        return f'{self.direction}-mark-{mark:x}'
+
+    def is_mark_chain(self, name: str) -> bool:
+        return name.startswith(f'{self.direction}-mark-')
+
+    def cmd_init(self) -> List:
+        cmds = [
+          {
+            'add': {
+              'table': {
+                'family': 'ip',
+                'name': NFT_TABLE_PREFIX
+              }
+            }
+          },
+          {
+            'add': {
+              'chain': {
+                **TABLE,
+                'name': self.chain_name,
+                'hook': 'input' if self.direction == 'ingress' else 'output',
+                'type': 'filter',
+                'prio': 0
+              }
+            }
+          },
+          {
+            'add': {
+              'map': {
+                **TABLE,
+                'name': self.map_name,
+                'type': ['iface_index', 'ipv4_addr', 'inet_proto', 'inet_service'],
+                'map': 'verdict',
+                'flags': ['interval']
+              }
+            }
+          }
+        ]
+
+        if NFT_CONNTRACK:
+            cmds.append({
+              'add': {
+                'map': {
+                  **TABLE,
+                  'name': self.restore_map_name,
+                  'type': 'mark',
+                  'map': 'verdict'
+                }
+              }
+            })
+
+        return cmds + self.cmd_create_rules()
+
+    def cmd_create_rules(self) -> List:
+        """ (Re-)create all rules of the base chain and the mark chains
+
+        The rules of the mark chains and the elements of the restore map
+        contain the generation. They are recreated for all used marks.
+        """
+
+        rules = []
+
+        if NFT_CONNTRACK:
+            rules.append(('restore', self.expr_restore()))
+
+        rules.append(('dispatch', self.expr_dispatch()))
+
+        cmds = self.cmd_flush_chain(self.chain_name) + [
+          {
+            'add': {
+              'rule': {
+                **TABLE,
+                'chain': self.chain_name,
+                'comment': comment,
+                'expr': exprs
+              }
+            }
+          } for comment, exprs in rules
+        ]
+
+        if NFT_CONNTRACK:
+            cmds.append({
+              'flush': {
+                'map': {
+                  **TABLE,
+                  'name': self.restore_map_name
+                }
+              }
+            })
+
+            for mark in self.marks:
+                cmds += self.cmd_create_mark_chain(mark)
+
+        return cmds
+
+    def cmd_flush_chain(self, name: str) -> List:
+        return [
+          {
+            'flush': {
+              'chain': {
+                **TABLE,
+                'name': name
+              }
+            }
+          }
+        ]
+
+    def cmd_create_mark_chain(self, mark: int) -> List:
+        """ (Re-)create the chain which applies a mark
+
+        The chain is added before it is flushed, so that this also works
+        for chains which already exist.
+        """
+
+        name = self.mark_chain_name(mark)
+
+        cmds = [
+          {
+            'add': {
+              'chain': {
+                **TABLE,
+                'name': name
+              }
+            }
+          }
+        ] + self.cmd_flush_chain(name) + [
+          {
+            'add': {
+              'rule': {
+                **TABLE,
+                'chain': name,
+                'expr': self.expr_mark(mark)
+              }
+            }
+          }
+        ]
+
+        if NFT_CONNTRACK:
+            cmds += self.cmd_modify_restore_element('add', mark)
+
+        return cmds
+
+    def cmd_delete_mark_chain(self, mark: int) -> List:
+        cmds = []
+
+        if NFT_CONNTRACK:
+            cmds += self.cmd_modify_restore_element('delete', mark)
+
+        return cmds + self.cmd_delete_chain(self.mark_chain_name(mark))
+
+    def cmd_delete_chain(self, name: str) -> List:
+        """ Delete a chain which might not exist anymore """
+
+        return [
+          {
+            'add': {
+              'chain': {
+                **TABLE,
+                'name': name
+              }
+            }
+          }
+        ] + self.cmd_flush_chain(name) + [
+          {
+            'delete': {
+              'chain': {
+                **TABLE,
+                'name': name
+              }
+            }
+          }
+        ]
+
+    def cmd_modify_restore_element(self, op: str, mark: int) -> List:
+        return [
+          {
+            op: {
+              'element': {
+                **TABLE,
+                'name': self.restore_map_name,
+                'elem': [
+                  [
+                    mark | self.generation << CT_GENERATION_SHIFT,
+                    self.verdict(mark)
+                  ]
+                ]
+              }
+            }
+          }
+        ]
+
+    def verdict(self, mark: int) -> Dict:
+        return {
+          'goto': {
+            'target': self.mark_chain_name(mark)
+          }
+        }
+
+    def expr_dispatch(self) -> List:
+        ingress = self.direction == 'ingress'
+
+        return [
+          {
+            'vmap': {
+              'key': {
+                'concat': [
+                  {
+                    'meta': {
+                      'key': 'iif' if ingress else 'oif'
+                    }
+                  },
+                  {
+                    'payload': {
+                      'protocol': 'ip',
+                      'field': 'saddr' if ingress else 'daddr'
+                    }
+                  },
+                  {
+                    'meta': {
+                      'key': 'l4proto'
+                    }
+                  },
+                  {
+                    'payload': {
+                      'protocol': 'th',
+                      'field': 'sport' if ingress else 'dport'
+                    }
+                  }
+                ]
+              },
+              'data': f'@{self.map_name}'
+            }
+          }
+        ]
+
+    def expr_restore(self) -> List:
+        """ Restore the mark of connections which have been classified by the current generation """
+
+        return [
+          {
+            'vmap': {
+              'key': {
+                '&': [
+                  {
+                    'ct': {
+                      'key': 'mark'
+                    }
+                  },
+                  self.mask | CT_GENERATION_MASK
+                ]
+              },
+              'data': f'@{self.restore_map_name}'
+            }
+          }
+        ]
+
+    def expr_mark(self, mark: int) -> List:
+        """ Replace the bits of the mask in the packet mark
+
+        With NFT_CONNTRACK, the mark is also remembered in the conntrack
+        mark together with the generation.
+        """
+
+        exprs = [
+          {
+            'mangle': {
+              'key': {
+                'meta': {
+                  'key': 'mark'
+                }
+              },
+              'value': {
+                '|': [
+                  {
+                    '&': [
+                      {
+                        'meta': {
+                          'key': 'mark'
+                        }
+                      },
+                      ~self.mask & 0xffffffff
+                    ]
+                  },
+                  mark
+                ]
+              }
+            }
+          }
+        ]
+
+        if NFT_CONNTRACK:
+            exprs.append({
+              'mangle': {
+                'key': {
+                  'ct': {
+                    'key': 'mark'
+                  }
+                },
+                'value': {
+                  '|': [
+                    {
+                      '&': [
+                        {
+                          'ct': {
+                            'key': 'mark'
+                          }
+                        },
+                        ~(self.mask | CT_GENERATION_MASK) & 0xffffffff
+                      ]
+                    },
+                    mark | self.generation << CT_GENERATION_SHIFT
+                  ]
+                }
+              }
+            })
+
+        return exprs
+
+    def bump_generation(self, batch: NftBatch):
+        """ Invalidate the classification results stored in the conntrack marks
+
+        The chains are recreated as part of the batch, so that the
+        new generation becomes active atomically with the map changes.
+        """
+
+        if not NFT_CONNTRACK or self.bumped_batch is batch:
+            return
+
+        generation = self.generation
+
+        def rollback():
+            self.generation = generation
+            self.bumped_batch = None
+
+        self.generation = generation % CT_GENERATIONS + 1
+        self.bumped_batch = batch
+
+        batch.add(self.cmd_create_rules())
+        batch.on_rollback(rollback)
+
+    def reset(self):
+        # The chains are not referenced anymore once the maps get flushed
+        self.stale_chains |= {self.mark_chain_name(mark) for mark in self.marks}
+
+        self.elements = {}
+        self.marks = {}
+        self.by_net = {}
+        self.by_supernet = {}
+
+    def cmd_flush(self) -> List:
+        cmds = [
+          {
+            'flush': {
+              'map': {
+                **TABLE,
+                'name': self.map_name
+              }
+            }
+          }
+        ]
+
+        if NFT_CONNTRACK:
+            cmds.append({
+              'flush': {
+                'map': {
+                  **TABLE,
+                  'name': self.restore_map_name
+                }
+              }
+            })
+
+        return cmds
+
+    def delete_stale_chains(self, batch: NftBatch):
+        """ Delete the mark chains of a previous run or rebuild
+
+        Needs to follow the flush of the maps. Chains which are
+        still needed get recreated later in the batch.
+        """
+
+        chains = set(self.stale_chains)
+
+        for name in sorted(chains):
+            batch.add(self.cmd_delete_chain(name))
+
+        batch.on_commit(lambda: self.stale_chains.difference_update(chains))
+
+    def adopted(self):
+        self.stale = False
+
+    def elem(self, key: Key, mark: int):
+        ifindex, net, proto, port = key
+
+        if net.prefixlen >= ipaddress.IPV4LENGTH:
+            addr: str | dict = str(net.network_address)
+        else:
+            addr = {
+              'prefix': {
+                'addr': str(net.network_address),
+                'len': net.prefixlen
+              }
+            }
+
+        return [
+          {
+            'concat': [
+              ifindex,
+              addr,
+              proto if proto is not None else {'range': [0, 255]},
+              port if port is not None else {'range': [0, 65535]}
+            ]
+          },
+          self.verdict(mark)
+        ]
+
+    def cmd_modify_elements(self, op: str, elems: List) -> List:
+        return [
+          {
+            op: {
+              'element': {
+                **TABLE,
+                'name': self.map_name,
+                'elem': elems
+              }
+            }
+          }
+        ]
+
+    def _ref(self, key: Key, mark: int) -> bool:
+        """ Returns True if the element is new """
+
+        _, refs = self.elements.get(key, (mark, 0))
+        self.elements[key] = (mark, refs + 1)
+
+        if refs == 0:
+            self._index(key)
+            self.marks[mark] = self.marks.get(mark, 0) + 1
+
+        return refs == 0
+
+    def _unref(self, key: Key) -> bool:
+        """ Returns True if the element is not referenced anymore """
+
+        mark, refs = self.elements[key]
+        if refs > 1:
+            self.elements[key] = (mark, refs - 1)
+            return False
+
+        del self.elements[key]
+        self._unindex(key)
+
+        if self.marks[mark] > 1:
+            self.marks[mark] -= 1
+        else:
+            del self.marks[mark]
+
+        return True
+
+    @staticmethod
+    def _supernets(key: Key) -> List[Tuple[int, int, int]]:
+        """ Get the network of a key and all its supernets, widest first """
+
+        ifindex, net = key[0], key[1]
+        addr = int(net.network_address)
+
+        return [(ifindex, addr & ~((1 << (ipaddress.IPV4LENGTH - p)) - 1), p) for p in range(net.prefixlen + 1)]
+
+    def _index(self, key: Key):
+        supernets = self._supernets(key)
+
+        self.by_net.setdefault(supernets[-1], set()).add(key)
+
+        for supernet in supernets:
+            self.by_supernet.setdefault(supernet, set()).add(key)
+
+    def _unindex(self, key: Key):
+        supernets = self._supernets(key)
+
+        for index, supernet in [(self.by_net, supernets[-1])] + [(self.by_supernet, s) for s in supernets]:
+            keys = index[supernet]
+            keys.discard(key)
+
+            if len(keys) == 0:
+                del index[supernet]
+
+    def conflict(self, key: Key) -> Optional[Key]:
+        """ Get an element which overlaps with the key
+
+        Only elements whose network contains or is contained by
+        the network of the key are compared.
+        """
+
+        supernets = self._supernets(key)
+
+        wider = (self.by_net.get(s, ()) for s in supernets[:-1])
+        candidates = itertools.chain(*wider, self.by_supernet.get(supernets[-1], ()))
+
+        return next((k for k in candidates if overlaps(k, key)), None)
+
+    def add(self, batch: NftBatch, keys: Iterable[Key], mark: int):
+        elems = []
+        refd = []
+
+        unused = mark not in self.marks
+
+        for key in keys:
+            current = self.elements.get(key)
+            if current is not None and current[0] != mark:
+                self.logger.error('Traffic %s is already mapped to mark %d. Skipping', key, current[0])
+                continue
+
+            if current is None:
+                conflict = self.conflict(key)
+                if conflict is not None:
+                    self.logger.error('Traffic %s overlaps with already mapped %s. Skipping', key, conflict)
+                    continue
+
+            if self._ref(key, mark):
+                elems.append(self.elem(key, mark))
+
+            refd.append(key)
+
+        def rollback():
+            for key in refd:
+                self._unref(key)
+
+        if len(refd) > 0:
+            batch.on_rollback(rollback)
+
+        # Connections without a match are not stored in conntrack.
+        # Hence, pure additions do not need a new generation.
+        if len(elems) > 0:
+            # The chain needs to exist before it is referenced
+            if unused:
+                batch.add(self.cmd_create_mark_chain(mark))
+
+            batch.add(self.cmd_modify_elements('add', elems))
+
+    def delete(self, batch: NftBatch, keys: Iterable[Key], mark: int):
+        elems = []
+        unrefd = []
+
+        for key in keys:
+            current = self.elements.get(key)
+            if current is None or current[0] != mark:
+                continue
+
+            if self._unref(key):
+                elems.append(self.elem(key, mark))
+
+            unrefd.append(key)
+
+        def rollback():
+            for key in unrefd:
+                self._ref(key, mark)
+
+        if len(unrefd) > 0:
+            batch.on_rollback(rollback)
+
+        if len(elems) > 0:
+            batch.add(self.cmd_modify_elements('delete', elems))
+
+            if mark not in self.marks:
+                batch.add(self.cmd_delete_mark_chain(mark))
+
+            self.bump_generation(batch)
+
+
+# Network namespace -> Direction -> Classifier
+_classifiers: Dict[Optional[int], Dict[str, Classifier]] = {}
+
+
+def get_classifiers() -> Dict[str, Classifier]:
+    """ Get the classifiers of the network namespace of the calling thread """
+
+    classifiers = _classifiers.get(netns.current().key)
+    if classifiers is None:
+        mask = get_allocator().mask
+
+        classifiers = _classifiers.setdefault(netns.current().key, {
+            'egress': Classifier('egress', mask)
+        })
+
+    return classifiers
+
+
+def forget(ns: netns.NetNS):
+    _classifiers.pop(ns.key, None)
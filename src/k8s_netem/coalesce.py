@@ -0,0 +1,97 @@
+from typing import Any, Callable, Dict, Hashable, Union
+
+import asyncio
+import logging
+import threading
+
+from k8s_netem import aio
+from k8s_netem.config import COALESCE_WINDOW
+
+# Placeholder until the event loop has armed the timer
+SCHEDULING = object()
+
+
+class Coalescer:
+    """ Collect keyed items for a short window and hand them over as one batch
+
+    Later items replace earlier ones with the same key, so superseded
+    versions of an object are dropped before the batch is flushed.
+    Flushes are serialized. If an event loop is registered, the window is
+    timed by the loop and flushes run on the kernel executor. Otherwise
+    flushes run on a timer thread.
+    """
+
+    def __init__(self, name: str, flush: Callable[[Dict[Hashable, Any]], None], window: float = COALESCE_WINDOW):
+        self.logger = logging.getLogger(f'coalesce:{name}')
+
+        self.window = window
+        self.flush_func = flush
+
+        self.pending: Dict[Hashable, Any] = {}
+        self.timer: Union[threading.Timer, asyncio.TimerHandle, object] = None
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def put(self, key: Hashable, item: Any):
+        with self.lock:
+            self.pending[key] = item
+
+            if self.timer is not None:
+                return
+
+            loop = aio.get_loop()
+            if loop is not None:
+                self.timer = SCHEDULING
+                loop.call_soon_threadsafe(self._schedule, loop)
+            else:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop):
+        with self.lock:
+            # Cancelled in the meantime
+            if self.timer is not SCHEDULING:
+                return
+
+            self.timer = loop.call_later(self.window, self.expedite)
+
+    def expedite(self):
+        """ Flush without waiting for the window to pass """
+
+        if aio.get_loop() is not None:
+            aio.KERNEL.submit(self.flush)
+        else:
+            # The caller might hold locks which are needed by the flush
+            thread = threading.Thread(target=self.flush, daemon=True)
+            thread.start()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+
+                self.pending = {}
+                self.timer = None
+
+            if len(batch) == 0:
+                return
+
+            self.logger.debug('Flushing batch of %d items', len(batch))
+
+            try:
+                self.flush_func(batch)
+            except Exception as e:
+                self.logger.exception('Failed to apply batch: %s', e)
+
+    def cancel(self):
+        with self.lock:
+            if isinstance(self.timer, threading.Timer):
+                self.timer.cancel()
+            elif isinstance(self.timer, asyncio.TimerHandle):
+                aio.get_loop().call_soon_threadsafe(self.timer.cancel)
+
+            self.timer = None
+
+            self.pending = {}
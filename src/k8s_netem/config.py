@@ -2,12 +2,80 @@ import os
 
 POD_NAMESPACE = os.environ.get('POD_NAMESPACE')
 POD_NAME = os.environ.get('POD_NAME')
+NODE_NAME = os.environ.get('NODE_NAME')
 
 SSL_CERT_FILE = os.environ.get('SSL_CERT_FILE', '/certs/tls.crt')
 SSL_KEY_FILE = os.environ.get('SSL_KEY_FILE', '/certs/tls.key')
 
 INJECT_TO_ALL = os.environ.get('INJECT_TO_ALL') in ['1', 'true', 'on']
 
+# Pods are managed by a per-node agent instead of injected sidecars
+AGENT_MODE = os.environ.get('AGENT_MODE') in ['1', 'true', 'on']
+
+# Follow the TrafficPlans published by the resolver instead of evaluating all profiles
+USE_PLANS = os.environ.get('USE_PLANS') in ['1', 'true', 'on']
+
 DEBUG = os.environ.get('DEBUG') in ['1', 'true', 'on']
 
 NFT_TABLE_PREFIX = 'k8s-netem'
+
+# 'tables' creates a table and base chain per profile
+# 'compiled' classifies all profiles with a single base chain and verdict map
+NFT_MODE = os.environ.get('NFT_MODE', 'tables')
+NFT_COMPILED = NFT_MODE == 'compiled'
+
+# Classify only the first packet of a connection (compiled mode only)
+NFT_CONNTRACK = os.environ.get('NFT_CONNTRACK') in ['1', 'true', 'on']
+
+# Bits of the fwmark used for profiles. The remaining bits are left to the CNI
+# The default avoids the bits used by Calico, Cilium and kube-proxy
+# It limits the number of profiles to 255, per pod or, with USE_PLANS, across the cluster
+NETEM_MARK_MASK = int(os.environ.get('NETEM_MARK_MASK', '0xff'), 0)
+
+# 'tc' forks the tc command, 'netlink' talks rtnetlink in-process (requires pyroute2)
+TC_BACKEND = os.environ.get('TC_BACKEND', 'tc')
+
+# Root qdisc of the builtin controller
+# 'prio' uses a band and fw filter prio per profile (at most 13 profiles per interface)
+# 'htb' maps marks to classes with a single fw filter prio
+TC_ROOT = os.environ.get('TC_ROOT', 'prio')
+
+# Interfaces (regex) whose TX queues get their own copy of the root qdisc below an mq qdisc
+# Other interfaces and those with a single TX queue use the single-queue layout
+# Interfaces fall back to the single-queue layout once they carry a profile with a shaping rate
+TC_MULTIQUEUE = os.environ.get('TC_MULTIQUEUE')
+
+# Rate of the HTB classes. Profiles are not shaped by it
+TC_HTB_RATE = os.environ.get('TC_HTB_RATE', '10gbit')
+
+# Packet size in bytes assumed for sizing netem queues and their memory
+NETEM_PACKET_SIZE = int(os.environ.get('NETEM_PACKET_SIZE', '1500'))
+
+# Rate assumed for sizing the netem queues of profiles without a rate
+NETEM_LIMIT_RATE = os.environ.get('NETEM_LIMIT_RATE', '1gbit')
+
+# Caps in bytes of the memory held by the netem queues of a pod and of all pods of the process
+NETEM_LIMIT_POD_BYTES = int(os.environ.get('NETEM_LIMIT_POD_BYTES', str(64 << 20)), 0)
+NETEM_LIMIT_NODE_BYTES = int(os.environ.get('NETEM_LIMIT_NODE_BYTES', str(1 << 30)), 0)
+
+# Stream tc commands to a long-lived 'tc -batch' process instead of forking tc for each
+TC_BATCH = os.environ.get('TC_BATCH', 'true') in ['1', 'true', 'on']
+
+WATCH_TIMEOUT = int(os.environ.get('WATCH_TIMEOUT', '300'))
+
+# Interval in seconds in which the kernel state is fully observed and drift is repaired
+RESYNC_INTERVAL = float(os.environ.get('RESYNC_INTERVAL', '300'))
+
+# Window in seconds for coalescing bursts of profile and pod events
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', '0.05'))
+
+# Window in seconds after which the resolver recomputes all plans
+RESOLVE_WINDOW = float(os.environ.get('RESOLVE_WINDOW', '1'))
+
+# Namespaces (comma-separated) whose pods are watched by a sidecar. Peers only select pods of these namespaces
+# '*' watches the pods of all namespaces. The agent and the resolver always watch all namespaces
+POD_CACHE_NAMESPACES = os.environ.get('POD_CACHE_NAMESPACES', POD_NAMESPACE or '*')
+
+# Replace the pod IPs of a node by its podCIDR if all pods on it are selected
+# Requires a cluster-wide watch of all nodes and pods
+NODE_CIDR_AGGREGATION = os.environ.get('NODE_CIDR_AGGREGATION') in ['1', 'true', 'on']
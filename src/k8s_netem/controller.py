@@ -1,6 +1,5 @@
 from __future__ import annotations
 from typing import Dict, TYPE_CHECKING
-import itertools
 import logging
 
 from k8s_netem.caller import Caller
@@ -8,8 +7,6 @@ from k8s_netem.caller import Caller
 if TYPE_CHECKING:
     from k8s_netem.profile import Profile
 
-available_mark = itertools.count(1000)
-
 
 class Controller(Caller):
     types: Dict[str, Controller] = {}
@@ -35,11 +32,31 @@ class Controller(Caller):
         except KeyError:
             raise RuntimeError(f'Invalid controller type: {type}')
 
-    @staticmethod
-    def get_mark() -> int:
-        """ Get next available fwmark """
+    def release_unadopted(self):
+        """ Remove the kernel state of a previous run which has not been claimed by any profile """
+
+        pass
+
+    def observe(self):
+        """ Take a snapshot of the kernel state managed by this controller
+
+        The kernel is not changed. Controllers which can not inspect their state return None.
+        """
+
+        return None
+
+    def repair(self, observed):
+        """ Restore the state shared by all profiles if observe() has found it missing
+
+        Called once the nftables changes of a reconciliation have been committed.
+        """
+
+        pass
+
+    def in_sync(self, profile: Profile, observed) -> bool:
+        """ Check if the observed state still contains everything of the profile """
 
-        return next(available_mark)
+        return True
 
     def add_profile(self, profile: Profile):
         if profile.uid not in self.profiles:
@@ -1,11 +1,112 @@
-from typing import Dict, Set
+from typing import Dict, List, Optional, Set, Tuple
+import re
 
 from k8s_netem.controller import Controller
 from k8s_netem.profile import Profile
+from k8s_netem.marks import get_allocator
+from k8s_netem.buffers import BUDGET, LIMIT_MIN, bdp_limit
+from k8s_netem.interface import get_tx_queues
+from k8s_netem.tc import get_backend
+from k8s_netem.config import TC_ROOT, TC_HTB_RATE, TC_MULTIQUEUE, NETEM_PACKET_SIZE
+
+# All fw filters of the HTB qdisc share this prio
+HTB_FILTER_PRIO = 1
+
+# Classes are provisioned in chunks ahead of the profiles
+HTB_CLASSES_CHUNK = 64
+
+# Netem handles are derived from the band (1000+band) and must fit into 16 bits as hexadecimal
+HTB_CLASSES_MAX = 8999
+
+# With the multiqueue layout, the handles of a tree are its major with the band in the lower bits
+MQ_BAND_BITS = 10
+MQ_BANDS_MAX = (1 << MQ_BAND_BITS) - 1
+MQ_QUEUES_MAX = (0xffff >> MQ_BAND_BITS) - 1
+
+
+class Tree:
+    """ A prio or HTB qdisc with the bands of all profiles
+
+    With the single-queue layout, the root qdisc is the only tree. With
+    the multiqueue layout, each TX queue of the mq root has its own tree.
+    """
+
+    def __init__(self, parent: str = 'root', major: int = 1, queue: Optional[int] = None):
+        self.parent = parent
+        self.major = major
+        self.queue = queue
+
+    @classmethod
+    def for_queue(cls, queue: int):
+        return cls(f'1:{queue+1:x}', (queue+1) << MQ_BAND_BITS, queue)
+
+    @property
+    def handle(self) -> str:
+        return f'{self.major:x}:'
+
+    def band_class(self, band: int) -> str:
+        return f'{self.major:x}:{band:x}'
+
+    def netem_handle(self, band: int) -> str:
+        if self.queue is None:
+            return f'{1000+band}:'
+
+        return f'{self.major | band:x}:'
+
+    def shaper_handles(self, band: int) -> Tuple[str, str]:
+        """ Handles of the TBF and fq_codel qdiscs beneath the netem qdisc of a prio band """
+
+        if self.queue is None:
+            return f'{2000+band}:', f'{3000+band}:'
+
+        return f'{self.major | 1 << 8 | band:x}:', f'{self.major | 2 << 8 | band:x}:'
+
+    def netem_band(self, handle: str) -> Optional[int]:
+        """ Inverse of netem_handle() """
+
+        major = handle.rstrip(':')
+
+        if self.queue is None:
+            return int(major) - 1000 if major.isdigit() else None
+
+        major = int(major, 16)
+        if major >> MQ_BAND_BITS != self.major >> MQ_BAND_BITS:
+            return None
+
+        return major & MQ_BANDS_MAX
+
+    def matches(self, qdisc: Dict, kind: str) -> bool:
+        if qdisc.get('kind') != kind or qdisc.get('handle') != self.handle:
+            return False
+
+        if self.parent == 'root':
+            return bool(qdisc.get('root'))
+
+        return qdisc.get('parent') == self.parent
 
 
 class BuiltinController(Controller):
-    """Wrapper around netem module and tc commands."""
+    """Wrapper around netem module and tc commands.
+
+    Each profile gets a band with its own netem qdisc. With the default
+    prio root, a band is a band of the prio qdisc, selected by a fw filter
+    at the prio of the band. The prio qdisc is limited to 16 bands.
+
+    With an HTB root, a band is a class of the HTB qdisc. Marks are mapped
+    to classes by the hashed fw filter of a single prio, so that a single
+    lookup serves any number of profiles.
+
+    Interfaces matched by TC_MULTIQUEUE get an mq root with a copy of
+    the prio or HTB qdisc, its filters and netem qdiscs for each TX queue.
+    The queues no longer share the lock of a single root qdisc.
+
+    The rate of the shaping parameters is enforced by the HTB class of a
+    profile. With a prio root, a TBF with an fq_codel child is attached
+    beneath the netem qdisc instead. In both cases netem only emulates
+    delay and loss. The trees of the TX queues share no level which could
+    be shaped. An interface therefore falls back to the single-queue layout
+    once it carries a profile with a rate.
+    """
 
     type = 'Builtin'
 
@@ -14,21 +115,285 @@ class BuiltinController(Controller):
 
         self.options = options
 
+        # Either the tc command or rtnetlink
+        self.tc = get_backend()
+
+        # Either 'prio' or 'htb'
+        self.root = TC_ROOT
+
+        self.trees = self._layout()
+        self.multiqueue = len(self.trees) > 1
+
         self.prio_bands = 0  # qdisc does not exist yet
-        self.prio_bands_avail: Set[int] = set()
+        self.htb_classes = 0
+
+        # Free bands of the prio qdisc or classes of the HTB qdisc
+        self.bands_avail: Set[int] = set()
+
+        # Mark -> Band of filters left by a previous run
+        self.adoptable: Dict[int, int] = {}
+
+        # Netem qdiscs left by a previous run
+        self.adoptable_qdiscs: Set[str] = set()
+
+        if not self._adopt():
+            if self.root == 'htb':
+                self._setup_htb(initial=True)
+            else:
+                # We initially reserve 8 bands for profiles
+                self._setup_prio(initial=True, bands_extra=8)
+
+    def _layout(self) -> List[Tree]:
+        if TC_MULTIQUEUE is None or re.match(TC_MULTIQUEUE, self.interface) is None:
+            return [Tree()]
+
+        queues = get_tx_queues(self.interface)
+        if queues > MQ_QUEUES_MAX:
+            self.logger.warn('Interface %s has more than %d TX queues. Using a single-queue layout', self.interface, MQ_QUEUES_MAX)
+            return [Tree()]
+
+        if queues < 2:
+            return [Tree()]
+
+        # A previous run has fallen back to the single-queue layout for a shaped profile
+        if any(Tree().matches(q, self.root) for q in self.tc.qdiscs(self.interface)):
+            self.logger.info('Keeping the single-queue layout of %s', self.interface)
+            return [Tree()]
+
+        self.logger.info('Using a multiqueue layout for the %d TX queues of %s', queues, self.interface)
 
-        # We initially reserve 8 bands for profiles
-        self._setup_prio(initial=True, bands_extra=8)
+        return [Tree.for_queue(q) for q in range(queues)]
+
+    @property
+    def bands_max(self) -> int:
+        return MQ_BANDS_MAX if self.multiqueue else HTB_CLASSES_MAX
 
     def deinit(self):
-        self._call(f'tc qdisc delete dev {self.interface} root')
+        self.tc.delete_qdisc(self.interface, 'root')
+
+        for profile in self.profiles.values():
+            BUDGET.release(profile.uid)
 
         self._dump_tc()
 
     def _dump_tc(self):
-        self._call(f'tc qdisc show dev {self.interface}')
-        self._call(f'tc filter show dev {self.interface}')
-        self._call(f'tc -g class show dev {self.interface}')
+        self.tc.dump(self.interface)
+
+    def observe(self):
+        qdiscs = self.tc.qdiscs(self.interface)
+
+        if not self._has_trees(qdiscs):
+            return {
+                'trees': False,
+                'qdiscs': set(),
+                'marks': set()
+            }
+
+        # Marks need a filter in every tree
+        marks: Optional[Set[int]] = None
+        for tree in self.trees:
+            filters = self.tc.filters(self.interface, tree.handle)
+            tree_marks = {int(f['options']['handle'].split('/')[0], 0) for f in filters if f.get('kind') == 'fw' and 'options' in f}
+
+            marks = tree_marks if marks is None else marks & tree_marks
+
+        return {
+            'trees': True,
+            'qdiscs': {q['handle'] for q in qdiscs if q.get('kind') in ['netem', 'tbf']},
+            'marks': marks
+        }
+
+    def repair(self, observed):
+        if observed is None or observed['trees']:
+            return
+
+        self.logger.warn('Root %s qdisc of %s is missing. Recreating it...', self.root, self.interface)
+
+        # All bands are gone together with the root qdisc
+        bands = self.prio_bands
+        classes = self.htb_classes
+        self.prio_bands = 0
+        self.htb_classes = 0
+        self.bands_avail.clear()
+
+        for profile in self.profiles.values():
+            profile.band = -1
+
+        if self.root == 'htb':
+            self._setup_htb(initial=True, classes_extra=classes)
+        else:
+            self._setup_prio(initial=True, bands_extra=bands)
+
+    def in_sync(self, profile: Profile, observed) -> bool:
+        if observed is None or profile.band < 0:
+            return False
+
+        if profile.mark not in observed['marks']:
+            return False
+
+        handles = set()
+        for tree in self.trees:
+            if self._wants_netem(profile):
+                handles.add(tree.netem_handle(profile.band))
+
+            if self.root == 'prio' and self._shaping_rate(profile):
+                handles.add(tree.shaper_handles(profile.band)[0])
+
+        return handles <= observed['qdiscs']
+
+    def _has_trees(self, qdiscs: List[Dict]) -> bool:
+        if self.multiqueue and not any(q.get('kind') == 'mq' and q.get('handle') == '1:' and q.get('root') for q in qdiscs):
+            return False
+
+        return all(any(tree.matches(q, self.root) for q in qdiscs) for tree in self.trees)
+
+    def _filter_prio(self, band: int) -> int:
+        if self.root == 'htb':
+            return HTB_FILTER_PRIO
+
+        return band
+
+    def _locate(self, handle: str) -> Optional[Tuple[Tree, int]]:
+        """ Find the tree and band of a netem qdisc """
+
+        for tree in self.trees:
+            band = tree.netem_band(handle)
+            if band is not None:
+                return tree, band
+
+        return None
+
+    def _adopt(self) -> bool:
+        """ Take over the root qdiscs and their bands from a previous run """
+
+        qdiscs = self.tc.qdiscs(self.interface)
+
+        if not self._has_trees(qdiscs):
+            return False
+
+        if self.root == 'htb':
+            classes = self.tc.classes(self.interface)
+
+            # Only classes which exist in all trees can be used
+            bands: Optional[Set[int]] = None
+            for tree in self.trees:
+                tree_bands = {int(c['handle'].split(':')[1], 16) for c in classes
+                              if c.get('class') == 'htb' and c.get('handle', '').startswith(tree.handle) and c['handle'] != tree.handle}
+
+                bands = tree_bands if bands is None else bands & tree_bands
+
+            if not bands:
+                return False
+
+            self.htb_classes = max(bands)
+
+        else:
+            roots = [q for q in qdiscs for tree in self.trees if tree.matches(q, 'prio')]
+
+            count = min(root.get('options', {}).get('bands', 3) for root in roots)
+            if count <= 3:
+                return False
+
+            self.prio_bands = count - 3
+            bands = set(range(3, count))
+
+        for tree in self.trees:
+            for f in self.tc.filters(self.interface, tree.handle):
+                if f.get('kind') != 'fw' or 'options' not in f:
+                    continue
+
+                mark = int(f['options']['handle'].split('/')[0], 0)
+
+                if self.root == 'htb':
+                    if 'classid' not in f['options']:
+                        continue
+
+                    self.adoptable[mark] = int(f['options']['classid'].split(':')[1], 16)
+                else:
+                    self.adoptable[mark] = f['pref']
+
+        self.adoptable_qdiscs = {q['handle'] for q in qdiscs if q.get('kind') == 'netem' and self._locate(q['handle']) is not None}
+
+        # Bands which are still in use can only be reused once adopted or released
+        held = set(self.adoptable.values()) | {self._locate(h)[1] for h in self.adoptable_qdiscs}
+
+        self.bands_avail = bands - held
+
+        self.logger.info('Adopting %d %s qdiscs with %d bands and %d filters of a previous run',
+                         len(self.trees), self.root, len(bands), len(self.adoptable))
+
+        return True
+
+    def release_unadopted(self):
+        released = set()
+
+        for mark, band in self.adoptable.items():
+            self.logger.info('Removing stale tc filter of band %d', band)
+
+            for tree in self.trees:
+                self.tc.delete_fw_filter(self.interface, self._filter_prio(band), mark, get_allocator().mask, tree.handle)
+
+            released.add(band)
+
+        for handle in self.adoptable_qdiscs:
+            tree, band = self._locate(handle)
+
+            self.logger.info('Removing stale netem qdisc of band %d', band)
+
+            self.tc.delete_qdisc(self.interface, tree.band_class(band), handle)
+
+            released.add(band)
+
+        # Classes keep the rate of a profile of the previous run
+        if self.root == 'htb':
+            for band in released:
+                for tree in self.trees:
+                    self.tc.htb_classes('change', self.interface, [band], TC_HTB_RATE, tree.handle)
+
+        self.bands_avail |= released
+
+        self.adoptable = {}
+        self.adoptable_qdiscs = set()
+
+    def _use_single_queue(self):
+        """ Move all profiles from the multiqueue to the single-queue layout
+
+        A flow only uses a single TX queue. Shaping each tree at the full
+        rate would let a profile send the rate times the number of queues.
+        """
+
+        self.logger.warn('Shaping needs a single root qdisc. Falling back to the single-queue layout for %s', self.interface)
+
+        installed = [p for p in self.profiles.values() if p.band >= 0]
+
+        self.trees = [Tree()]
+        self.multiqueue = False
+
+        # All bands are replaced together with the mq root
+        bands = self.prio_bands
+        classes = self.htb_classes
+        self.prio_bands = 0
+        self.htb_classes = 0
+        self.bands_avail.clear()
+        self.adoptable = {}
+        self.adoptable_qdiscs = set()
+
+        for profile in self.profiles.values():
+            profile.band = -1
+
+        if self.root == 'htb':
+            self._setup_htb(initial=True, classes_extra=max(classes, HTB_CLASSES_CHUNK))
+        else:
+            self._setup_prio(initial=True, bands_extra=max(bands, 8))
+
+        for profile in installed:
+            self._add_profile(profile)
+
+    def _setup_root(self):
+        self.tc.delete_qdisc(self.interface, 'root')
+
+        if self.multiqueue:
+            self.tc.mq('add', self.interface)
 
     def _setup_prio(self, initial=False, bands_extra=1):
         if initial:
@@ -39,125 +404,180 @@ class BuiltinController(Controller):
         self.prio_bands += bands_extra
 
         if initial:
-            self.logger.info(f'Performing initial setup of prio qdisc with {self.prio_bands+3} bands')
+            self.logger.info(f'Performing initial setup of {len(self.trees)} prio qdiscs with {self.prio_bands+3} bands')
 
-            self._call(f'tc qdisc delete dev {self.interface} root')
+            self._setup_root()
 
         else:
-            self.logger.info(f'Performing update of prio qdisc with {self.prio_bands+3} bands')
+            self.logger.info(f'Performing update of {len(self.trees)} prio qdiscs with {self.prio_bands+3} bands')
 
-        self._check_call(f'tc qdisc {operation} dev {self.interface} root handle 1: prio bands {self.prio_bands+3}')
+        for tree in self.trees:
+            self.tc.prio(operation, self.interface, self.prio_bands+3, tree.parent, tree.handle)
 
-        self.prio_bands_avail.update(range(3, 3+self.prio_bands))
+        self.bands_avail.update(range(3, 3+self.prio_bands))
 
         self._dump_tc()
 
-    # pylint: disable=too-many-arguments
-    def _update_qdisc_netem(self,
-                            parent: str,
-                            handle: str,
-                            operation: str = 'add',  # or 'change'
-                            loss_ratio: float = 0,
-                            loss_correlation: int = 0,
-                            duplication_ratio: int = 0,
-                            duplication_correlation: int = 0,
-                            delay: float = 0,
-                            jitter: float = 0,
-                            delay_jitter_correlation: int = 0,
-                            reorder_ratio: int = 0,
-                            reorder_correlation: int = 0,
-                            reorder_gap: int = 0,
-                            distribution: str = 'normal',
-                            limit: int = 0,
-                            rate: int = 0,
-                            rate_packetoverhead: int = 0,
-                            rate_cellsize: int = 0,
-                            rate_celloverhead: int = 0,
-                            slot_min_delay: float = 0,
-                            slot_max_delay: float = 0,
-                            slot_distribution: str = 'normal',
-                            slot_delay: float = 0,
-                            slot_jitter: float = 0,
-                            slot_packets: int = 0,
-                            slot_bytes: int = 0):
-        """Enable packet loss."""
+    def _setup_htb(self, initial=False, classes_extra=HTB_CLASSES_CHUNK):
+        first = self.htb_classes + 1
+        last = min(self.htb_classes + classes_extra, self.bands_max)
+        if last < first:
+            raise RuntimeError(f'All {self.bands_max} classes of the HTB qdisc of {self.interface} are in use')
+
+        if initial:
+            self.logger.info('Performing initial setup of %d HTB qdiscs with %d classes', len(self.trees), last)
+
+            self._setup_root()
+
+            for tree in self.trees:
+                self.tc.htb('add', self.interface, tree.parent, tree.handle)
+
+        else:
+            self.logger.info('Adding classes %d to %d to %d HTB qdiscs', first, last, len(self.trees))
+
+        # Classes are unshaped until a profile claims them
+        for tree in self.trees:
+            self.tc.htb_classes('add', self.interface, range(first, last+1), TC_HTB_RATE, tree.handle)
+
+        self.htb_classes = last
+        self.bands_avail.update(range(first, last+1))
+
+        self._dump_tc()
+
+    def _wants_netem(self, profile: Profile) -> bool:
+        """ The TBF of a prio band is attached beneath a netem qdisc, even without netem parameters """
+
+        if profile.parameters.get('netem'):
+            return True
+
+        return self.root == 'prio' and self._shaping_rate(profile) is not None
+
+    def _shaping_rate(self, profile: Profile) -> Optional[str]:
+        rate = profile.parameters.get('shaping', {}).get('rate', 0)
+        if rate == 0:
+            return None
+
+        return f'{rate}kbit'
+
+    def _netem_parameters(self, profile: Profile) -> Optional[Dict]:
+        """ Complete the netem parameters of a profile by a limit within the buffer caps """
 
+        if not self._wants_netem(profile):
+            BUDGET.release(profile.uid)
+            return None
+
+        parameters = dict(profile.parameters.get('netem', {}))
+
+        limit = parameters.get('limit', 0)
         if limit == 0:
-            limit = 20000
-
-        cmd = f'tc qdisc {operation} dev {self.interface} parent {parent} handle {handle} netem limit {limit}'
-
-        if loss_ratio > 0:
-            cmd += f' loss random {int(loss_ratio*1e2)}%'
-            if loss_correlation > 0:
-                cmd += f' {int(loss_correlation*1e2)}%'
-
-        if duplication_ratio > 0:
-            cmd += f' duplicate {int(duplication_ratio*1e2)}%'
-            if duplication_correlation > 0:
-                cmd += f' {int(duplication_correlation*1e2)}%'
-
-        if delay > 0:
-            cmd += f' delay {int(delay*1e3)}ms'
-            if jitter > 0:
-                cmd += f' {int(jitter*1e3)}ms'
-                if delay_jitter_correlation:
-                    cmd += f' {int(delay_jitter_correlation*1e2)}%'
-
-            if distribution != 'normal':
-                cmd += f' distribution {distribution}'
-
-            if reorder_ratio > 0:
-                cmd += f' reorder {int(reorder_ratio*1e2)}%'
-                if reorder_correlation > 0:
-                    cmd += f' {int(reorder_correlation*1e2)}%'
-                if reorder_gap > 0:
-                    cmd += f' gap {reorder_gap}'
-
-        if rate > 0:
-            cmd += f' rate {rate}kbit'
-            if rate_packetoverhead != 0:
-                cmd += f' {rate_packetoverhead}'
-                if rate_cellsize > 0:
-                    cmd += f' {rate_cellsize}'
-                    if rate_celloverhead > 0:
-                        cmd += f' {rate_celloverhead}'
-
-        if slot_min_delay > 0 or (slot_delay > 0 and slot_jitter > 0):
-            cmd += ' slot'
-            if slot_min_delay > 0:
-                cmd += f' {int(slot_min_delay*1e3)}ms'
-                if slot_max_delay:
-                    cmd += f' {int(slot_max_delay*1e3)}ms'
-            else:
-                cmd += f' distribution {slot_distribution} {int(slot_delay*1e3)}ms {int(slot_jitter*1e3)}ms'
+            # The shaper drains the netem queue at its rate
+            rate = parameters.get('rate', 0) or profile.parameters.get('shaping', {}).get('rate', 0)
+            rate = rate * 1e3 or None
+            limit = bdp_limit(parameters.get('delay', 0), parameters.get('jitter', 0), rate)
+
+        # Each TX queue has its own netem qdisc. A single flow might use
+        # only one of them, so each is sized for the whole product.
+        queues = len(self.trees)
+
+        wanted = limit * queues * NETEM_PACKET_SIZE
+        granted = BUDGET.reserve(profile.uid, wanted, min(limit, LIMIT_MIN) * queues * NETEM_PACKET_SIZE)
+        if granted < wanted:
+            limit = granted // (queues * NETEM_PACKET_SIZE)
+
+            self.logger.warn('Capped netem limit of profile %s to %d packets per queue to stay within the buffer caps', profile, limit)
 
-            if slot_packets > 0:
-                cmd += ' packets {slot_packets}'
+        parameters['limit'] = limit
 
-            if slot_bytes > 0:
-                cmd += ' bytes {slot_bytes}'
+        pod, node = BUDGET.usage()
+        self.logger.info('netem queues of profile %s hold up to %d packets (%.1f MiB). Pod total: %.1f MiB, node total: %.1f MiB',
+                         profile, limit * queues, granted / 2**20, pod / 2**20, node / 2**20)
 
-        self._check_call(cmd)
+        return parameters
+
+    def _update_qdisc_netem(self, parent: str, handle: str, operation: str = 'add', **parameters):
+        """Enable packet loss."""
+
+        self.tc.netem(operation, self.interface, parent, handle, parameters)
 
         return handle
 
+    def _update_shaping(self, profile: Profile, tree: Tree, stale: bool = True):
+        """ Shape the traffic of a profile by its HTB class or a TBF beneath its netem qdisc
+
+        Without stale, the band is known to have no shaper yet.
+        """
+
+        rate = self._shaping_rate(profile)
+        if rate is None and not stale:
+            return
+
+        burst = profile.parameters.get('shaping', {}).get('burst', 0) or None
+
+        if self.root == 'htb':
+            self.tc.htb_classes('change', self.interface, [profile.band], rate or TC_HTB_RATE, tree.handle, burst)
+            return
+
+        tbf, fq_codel = tree.shaper_handles(profile.band)
+        parent = tree.netem_handle(profile.band) + '1'
+
+        # fq_codel is removed together with its parent
+        if rate is None:
+            self.tc.delete_qdisc(self.interface, parent, tbf)
+            return
+
+        self.tc.tbf('replace', self.interface, parent, tbf, rate, burst)
+        self.tc.fq_codel('replace', self.interface, tbf + '1', fq_codel)
+
     def _add_profile(self, profile: Profile):
-        profile.band = self.prio_bands_avail.pop()
+        band = self.adoptable.pop(profile.mark, None)
+        if band is not None:
+            self._adopt_profile(profile, band)
+            return
 
-        self.logger.info('Assigned prio qdisc band %d to profile %s', profile.band, profile)
+        profile.band = self.bands_avail.pop()
 
-        handle = f'{1000+profile.band}:'
-        parent = f'1:{profile.band}'
+        self.logger.info('Assigned %s qdisc band %d to profile %s', self.root, profile.band, profile)
 
-        self._check_call(f'tc filter add dev {self.interface} prio {profile.band} handle {profile.mark} fw flowid {parent}')
+        netem_parameters = self._netem_parameters(profile)
 
-        netem_parameters = profile.parameters.get('netem')
-        if netem_parameters:
-            parent = self._update_qdisc_netem(parent=parent,
-                                              handle=handle,
-                                              operation='add',
-                                              **netem_parameters)
+        for tree in self.trees:
+            parent = tree.band_class(profile.band)
+
+            # Only the bits of the mask are compared
+            self.tc.add_fw_filter(self.interface, self._filter_prio(profile.band), profile.mark, get_allocator().mask, parent, tree.handle)
+
+            if netem_parameters is not None:
+                self._update_qdisc_netem(parent=parent,
+                                         handle=tree.netem_handle(profile.band),
+                                         operation='add',
+                                         **netem_parameters)
+
+            self._update_shaping(profile, tree, stale=False)
+
+    def _adopt_profile(self, profile: Profile, band: int):
+        """ Reuse the filter and netem qdisc of a previous run """
+
+        profile.band = band
+
+        self.logger.info('Adopted %s qdisc band %d for profile %s', self.root, band, profile)
+
+        netem_parameters = self._netem_parameters(profile)
+
+        for tree in self.trees:
+            handle = tree.netem_handle(band)
+            operation = 'change' if handle in self.adoptable_qdiscs else 'add'
+            self.adoptable_qdiscs.discard(handle)
+
+            if netem_parameters is not None:
+                self._update_qdisc_netem(parent=tree.band_class(band),
+                                         handle=handle,
+                                         operation=operation,
+                                         **netem_parameters)
+            elif operation == 'change':
+                self.tc.delete_qdisc(self.interface, tree.band_class(band), handle)
+
+            # A shaper of the previous run might be stale
+            self._update_shaping(profile, tree, stale=self.root == 'htb' or operation == 'change')
 
     def _remove_profile(self, profile: Profile):
         if profile.band < 0:
@@ -166,29 +586,54 @@ class BuiltinController(Controller):
 
         self.logger.info('Removing tc filter and netem qdiscs for profile %s', profile)
 
-        handle = f'{1000+profile.band}:'
-        parent = f'1:{profile.band}'
+        # The objects might have already vanished from the kernel
+        for tree in self.trees:
+            self.tc.delete_fw_filter(self.interface, self._filter_prio(profile.band), profile.mark, get_allocator().mask, tree.handle)
+            self.tc.delete_qdisc(self.interface, tree.band_class(profile.band), tree.netem_handle(profile.band))
 
-        self._check_call(f'tc filter delete dev {self.interface} parent 1: prio {profile.band} handle {profile.mark} fw')
-        self._check_call(f'tc qdisc delete dev {self.interface} parent {parent} handle {handle}')
+            # The class is reused by other profiles
+            if self.root == 'htb' and self._shaping_rate(profile):
+                self.tc.htb_classes('change', self.interface, [profile.band], TC_HTB_RATE, tree.handle)
 
         self._dump_tc()
 
-        self.prio_bands_avail.add(profile.band)
+        BUDGET.release(profile.uid)
+
+        self.bands_avail.add(profile.band)
         profile.band = -1
 
     def _update_profile(self, profile: Profile):
-        netem_parameters = profile.parameters.get('netem')
-        if netem_parameters:
-            self._update_qdisc_netem(parent=f'1:{profile.band}',
-                                     handle=f'{1000+profile.band}:',
-                                     operation='change',
-                                     **netem_parameters)
+        # Other parameters do not affect the netem qdisc or shaper
+        if not any(path[:1] in [('netem',), ('shaping',)] for path in profile.changes):
+            self.logger.info('netem and shaping parameters of profile %s have not changed', profile)
+            return
+
+        shaping = any(path[:1] == ('shaping',) for path in profile.changes)
+
+        # The limit depends on the shaping rate, and a TBF might need a new netem qdisc
+        netem_parameters = self._netem_parameters(profile)
+        for tree in self.trees:
+            if netem_parameters is not None:
+                self._update_qdisc_netem(parent=tree.band_class(profile.band),
+                                         handle=tree.netem_handle(profile.band),
+                                         operation='replace',
+                                         **netem_parameters)
+
+            if shaping:
+                self._update_shaping(profile, tree)
 
     def add_profile(self, profile: Profile):
         super().add_profile(profile)
 
-        if len(self.prio_bands_avail) == 0:
+        if self.multiqueue and self._shaping_rate(profile) is not None:
+            self._use_single_queue()
+
+        if len(self.bands_avail) == 0 and self.root == 'htb':
+            self.logger.info('No more classes in HTB qdisc available. Provisioning more...')
+
+            self._setup_htb()
+
+        elif len(self.bands_avail) == 0:
             self.logger.info('No more bands in prio qdisc available. Requesting more...')
 
             # There are no more bands in the prio qdisc available
@@ -201,6 +646,13 @@ class BuiltinController(Controller):
     def update_profile(self, profile: Profile):
         super().update_profile(profile)
 
+        if self.multiqueue and self._shaping_rate(profile) is not None:
+            self._use_single_queue()
+
+            # Profiles with a band have been added again with their current parameters
+            if profile.band >= 0:
+                return
+
         if profile.band < 0:
             self.logger.info('Adding netem qdisc for profile %s as it hasnt been added yet', profile)
             self._add_profile(profile)
@@ -83,6 +83,8 @@ class FlexeController(Controller):
 
         self.logger.info('Sent initial message to Flexe server')
 
+        self.running = True
+
         self.main_thread_id = threading.Thread(target=self.main_thread)
         self.main_thread_id.daemon = True
         self.main_thread_id.start()
@@ -110,7 +112,7 @@ class FlexeController(Controller):
         self.opened = 1
 
     def main_thread(self):
-        while True:
+        while self.running:
             try:
                 msg = self.queue.get(timeout=1)
 
@@ -135,11 +137,13 @@ class FlexeController(Controller):
     def deinit(self):
         self.logger.info('deinit')
 
-        if self.ws_thread_id.is_alive():
-            self.ws_thread_id.join(0.0)
+        # The sender thread notices within its queue timeout
+        self.running = False
+        self.main_thread_id.join(2.0)
 
-        if self.main_thread_id.is_alive():
-            self.main_thread_id.join(0.0)
+        # Closing the socket returns from run_forever()
+        self.ws.close()
+        self.ws_thread_id.join(2.0)
 
     def add_profile(self, profile: Profile):
         self.logger.info('Add profile: %s', profile)
@@ -286,6 +290,10 @@ class FlexeController(Controller):
             # Flexe NetEm removes all profiles, if dictionary does not include 'profiles' key
             del run_msg['profiles']
 
+        # The filter only depends on the mark, which is kept by updates
+        elif mode == "update" and self.filterid > 0:
+            send_filters = False
+
         # Handle the filter message part here
         if send_filters:
             filter_msg = {}
@@ -1,11 +1,13 @@
 from __future__ import annotations
-from typing import Dict, TYPE_CHECKING
+from typing import Dict, Hashable, Set, TYPE_CHECKING
 
 import logging
 
 from k8s_netem.resource import Resource
 from k8s_netem.rule import Rule
-from k8s_netem.nftables import nft
+from k8s_netem.nftables import NftBatch
+from k8s_netem.classifier import get_classifiers
+from k8s_netem.config import NFT_COMPILED
 
 if TYPE_CHECKING:
     from k8s_netem.profile import Profile
@@ -25,23 +27,93 @@ class Direction(Resource):
 
         self.chain_name = self.direction
 
-        self.rules = {Rule(self, i, r) for i, r in enumerate(self.spec)}
+        # All profiles share the classifier in the compiled nftables mode
+        self.classifier = get_classifiers().get(dir) if NFT_COMPILED else None
 
-    def init(self):
+        # Only the egress classifier exists so far. Without the check, rules
+        # would end up in a plain chain of the table shared by all profiles.
+        if NFT_COMPILED and self.classifier is None:
+            raise RuntimeError(f'{dir.capitalize()} rules are not supported in the compiled nftables mode')
+
+        # Key -> Rule
+        self.rules: Dict[Hashable, Rule] = {}
+        for i, r in enumerate(self.spec):
+            rule = Rule(self, i, r)
+            self.rules[rule.key] = rule
+
+    def init(self, batch: NftBatch):
         self.logger.info('Initializing %s direction of profile %s', self.direction, self.profile)
 
-        self.init_nftables()
+        self.init_nftables(batch)
+
+        for rule in self.rules.values():
+            rule.init(batch)
+
+    def adopt(self, batch: NftBatch, table: Dict):
+        """ Take over the rules of a previous run from the inventory of our table
+
+        Rules are mapped back by their index which is part of their comment.
+        Remaining rules and their sets are removed.
+        """
+
+        self.logger.info('Adopting %s direction of profile %s', self.direction, self.profile)
+
+        self.init_nftables(batch)
+
+        # Comment -> Handle
+        existing = {comment: handle for (chain, comment), handle in table['handles'].items() if chain == self.chain_name}
+
+        for rule in self.rules.values():
+            prefix = f'{self.direction}-{rule.index}-'
+
+            name = next((c for c in existing if c.startswith(prefix)), None)
+            if name is not None:
+                del existing[name]
+                rule.adopt(batch, name)
+            else:
+                rule.init(batch)
+
+        for comment, handle in existing.items():
+            self.logger.info('Removing stale rule %s', comment)
+
+            batch.add(self.cmd_delete_stale_rule(handle, comment, table['sets']))
+
+    def cmd_delete_stale_rule(self, handle: int, comment: str, sets: Set[str]):
+        cmds = [
+          {
+            'delete': {
+              'rule': {
+                **self.profile.table,
+                'chain': self.chain_name,
+                'handle': handle
+              }
+            }
+          }
+        ]
+
+        for suffix in ['nets', 'ports', 'ether-types', 'inet-protos']:
+            name = f'{comment}-{suffix}'
+            if name not in sets:
+                continue
+
+            cmds.append({
+              'delete': {
+                'set': {
+                  **self.profile.table,
+                  'name': name
+                }
+              }
+            })
 
-        for rule in self.rules:
-            rule.init()
+        return cmds
 
-    def deinit(self):
+    def deinit(self, batch: NftBatch):
         self.logger.info('Deinitializing %s direction of profile %s', self.direction, self.profile)
 
-        for rule in self.rules:
-            rule.deinit()
+        for rule in self.rules.values():
+            rule.deinit(batch)
 
-        self.deinit_nftables()
+        self.deinit_nftables(batch)
 
     def cmd_create_chain(self):
         hook = 'input' if self.direction == 'ingress' else 'output'
@@ -72,34 +144,57 @@ class Direction(Resource):
           }
         ]
 
-    def init_nftables(self):
+    def init_nftables(self, batch: NftBatch):
+        if self.classifier is not None:
+            return
+
         cmds = []
 
         cmds += self.cmd_create_chain()
 
-        nft(cmds)
+        batch.add(cmds)
+
+    def deinit_nftables(self, batch: NftBatch):
+        if self.classifier is not None:
+            return
 
-    def deinit_nftables(self):
         cmds = []
 
         cmds += self.cmd_delete_chain()
 
-        nft(cmds)
+        batch.add(cmds)
 
-    def update(self, new_direction: Direction):
+    def update(self, new_direction: Direction, batch: NftBatch):
         self.logger.info('Updating direction %s', self)
 
-        # Added rules
-        for rule in new_direction.rules - self.rules:
-            self.logger.info('Adding rule: %s', rule)
+        rules = {}
 
-            rule.direction = self
-            rule.init()
-            self.rules.add(rule)
+        for key, new_rule in new_direction.rules.items():
+            rule = self.rules.get(key)
+
+            # Added rules
+            if rule is None:
+                self.logger.info('Adding rule: %s', new_rule.name)
+
+                new_rule.direction = self
+                new_rule.init(batch)
+
+                rule = new_rule
+
+            # Modified rules are patched in-place
+            elif rule != new_rule:
+                rule.update(new_rule, batch)
+
+            rules[key] = rule
 
         # Removed rules
-        for rule in self.rules - new_direction.rules:
-            self.logger.info('Removing rule: %s', rule)
+        for key in self.rules.keys() - new_direction.rules.keys():
+            rule = self.rules[key]
+
+            self.logger.info('Removing rule: %s', rule.name)
+
+            rule.deinit(batch)
+
+        self.rules = rules
 
-            rule.deinit()
-            self.rules.remove(rule)
+        self.spec = new_direction.spec
@@ -0,0 +1,196 @@
+from __future__ import annotations
+from typing import Dict, Iterator, List
+
+import logging
+import threading
+
+import urllib3
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from kubernetes.watch.watch import iter_resp_lines
+
+from k8s_netem.config import WATCH_TIMEOUT
+
+HTTP_GONE = 410
+
+RETRY_DELAY_MIN = 1
+RETRY_DELAY_MAX = 60
+
+
+class ExpiredError(RuntimeError):
+    """ The resourceVersion we tried to resume from has been compacted """
+
+
+def object_metadata(obj) -> Dict:
+    if isinstance(obj, dict):
+        meta = obj.get('metadata', {})
+
+        return {
+            'uid': meta.get('uid'),
+            'resource_version': meta.get('resourceVersion')
+        }
+    else:
+        return {
+            'uid': obj.metadata.uid,
+            'resource_version': obj.metadata.resource_version
+        }
+
+
+class Informer:
+    """ List and watch a collection of Kubernetes objects
+
+    A local store of all objects keyed by their uid is kept up to date.
+    Watches are resumed from the last seen resourceVersion and request
+    bookmarks so that the resourceVersion advances even if no objects change.
+    A full relist is only performed if the API server answers with 410 Gone.
+    The result of the relist is diffed against the store and returned as
+    synthetic ADDED, MODIFIED and DELETED events.
+    """
+
+    def __init__(self, name: str, func, *args, **kwargs):
+        self.logger = logging.getLogger(f'informer:{name}')
+
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+        self.store: Dict[str, object] = {}
+        self.resource_version: str = None
+
+        # Only used for decoding events
+        self.decoder = watch.Watch()
+        self.return_type = self.decoder.get_return_type(func)
+
+        self.stopped = threading.Event()
+        self.response = None
+
+    def convert(self, event: Dict) -> Dict:
+        """ Hook for subclasses to augment events before they are passed on """
+
+        return event
+
+    def list(self) -> List[Dict]:
+        """ (Re-)list all objects and return the difference to the store as events """
+
+        ret = self.func(*self.args, **self.kwargs)
+
+        if isinstance(ret, dict):
+            items = ret.get('items', [])
+            resource_version = ret['metadata']['resourceVersion']
+        else:
+            items = ret.items
+            resource_version = ret.metadata.resource_version
+
+        self.logger.info('Listed %d objects at resourceVersion %s', len(items), resource_version)
+
+        events = []
+        seen = set()
+
+        for obj in items:
+            meta = object_metadata(obj)
+            uid = meta['uid']
+
+            old_obj = self.store.get(uid)
+            if old_obj is None:
+                events.append({'type': 'ADDED', 'object': obj})
+            elif object_metadata(old_obj)['resource_version'] != meta['resource_version']:
+                events.append({'type': 'MODIFIED', 'object': obj})
+
+            self.store[uid] = obj
+            seen.add(uid)
+
+        for uid in set(self.store) - seen:
+            events.append({'type': 'DELETED', 'object': self.store.pop(uid)})
+
+        self.resource_version = resource_version
+
+        return [self.convert(event) for event in events]
+
+    def stream(self) -> Iterator[Dict]:
+        """ Watch for changes starting at the last seen resourceVersion """
+
+        kwargs = {
+            **self.kwargs,
+            'watch': True,
+            'allow_watch_bookmarks': True,
+            'resource_version': self.resource_version,
+            'timeout_seconds': WATCH_TIMEOUT,
+            '_preload_content': False
+        }
+
+        try:
+            self.response = self.func(*self.args, **kwargs)
+        except ApiException as e:
+            if e.status == HTTP_GONE:
+                raise ExpiredError(e.reason)
+            raise
+
+        try:
+            for line in iter_resp_lines(self.response):
+                event = self.decoder.unmarshal_event(line, self.return_type)
+                if event is None:
+                    continue
+
+                type = event['type']
+                raw = event['raw_object']
+
+                if type == 'ERROR':
+                    if raw.get('code') == HTTP_GONE:
+                        raise ExpiredError(raw.get('message'))
+
+                    raise ApiException(status=raw.get('code'),
+                                       reason=f'{raw.get("reason")}: {raw.get("message")}')
+
+                self.resource_version = raw['metadata']['resourceVersion']
+
+                if type == 'BOOKMARK':
+                    self.logger.debug('Bookmark at resourceVersion %s', self.resource_version)
+                    continue
+
+                uid = raw['metadata']['uid']
+                if type == 'DELETED':
+                    self.store.pop(uid, None)
+                else:
+                    self.store[uid] = event['object']
+
+                yield self.convert(event)
+
+        finally:
+            self.response.close()
+            self.response.release_conn()
+            self.response = None
+
+    def watch(self) -> Iterator[Dict]:
+        """ Yield events until stopped, transparently resuming and relisting """
+
+        delay = RETRY_DELAY_MIN
+        expired = self.resource_version is None
+
+        while not self.stopped.is_set():
+            try:
+                if expired:
+                    yield from self.list()
+                    expired = False
+
+                yield from self.stream()
+
+                delay = RETRY_DELAY_MIN
+
+            except ExpiredError as e:
+                self.logger.info('Resource version %s is too old (%s). Relisting...', self.resource_version, e)
+                expired = True
+
+            except (ApiException, urllib3.exceptions.HTTPError, OSError) as e:
+                if self.stopped.is_set():
+                    break
+
+                self.logger.warning('Watch failed: %s. Resuming in %d seconds', e, delay)
+
+                self.stopped.wait(delay)
+                delay = min(delay * 2, RETRY_DELAY_MAX)
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.response is not None:
+            self.response.close()
@@ -1,11 +1,15 @@
-import os
+import json
 import re
+import socket
+import subprocess
 
 
 def get_default_route_interface():
     """Read the default gateway directly from /proc."""
 
-    with open('/proc/net/route') as fh:
+    # /proc/net refers to the network namespace of the process
+    # rather than the one the calling thread might have entered
+    with open('/proc/thread-self/net/route') as fh:
         for line in fh:
             fields = line.strip().split()
             if fields[1] == '00000000' and fields[7] == '00000000':
@@ -17,7 +21,8 @@ def get_default_route_interface():
 def get_interfaces(filter: str = None):
     """ Find suitable interface """
 
-    intfs = os.listdir('/sys/class/net')
+    # Unlike /sys/class/net, this respects the network namespace of the calling thread
+    intfs = [name for _, name in socket.if_nameindex()]
     intfs.sort()
 
     if filter is None:
@@ -29,5 +34,16 @@ def get_interfaces(filter: str = None):
 
 
 def get_interface_index(intf: str) -> int:
-    with open(f'/sys/class/net/{intf}/ifindex') as f:
-        return int(f.read())
+    if intf is None:
+        return None
+
+    return socket.if_nametoindex(intf)
+
+
+def get_tx_queues(intf: str) -> int:
+    """ Get the number of TX queues of an interface """
+
+    # Also respects the network namespace of the calling thread
+    links = json.loads(subprocess.check_output(['ip', '-d', '-j', 'link', 'show', 'dev', intf], text=True))
+
+    return links[0].get('num_tx_queues', 1)
@@ -0,0 +1,176 @@
+from __future__ import annotations
+from typing import Dict, List, Optional
+
+import hashlib
+import logging
+import threading
+
+from k8s_netem.config import NETEM_MARK_MASK, NFT_CONNTRACK
+from k8s_netem import netns
+
+LOGGER = logging.getLogger('marks')
+
+# The upper bits of the conntrack mark hold the generation
+# of the classifier which has classified the connection
+CT_GENERATION_SHIFT = 24
+CT_GENERATION_MASK = 0xff << CT_GENERATION_SHIFT
+CT_GENERATIONS = 0xff
+CT_MARK_MASK = (1 << CT_GENERATION_SHIFT) - 1
+
+
+def effective_mask() -> int:
+    mask = NETEM_MARK_MASK & 0xffffffff
+
+    # The upper bits of the conntrack mark hold the generation of the classifier
+    if NFT_CONNTRACK and mask & CT_GENERATION_MASK:
+        LOGGER.warn('NETEM_MARK_MASK 0x%08x overlaps with the conntrack generation. Using 0x%08x instead',
+                    mask, mask & CT_MARK_MASK)
+        mask &= CT_MARK_MASK
+
+    if mask == 0:
+        raise RuntimeError('NETEM_MARK_MASK leaves no bits for marks')
+
+    return mask
+
+
+class MarkAllocator:
+    """ Allocate fwmarks within the bits of a mask
+
+    Only the bits of the mask are used, so that the mark space can be
+    shared with CNIs which use the remaining bits. The preferred mark of a
+    profile is derived from its uid. A restarted sidecar therefore usually
+    ends up with the same marks and can adopt the existing kernel state.
+    Colliding profiles are assigned a released mark from the free list
+    or the next unused one. A profile owns at most a single mark.
+
+    The number of marks is limited by the bits of the mask, e.g. to 255
+    profiles with the default mask of 0xff.
+    """
+
+    def __init__(self, mask: int):
+        self.mask = mask
+
+        # Positions of the bits of the mask, lowest first
+        self.bits: List[int] = [i for i in range(32) if mask & (1 << i)]
+
+        # The zero mark is never allocated
+        self.size = (1 << len(self.bits)) - 1
+
+        self.lock = threading.Lock()
+
+        # Mark -> Uid
+        self.used: Dict[int, str] = {}
+
+        # Released marks which may be reused
+        self.free: List[int] = []
+
+    def deposit(self, n: int) -> int:
+        """ Spread the bits of n over the bits of the mask """
+
+        mark = 0
+        for i, bit in enumerate(self.bits):
+            if n & (1 << i):
+                mark |= 1 << bit
+
+        return mark
+
+    def preferred(self, uid: str) -> int:
+        digest = int(hashlib.sha1(uid.encode()).hexdigest(), 16)
+
+        return self.deposit(digest % self.size + 1)
+
+    def allocate(self, uid: str) -> int:
+        with self.lock:
+            for mark, owner in self.used.items():
+                if owner == uid:
+                    return mark
+
+            return self._allocate(uid)
+
+    def _allocate(self, uid: str) -> int:
+        mark = self.preferred(uid)
+        if mark in self.used:
+            mark = self._next_free(mark)
+
+        self.used[mark] = uid
+
+        return mark
+
+    def _next_free(self, mark: int) -> int:
+        while len(self.free) > 0:
+            candidate = self.free.pop()
+            if candidate not in self.used:
+                return candidate
+
+        if len(self.used) >= self.size:
+            raise RuntimeError(f'All {self.size} marks of mask 0x{self.mask:08x} are in use')
+
+        n = self.compact(mark)
+        while self.deposit(n) in self.used:
+            n = n % self.size + 1
+
+        return self.deposit(n)
+
+    def compact(self, mark: int) -> int:
+        """ Inverse of deposit() """
+
+        n = 0
+        for i, bit in enumerate(self.bits):
+            if mark & (1 << bit):
+                n |= 1 << i
+
+        return n
+
+    def reserve(self, uid: str, mark: int) -> int:
+        """ Claim a mark which has been assigned elsewhere, e.g. by the resolver or a previous run
+
+        A previous mark of the profile is released. If the mark is already
+        used by another profile, a new one is allocated instead.
+        Returns the mark of the profile.
+        """
+
+        if mark & ~self.mask:
+            LOGGER.warn('Mark 0x%x of profile %s is outside of the mask 0x%08x', mark, uid, self.mask)
+
+        with self.lock:
+            for old_mark, owner in list(self.used.items()):
+                if owner == uid and old_mark != mark:
+                    del self.used[old_mark]
+                    self.free.append(old_mark)
+
+            owner = self.used.get(mark)
+            if owner is not None and owner != uid:
+                LOGGER.warn('Mark 0x%x of profile %s is already used by profile %s. Allocating another one', mark, uid, owner)
+
+                return self._allocate(uid)
+
+            self.used[mark] = uid
+
+            return mark
+
+    def release(self, mark: int):
+        with self.lock:
+            if self.used.pop(mark, None) is not None:
+                self.free.append(mark)
+
+    def owner(self, mark: int) -> Optional[str]:
+        return self.used.get(mark)
+
+
+_allocators: Dict[Optional[int], MarkAllocator] = {}
+
+
+def get_allocator() -> MarkAllocator:
+    """ Get the mark allocator of the network namespace of the calling thread """
+
+    key = netns.current().key
+
+    allocator = _allocators.get(key)
+    if allocator is None:
+        allocator = _allocators.setdefault(key, MarkAllocator(effective_mask()))
+
+    return allocator
+
+
+def forget(ns: netns.NetNS):
+    _allocators.pop(ns.key, None)
@@ -1,40 +1,92 @@
 from __future__ import annotations
-from typing import Union, Dict
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Optional, Set, Tuple, Union
+
+import functools
+import json
+import threading
 
-from kubernetes import client
 from kubernetes.client.models import V1LabelSelector
 
+from k8s_netem.resource import digest_dict
+
+
+# Requirements which reject most labels are evaluated first
+OPERATORS = ['In', 'Exists', 'NotIn', 'DoesNotExist']
+
+Requirement = Tuple[str, str, FrozenSet[str]]
+
+
+def canonical_selector(o: Union[Dict, V1LabelSelector, None]) -> Dict:
+    """ Normalize a label selector into a plain dict """
+
+    if o is None:
+        return {}
+
+    if isinstance(o, V1LabelSelector):
+        return {
+            'matchLabels': o.match_labels or {},
+            'matchExpressions': [
+                {
+                    'key': expr.key,
+                    'operator': expr.operator,
+                    'values': expr.values or []
+                } for expr in o.match_expressions or []
+            ]
+        }
+
+    return o
+
 
 class LabelSelector:
+    """ A compiled and immutable label selector
+
+    matchLabels and matchExpressions are compiled into a sorted tuple of
+    requirements, all of which must be satisfied. Instances are shared
+    between identical selectors by compile().
+    """
+
+    __slots__ = ['requirements', 'digest']
+
+    def __init__(self, o: Union[Dict, V1LabelSelector, None]):
+        spec = canonical_selector(o)
 
-    def __init__(self, o: Union[Dict[str, str], V1LabelSelector]):
-        obj: V1LabelSelector = None
-        if o is not V1LabelSelector:
-            v1 = client.CoreV1Api()
-            obj = v1.api_client._ApiClient__deserialize(o, 'V1LabelSelector')
-        else:
-            obj = o
+        reqs = set()
 
-        self.match_labels = obj.match_labels or {}
-        self.match_expressions = obj.match_expressions or []
+        for expr in spec.get('matchExpressions') or []:
+            op = expr.get('operator')
+            if op not in OPERATORS:
+                raise RuntimeError(f'Invalid label selector operator: {op}')
 
-        self.expressions = self.match_expressions
+            reqs.add((expr['key'], op, frozenset(expr.get('values') or [])))
 
         # Convert matchLabels into matchExpressions
-        for key, value in self.match_labels.items():
-            self.expressions.append({
-                'key': key,
-                'values': [value],
-                'operator': 'In'
-            })
+        for key, value in (spec.get('matchLabels') or {}).items():
+            reqs.add((key, 'In', frozenset([value])))
+
+        object.__setattr__(self, 'requirements', tuple(sorted(reqs, key=lambda r: (OPERATORS.index(r[1]), r[0], sorted(r[2])))))
+        object.__setattr__(self, 'digest', digest_dict(spec))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('LabelSelector is immutable')
+
+    def __hash__(self):
+        return hash(self.requirements)
+
+    def __eq__(self, other):
+        return isinstance(other, LabelSelector) and self.requirements == other.requirements
+
+    @classmethod
+    def compile(cls, o: Union[Dict, V1LabelSelector, None]) -> LabelSelector:
+        """ Get a shared selector for the spec """
+
+        spec = canonical_selector(o)
+
+        return _compile(json.dumps(spec, sort_keys=True))
 
     def to_labelselector(self):
         exprs = []
-        for expr in self.expressions:
-            op = expr.get('operator', 'In')
-            key = expr.get('key')
-            values = expr.get('values', [])
-            values_list = ','.join(values)
+        for key, op, values in self.requirements:
+            values_list = ','.join(sorted(values))
 
             if op == 'In':
                 exprs.append(f'{key} in ({values_list})')
@@ -47,29 +99,169 @@ class LabelSelector:
 
         return ','.join(exprs)
 
-    def match(self, labels) -> bool:
+    def match(self, labels: Optional[Dict[str, str]]) -> bool:
+        # All requirements must be satisfied.
         # An empty label selector matches all objects.
-        if len(self.expressions) == 0:
-            return True
+        labels = labels or {}
 
-        for expr in self.expressions:
-            key = expr.get('key')
-            vals = expr.get('values')
-            op = expr.get('operator')
+        for key, op, values in self.requirements:
+            if op == 'In':
+                if labels.get(key) not in values:
+                    return False
+            elif op == 'Exists':
+                if key not in labels:
+                    return False
+            elif op == 'NotIn':
+                if labels.get(key) in values:
+                    return False
+            elif op == 'DoesNotExist':
+                if key in labels:
+                    return False
 
-            val = labels.get(key)
+        return True
 
-            match = False
-            if op == 'In':
-                match = val in vals
+    def match_many(self, labels_list: Iterable[Optional[Dict[str, str]]]) -> List[bool]:
+        """ Match a batch of label sets """
+
+        if len(self.requirements) == 0:
+            return [True for _ in labels_list]
+
+        return [self.match(labels) for labels in labels_list]
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile(canonical: str) -> LabelSelector:
+    return LabelSelector(json.loads(canonical))
+
+
+Anchor = Tuple[str, str, Optional[FrozenSet[str]]]
+
+
+class SelectorIndex:
+    """ Find the selectors matching a set of labels without evaluating all of them
+
+    Each selector is filed under a single one of its requirements: In
+    requirements under each of their key/value pairs, Exists under their
+    key and NotIn under their key together with the excluded values.
+    Selectors with only DoesNotExist requirements or none at all are
+    candidates for any labels. Candidates are verified with the full
+    selector.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.selectors: Dict[Hashable, LabelSelector] = {}
+        self.anchors: Dict[Hashable, Optional[Anchor]] = {}
+
+        # (Key, Value) -> Selectors
+        self.values: Dict[Tuple[str, str], Set[Hashable]] = {}
+
+        # Key -> Selectors
+        self.exists: Dict[str, Set[Hashable]] = {}
+
+        # Key -> Selector -> Excluded values
+        self.not_in: Dict[str, Dict[Hashable, FrozenSet[str]]] = {}
+
+        self.others: Set[Hashable] = set()
+
+    def __len__(self):
+        return len(self.selectors)
+
+    @staticmethod
+    def anchor(selector: LabelSelector) -> Optional[Anchor]:
+        # Requirements are sorted by operator. In requirements
+        # with few values are the most selective ones.
+        ins = [r for r in selector.requirements if r[1] == 'In']
+        if len(ins) > 0:
+            return min(ins, key=lambda r: len(r[2]))
+
+        for key, op, values in selector.requirements:
+            if op == 'Exists':
+                return (key, op, None)
             elif op == 'NotIn':
-                match = val not in vals
+                return (key, op, values)
+
+        return None
+
+    def add(self, key: Hashable, selector: LabelSelector):
+        with self.lock:
+            self._remove(key)
+
+            anchor = self.anchor(selector)
+
+            self.selectors[key] = selector
+            self.anchors[key] = anchor
+
+            if anchor is None:
+                self.others.add(key)
+                return
+
+            label, op, values = anchor
+            if op == 'In':
+                for value in values:
+                    self.values.setdefault((label, value), set()).add(key)
             elif op == 'Exists':
-                match = key in labels
-            elif op == 'DoesNotExist':
-                match = key not in labels
+                self.exists.setdefault(label, set()).add(key)
+            elif op == 'NotIn':
+                self.not_in.setdefault(label, {})[key] = values
+
+    def remove(self, key: Hashable):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: Hashable):
+        if key not in self.selectors:
+            return
+
+        del self.selectors[key]
+        anchor = self.anchors.pop(key)
+
+        if anchor is None:
+            self.others.discard(key)
+            return
+
+        label, op, values = anchor
+        if op == 'In':
+            for value in values:
+                bucket = self.values[(label, value)]
+                bucket.discard(key)
+                if len(bucket) == 0:
+                    del self.values[(label, value)]
+        elif op == 'Exists':
+            bucket = self.exists[label]
+            bucket.discard(key)
+            if len(bucket) == 0:
+                del self.exists[label]
+        elif op == 'NotIn':
+            bucket = self.not_in[label]
+            del bucket[key]
+            if len(bucket) == 0:
+                del self.not_in[label]
+
+    def candidates(self, labels: Dict[str, str]) -> Set[Hashable]:
+        """ Get all selectors which might match the labels """
+
+        with self.lock:
+            candidates = set(self.others)
+
+            for label, value in labels.items():
+                candidates.update(self.values.get((label, value), ()))
+                candidates.update(self.exists.get(label, ()))
+
+            for label, bucket in self.not_in.items():
+                value = labels.get(label)
+                candidates.update(key for key, excluded in bucket.items() if value not in excluded)
+
+            return candidates
+
+    def match(self, labels: Dict[str, str]) -> List[Hashable]:
+        """ Get all selectors which match the labels """
+
+        labels = labels or {}
+        candidates = self.candidates(labels)
 
-            if match:
-                return True
+        with self.lock:
+            selectors = [(key, self.selectors.get(key)) for key in candidates]
 
-        return False
+        return [key for key, sel in selectors if sel is not None and sel.match(labels)]
@@ -0,0 +1,124 @@
+from __future__ import annotations
+from typing import List, Optional
+
+import contextlib
+import ctypes
+import glob
+import logging
+import os
+import threading
+
+CLONE_NEWNET = 0x40000000
+
+LOGGER = logging.getLogger('netns')
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_local = threading.local()
+
+
+def setns(fd: int):
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f'Failed to enter network namespace: {os.strerror(errno)}')
+
+
+class NetNS:
+    """ A network namespace which can be entered by the calling thread
+
+    Network namespaces are a per-thread property. Subprocesses and threads
+    started while a namespace is entered inherit it. State which depends
+    on the namespace, like nftables contexts and handle indices, is keyed
+    by the namespace.
+
+    The host namespace (key None) is never switched into and out of.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.fd: Optional[int] = os.open(path, os.O_RDONLY) if path is not None else None
+
+        # Serializes reconciliations and pod event flushes of the namespace
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return self.path or 'host'
+
+    @property
+    def key(self) -> Optional[int]:
+        if self.fd is None:
+            return None
+
+        return os.fstat(self.fd).st_ino
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @contextlib.contextmanager
+    def enter(self):
+        stack: List[NetNS] = _local.__dict__.setdefault('stack', [])
+
+        if self.fd is None:
+            stack.append(self)
+            try:
+                yield self
+            finally:
+                stack.pop()
+
+            return
+
+        orig = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+
+        try:
+            setns(self.fd)
+            stack.append(self)
+
+            try:
+                yield self
+            finally:
+                stack.pop()
+                setns(orig)
+        finally:
+            os.close(orig)
+
+
+HOST = NetNS()
+
+
+def current() -> NetNS:
+    """ Get the namespace the calling thread has entered last """
+
+    stack = _local.__dict__.get('stack')
+
+    return stack[-1] if stack else HOST
+
+
+def find_pod_netns(uid: str) -> Optional[NetNS]:
+    """ Find the network namespace of a pod by one of its processes
+
+    The cgroup path of the containers of a pod contains its uid. With the
+    systemd cgroup driver, dashes in the uid are replaced by underscores.
+    Requires access to the process table of the host (hostPID).
+    """
+
+    patterns = [f'pod{uid}', f'pod{uid.replace("-", "_")}']
+
+    for cgroup in glob.glob('/proc/[0-9]*/cgroup'):
+        try:
+            with open(cgroup) as f:
+                content = f.read()
+        except OSError:
+            continue
+
+        if not any(p in content for p in patterns):
+            continue
+
+        pid = cgroup.split('/')[2]
+
+        try:
+            return NetNS(f'/proc/{pid}/ns/net')
+        except OSError:
+            continue
+
+    return None
@@ -1,9 +1,16 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional
+
 import nftables
 import logging
 import json
 import threading
 
-_nftables = None
+from k8s_netem.config import NFT_TABLE_PREFIX
+from k8s_netem import netns
+
+# Network namespace -> Context
+_nftables: Dict[Optional[int], nftables.Nftables] = {}
 _nftables_lock = threading.Lock()
 
 LOGGER = logging.getLogger('nft')
@@ -19,13 +26,245 @@ class NftablesError(RuntimeError):
         super().__init__(f'Failed to configure nftables: {err} ({rc})')
 
 
-def nft(cmds):
-    global _nftables
+class NftBatch:
+    """ Collects nftables commands and commits them in a single transaction
+
+    libnftables applies all commands of a single json_cmd() call atomically.
+    Either all commands of a batch are applied or none of them. Hooks
+    registered with on_commit() and on_rollback() keep the bookkeeping of
+    the caller in line with the outcome.
+    """
+
+    def __init__(self):
+        self.cmds: List[Dict] = []
+
+        self.commit_hooks: List[Callable] = []
+        self.rollback_hooks: List[Callable] = []
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def add(self, cmds: List[Dict]):
+        self.cmds += cmds
+
+    def merge(self, other: NftBatch):
+        self.cmds += other.cmds
+
+        self.commit_hooks += other.commit_hooks
+        self.rollback_hooks += other.rollback_hooks
+
+    def on_commit(self, hook: Callable):
+        self.commit_hooks.append(hook)
+
+    def on_rollback(self, hook: Callable):
+        self.rollback_hooks.append(hook)
+
+    def abort(self):
+        """ Discard the batch without committing it """
+
+        for hook in self.rollback_hooks:
+            hook()
+
+        self.cmds = []
+        self.commit_hooks = []
+        self.rollback_hooks = []
+
+    def commit(self):
+        try:
+            output = nft(self.cmds)
+        except NftablesError as e:
+            LOGGER.error('Failed to commit batch of %d commands: %s', len(self.cmds), e)
+            LOGGER.debug('  Commands: %s', json.dumps(e.cmds, indent=2))
+
+            for hook in self.rollback_hooks:
+                hook()
+
+            raise
+        finally:
+            hooks = self.commit_hooks
+
+            self.cmds = []
+            self.commit_hooks = []
+            self.rollback_hooks = []
+
+        # Hooks run independently of each other as the
+        # transaction itself has already been committed
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                LOGGER.exception('Failed to run commit hook: %s', e)
+
+        return output
+
+
+class HandleIndex:
+    """ Kernel handles of the rules and sets in our tables
+
+    Handles are captured from the echoed output of the commands which
+    created the objects. Rules can thereby be deleted or replaced without
+    listing and searching their chain first.
+
+    A separate index is kept for every network namespace.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Network namespace -> Table -> {'rules': {(Chain, Comment) -> Handle}, 'sets': {Name -> Handle}}
+        self.indices: Dict[Optional[int], Dict[str, Dict]] = {}
+
+    @property
+    def tables(self) -> Dict[str, Dict]:
+        return self.indices.setdefault(netns.current().key, {})
+
+    @tables.setter
+    def tables(self, tables: Dict[str, Dict]):
+        self.indices[netns.current().key] = tables
+
+    def forget(self, ns: netns.NetNS):
+        """ Drop the index of a network namespace which is not used anymore """
+
+        with self.lock:
+            self.indices.pop(ns.key, None)
+
+    def _table(self, name: str) -> Dict:
+        return self.tables.setdefault(name, {
+            'rules': {},
+            'sets': {}
+        })
+
+    def rule(self, table: str, chain: str, comment: str) -> Optional[int]:
+        with self.lock:
+            return self.tables.get(table, {}).get('rules', {}).get((chain, comment))
+
+    def set(self, table: str, name: str) -> Optional[int]:
+        with self.lock:
+            return self.tables.get(table, {}).get('sets', {}).get(name)
+
+    def _add(self, type: str, obj: Dict):
+        if obj.get('family') != 'ip' or 'handle' not in obj:
+            return
+
+        name = obj['name'] if type == 'table' else obj['table']
+        if not name.startswith(NFT_TABLE_PREFIX):
+            return
+
+        table = self._table(name)
+
+        if type == 'rule' and 'comment' in obj:
+            table['rules'][(obj['chain'], obj['comment'])] = obj['handle']
+        elif type in ['set', 'map']:
+            table['sets'][obj['name']] = obj['handle']
+
+    def _delete(self, type: str, obj: Dict):
+        if type == 'ruleset':
+            self.tables = {}
+            return
+
+        if obj.get('family') != 'ip':
+            return
+
+        name = obj['name'] if type == 'table' else obj['table']
+        table = self.tables.get(name)
+        if table is None:
+            return
 
-    if _nftables is None:
-        LOGGER.info('Loading nftables')
-        _nftables = nftables.Nftables()
-        _nftables.validator = nftables.SchemaValidator()
+        if type == 'table':
+            del self.tables[name]
+        elif type == 'chain':
+            table['rules'] = {k: h for k, h in table['rules'].items() if k[0] != obj['name']}
+        elif type == 'rule':
+            table['rules'] = {k: h for k, h in table['rules'].items() if h != obj.get('handle')}
+        elif type in ['set', 'map']:
+            table['sets'].pop(obj['name'], None)
+
+    def update(self, cmds: List[Dict], output: Dict):
+        """ Track the changes of a successfully committed batch """
+
+        with self.lock:
+            # Removals are taken from the commands themselves
+            for cmd in cmds:
+                for op, objs in cmd.items():
+                    if op not in ['delete', 'destroy', 'flush']:
+                        continue
+
+                    for type, obj in objs.items():
+                        if op == 'flush' and type not in ['ruleset', 'chain', 'table']:
+                            continue
+
+                        if op == 'flush' and type == 'table':
+                            table = self.tables.get(obj.get('name'))
+                            if table is not None:
+                                table['rules'] = {}
+                            continue
+
+                        self._delete(type, obj or {})
+
+            # Additions from the echoed commands which include the handles
+            if not output:
+                return
+
+            for elm in output.get('nftables', []):
+                for op, objs in elm.items():
+                    if op not in ['add', 'create', 'insert', 'replace']:
+                        continue
+
+                    for type, obj in objs.items():
+                        self._add(type, obj)
+
+    def reindex(self):
+        """ Rebuild the index from the rules and sets currently found in the kernel """
+
+        ruleset = list_ruleset()
+
+        with self.lock:
+            self.tables = {}
+
+            for name, inventory in ruleset.items():
+                table = self._table(name)
+
+                table['rules'] = dict(inventory['handles'])
+                table['sets'] = dict(inventory['set_handles'])
+
+        LOGGER.info('Indexed handles of %d tables', len(self.tables))
+
+
+HANDLES = HandleIndex()
+
+
+def context() -> nftables.Nftables:
+    """ Get the nftables context of the network namespace of the calling thread
+
+    Contexts are bound to the namespace in which they have been created.
+    """
+
+    key = netns.current().key
+
+    ctx = _nftables.get(key)
+    if ctx is None:
+        LOGGER.info('Loading nftables for network namespace %s', netns.current())
+        ctx = nftables.Nftables()
+        ctx.validator = nftables.SchemaValidator()
+
+        # Let the kernel report the handles of newly created objects
+        ctx.set_echo_output(True)
+        ctx.set_handle_output(True)
+
+        _nftables[key] = ctx
+
+    return ctx
+
+
+def forget(ns: netns.NetNS):
+    """ Release all state kept for a network namespace """
+
+    _nftables.pop(ns.key, None)
+    HANDLES.forget(ns)
+
+
+def nft(cmds):
+    ctx = context()
 
     if len(cmds) == 0:
         return None
@@ -39,7 +278,7 @@ def nft(cmds):
 
     _nftables_lock.acquire()
 
-    rc, output, err = _nftables.json_cmd(payload)
+    rc, output, err = ctx.json_cmd(payload)
 
     _nftables_lock.release()
 
@@ -49,9 +288,59 @@ def nft(cmds):
     if rc != 0:
         raise NftablesError(rc, err, cmds)
 
+    HANDLES.update(cmds, output)
+
     return output
 
 
+def list_ruleset():
+    """ Get an inventory of the k8s-netem tables currently present in the kernel
+
+    Returns a dict mapping table names to the chains, sets and commented rules
+    of the table as well as the handles of the rules and sets.
+    """
+
+    output = nft([
+        {
+            'list': {
+                'ruleset': None
+            }
+        }
+    ])
+
+    tables = {}
+    for elm in output.get('nftables', []):
+        for type, obj in elm.items():
+            if type not in ['table', 'chain', 'set', 'map', 'rule']:
+                continue
+
+            if obj.get('family') != 'ip':
+                continue
+
+            name = obj['name'] if type == 'table' else obj['table']
+            if not name.startswith(NFT_TABLE_PREFIX):
+                continue
+
+            table = tables.setdefault(name, {
+                'chains': set(),
+                'sets': set(),
+                'rules': {},
+                'handles': {},
+                'set_handles': {}
+            })
+
+            if type == 'chain':
+                table['chains'].add(obj['name'])
+            elif type in ['set', 'map']:
+                table['sets'].add(obj['name'])
+                table['set_handles'][obj['name']] = obj.get('handle')
+            elif type == 'rule' and 'comment' in obj:
+                table['rules'][obj['comment']] = obj['handle']
+                table['handles'][(obj['chain'], obj['comment'])] = obj['handle']
+
+    return tables
+
+
 def log_cmd(logger, cmd):
     for action, object in cmd.items():
         for type, object in object.items():
@@ -1,62 +1,15 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Dict
+from typing import TYPE_CHECKING, Dict, List
 import logging
-import threading
 
-from kubernetes import watch, client
-import ipaddress
-
-from k8s_netem.match import LabelSelector
+from k8s_netem.cache import POD_CACHE
 from k8s_netem.resource import Resource
+from k8s_netem import aio
 
 if TYPE_CHECKING:
     from k8s_netem.direction import Rule
 
 
-class Namespace:
-
-    def __init__(self, peer, name=None):
-        self.peer = peer
-        self.name = name
-
-        self.logger = logging.getLogger(f'namespace:{name}')
-
-        self.thread = threading.Thread(target=self.watch_pods)
-        self.watch = None
-
-    def init(self):
-        self.logger.info('Initialize namespace watcher %s', self.name)
-        self.thread.start()
-
-    def deinit(self):
-        self.logger.info('Deinitialize namespace watcher %s', self.name)
-
-        if self.thread.is_alive():
-            if self.watch:
-                self.watch.stop()
-            self.thread.join(0.0)
-
-    def watch_pods(self):
-        self.logger.info('Started watching pods for %s', self.peer.spec)
-
-        self.watch = watch.Watch()
-        v1 = client.CoreV1Api()
-
-        selector = LabelSelector(self.peer.spec['podSelector']).to_labelselector()
-        stream_args = {
-            'label_selector': selector
-        }
-
-        if self.name:
-            stream_func = v1.list_namespaced_pod
-            stream_args['namespace': self.name]
-        else:
-            stream_func = v1.list_pod_for_all_namespaces
-
-        for event in self.watch.stream(stream_func, **stream_args):
-            self.peer.handle_pod_event(event)
-
-
 class Peer(Resource):
 
     def __init__(self, rule: Rule, index: int, spec):
@@ -67,95 +20,73 @@ class Peer(Resource):
         self.rule = rule
         self.index = index
 
-        self.thread = threading.Thread(target=self.watch_namespaces)
-        self.namespaces: Dict[str, Namespace] = {}
-        self.watch = None
+        # Peers might be initialized again when their profile is rebuilt
+        self.subscribed = False
 
-    def init(self):
-        self.logger.info('Initialize peer: %s', self.spec)
+        # Between init() and deinit()
+        self.active = False
 
-        if 'namespaceSelector' in self.spec:
-            self.thread.start()
+    def __str__(self):
+        return f'{self.rule.direction.name}-{self.rule.index}-{self.index}'
 
-        elif 'podSelector' in self.spec:
-            ns = Namespace(self)
-            ns.init()
+    @property
+    def selects_pods(self) -> bool:
+        return 'podSelector' in self.spec or 'namespaceSelector' in self.spec
 
-            self.namespaces['all'] = ns
+    def init(self):
+        self.logger.info('Initialize peer: %s', self.spec)
 
-    def deinit(self):
-        self.logger.info('Deinitialize peer: %s', self.spec)
+        self.active = True
 
-        if self.thread.is_alive():
-            if self.watch:
-                self.watch.stop()
-            self.thread.join(0.0)
+        # Pods are watched by a single informer shared by all peers.
+        # Starting it lists all pods. So it is kept off the kernel worker.
+        if self.selects_pods:
+            aio.offload(self.subscribe)
 
-        for _, ns in self.namespaces.items():
-            ns.deinit()
+    def subscribe(self):
+        POD_CACHE.init()
 
-    def watch_namespaces(self, peer):
-        self.logger.info('Started watching namespaces for %s', peer)
+        with POD_CACHE.lock:
+            # Deinitialized in the meantime
+            if self.active and not self.subscribed:
+                POD_CACHE.subscribe(self)
+                self.subscribed = True
 
-        self.watch = watch.Watch()
-        v1 = client.CoreV1Api()
+    def deinit(self):
+        self.logger.info('Deinitialize peer: %s', self.spec)
 
-        selector = LabelSelector(peer['namespaceSelector']).to_labelselector()
-        stream_args = {
-            'selector': selector
-        }
+        with POD_CACHE.lock:
+            self.active = False
 
-        for event in self.watch.stream(v1.list_namespace, **stream_args):
-            self.handle_namespace_event(event)
+            if self.subscribed:
+                POD_CACHE.unsubscribe(self)
+                self.subscribed = False
 
-    def handle_namespace_event(self, event):
+    def handle_pod_event(self, event):
+        pod = event['object']
         type = event['type']
-        ns = event['object']
-
-        uid = ns.metadata.uid
 
-        self.logger.info('%s %s %s', type.capitalize(),
-                         ns.kind,
-                         ns.metadata.name)
+        if type not in ['MODIFIED', 'ADDED', 'DELETED']:
+            return
 
-        if type == 'ADDED':
-            ns = Namespace(self, ns.metadata.name)
-            ns.init()
+        self.logger.debug('%s pod %s/%s with IP %s',
+                          type.capitalize(),
+                          pod.metadata.namespace,
+                          pod.metadata.name,
+                          pod.status.pod_ip)
 
-            self.namespaces[uid] = ns
+        # Superseded events of the same pod are dropped by the coalescer
+        self.rule.pod_events.put((self.index, pod.metadata.uid), {**event, 'peer': self})
 
-        elif type == 'DELETED':
-            ns = self.namespaces[uid]
-            ns.deinit()
+    def handle_pod_events(self, events: List[Dict]):
+        """ Apply a whole listing of pods at once instead of waiting for the coalescer """
 
-            del self.namespaces[uid]
+        if len(events) == 0:
+            return
 
-    def handle_pod_event(self, event):
-        pod = event['object']
-        type = event['type']
+        self.logger.debug('Applying batch of %d pod events', len(events))
 
-        if pod.status.pod_ip is None:
-            self.logger.debug('Pod is missing IP address. Skipping')
-            return
+        for event in events:
+            self.rule.pod_events.put((self.index, event['object'].metadata.uid), {**event, 'peer': self})
 
-        verb = {
-            'MODIFIED': 'in',
-            'ADDED': 'to',
-            'DELETED': 'from'
-        }
-
-        if type in ['MODIFIED', 'ADDED', 'DELETED']:
-            self.logger.info('%s %s %s set %s for pod %s/%s',
-                             type.capitalize(),
-                             pod.status.pod_ip,
-                             verb[type],
-                             self.rule.set_nets_name,
-                             pod.metadata.namespace,
-                             pod.metadata.name)
-
-            cidr = ipaddress.IPv4Network(pod.status.pod_ip)
-
-            if type == 'DELETED':
-                self.rule.delete_net(cidr)
-            else:
-                self.rule.add_net(cidr, f'{pod.metadata.namespace}/{pod.metadata.name}')
+        self.rule.pod_events.expedite()
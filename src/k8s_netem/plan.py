@@ -0,0 +1,104 @@
+from __future__ import annotations
+from typing import Dict, List, Optional
+
+from kubernetes import client
+
+from k8s_netem.informer import Informer
+from k8s_netem.resource import compare_dicts
+
+GROUP = 'k8s-netem.riasc.eu'
+VERSION = 'v1'
+PLURAL = 'trafficplans'
+
+LABEL_NODE = f'{GROUP}/node'
+LABEL_POD_UID = f'{GROUP}/pod-uid'
+
+
+def plan_profile(entry: Dict) -> Dict:
+    """ Convert a profile of a plan into a TrafficProfile-like resource
+
+    The resulting profile always matches the pod of the plan and its rules
+    only contain the already resolved networks of their peers.
+    """
+
+    spec = {
+        'podSelector': {},
+        'type': entry.get('type', 'Builtin'),
+        'parameters': entry.get('parameters', {}),
+        'mark': entry['mark']
+    }
+
+    if 'interfaceFilter' in entry:
+        spec['interfaceFilter'] = entry['interfaceFilter']
+
+    for direction in ['ingress', 'egress']:
+        if direction in entry:
+            spec[direction] = entry[direction]
+
+    return {
+        'kind': 'TrafficProfile',
+        'metadata': {
+            'name': entry['name'],
+            'uid': entry['uid']
+        },
+        'spec': spec
+    }
+
+
+class PlanTracker:
+    """ Turn successive versions of the plan of a pod into profile events """
+
+    def __init__(self):
+        # Profile uid -> Profile resource
+        self.profiles: Dict[str, Dict] = {}
+
+    def events(self, plan: Optional[Dict]) -> List[Dict]:
+        entries = plan.get('spec', {}).get('profiles', []) if plan is not None else []
+
+        profiles = {e['uid']: plan_profile(e) for e in entries}
+
+        events = []
+
+        for uid, res in self.profiles.items():
+            if uid not in profiles:
+                events.append({'type': 'DELETED', 'object': res})
+
+        for uid, res in profiles.items():
+            old_res = self.profiles.get(uid)
+            if old_res is None:
+                events.append({'type': 'ADDED', 'object': res})
+            elif not compare_dicts(old_res, res):
+                events.append({'type': 'MODIFIED', 'object': res})
+
+        self.profiles = profiles
+
+        return events
+
+
+class PlanInformer(Informer):
+    """ Informer for TrafficPlans
+
+    Sidecars watch the plan of their own pod, agents the plans of all pods of their node.
+    """
+
+    def __init__(self, namespace: str = None, name: str = None, node: str = None):
+        api = client.CustomObjectsApi()
+
+        if namespace is not None:
+            super().__init__('plans', api.list_namespaced_custom_object,
+                             group=GROUP,
+                             version=VERSION,
+                             plural=PLURAL,
+                             namespace=namespace,
+                             field_selector=f'metadata.name={name}')
+        elif node is not None:
+            super().__init__('plans', api.list_cluster_custom_object,
+                             group=GROUP,
+                             version=VERSION,
+                             plural=PLURAL,
+                             label_selector=f'{LABEL_NODE}={node}')
+        else:
+            super().__init__('plans', api.list_cluster_custom_object,
+                             group=GROUP,
+                             version=VERSION,
+                             plural=PLURAL)
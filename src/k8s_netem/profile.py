@@ -1,14 +1,16 @@
 from __future__ import annotations
-from typing import Dict, Iterable
+from typing import Dict, List, Tuple
 
 import logging
-from kubernetes import client, watch
+from kubernetes import client
 
-from k8s_netem.resource import Resource, compare_dicts
+from k8s_netem.resource import Resource
+from k8s_netem.informer import Informer
 from k8s_netem.match import LabelSelector
 from k8s_netem.direction import Direction
-from k8s_netem.config import NFT_TABLE_PREFIX
-from k8s_netem.nftables import nft
+from k8s_netem.config import NFT_TABLE_PREFIX, NFT_COMPILED
+from k8s_netem.nftables import NftBatch
+from k8s_netem import netns
 from k8s_netem.interface import get_default_route_interface, get_interfaces, get_interface_index
 
 DIRECTIONS = ['ingress', 'egress']
@@ -31,13 +33,27 @@ class Profile(Resource):
         self.name: str = self.meta.get('name')
         self.uid: str = self.meta.get('uid')
 
+        self.pod_selector = LabelSelector.compile(self.spec.get('podSelector', {}))
+
         self.interface_filter = self.spec.get('interfaceFilter')
         self.type = self.spec.get('type', 'Builtin')
         self.parameters = self.spec.get('parameters', {})
 
+        # Paths within the parameters which have been changed by the last update()
+        self.changes: List[Tuple] = []
+
+        # Mark assigned by the resolver for profiles of plans
+        self.planned_mark: int = self.spec.get('mark')
+
         self.logger = logging.getLogger(f'profile:{self.name}')
 
-        self.table_name = f'{NFT_TABLE_PREFIX}-{self.name}'
+        # Interfaces are resolved in and rules applied to this namespace
+        self.netns = netns.current()
+
+        if NFT_COMPILED:
+            self.table_name = NFT_TABLE_PREFIX
+        else:
+            self.table_name = f'{NFT_TABLE_PREFIX}-{self.name}'
 
         self.table = {
             'family': 'ip',
@@ -67,27 +83,69 @@ class Profile(Resource):
     def __str__(self):
         return f'{self.name} ({self.type})<{self.uid}>'
 
-    def init(self, mark: int):
+    def init(self, mark: int, batch: NftBatch):
         self.logger.info('Initializing profile %s', self.name)
 
         self.mark = mark
 
-        self.init_nftables()
+        self.init_nftables(batch)
 
         if self.ingress:
-            self.ingress.init()
+            self.ingress.init(batch)
         if self.egress:
-            self.egress.init()
+            self.egress.init(batch)
+
+    def adopt(self, mark: int, batch: NftBatch, table: Dict):
+        """ Take over the table which a previous run has left for this profile """
+
+        self.logger.info('Adopting profile %s', self.name)
+
+        self.mark = mark
+
+        self.init_nftables(batch)
+
+        for d in DIRECTIONS:
+            direction = getattr(self, d)
 
-    def deinit(self):
+            if direction is not None:
+                direction.adopt(batch, table)
+
+            # Chains of directions which have been removed in the meantime
+            elif d in table['chains']:
+                batch.add([
+                  {
+                    'flush': {
+                      'chain': {
+                        **self.table,
+                        'name': d
+                      }
+                    }
+                  },
+                  {
+                    'delete': {
+                      'chain': {
+                        **self.table,
+                        'name': d
+                      }
+                    }
+                  }
+                ])
+
+    def deinit(self, batch: NftBatch):
         self.logger.info('Deinitializing profile %s', self.name)
 
         if self.ingress:
-            self.ingress.deinit()
+            self.ingress.deinit(batch)
         if self.egress:
-            self.egress.deinit()
+            self.egress.deinit(batch)
+
+        self.deinit_nftables(batch)
+
+    def init_nftables(self, batch: NftBatch):
+        # The shared table is managed by the classifier
+        if NFT_COMPILED:
+            return
 
-    def init_nftables(self):
         cmds = [
           {
             'add': {
@@ -99,9 +157,12 @@ class Profile(Resource):
           }
         ]
 
-        nft(cmds)
+        batch.add(cmds)
+
+    def deinit_nftables(self, batch: NftBatch):
+        if NFT_COMPILED:
+            return
 
-    def deinit_nftables(self):
         cmds = [
           {
             'delete': {
@@ -113,7 +174,7 @@ class Profile(Resource):
           }
         ]
 
-        nft(cmds)
+        batch.add(cmds)
 
     def get_interface(self):
         if self.interface_filter is None:
@@ -125,11 +186,9 @@ class Profile(Resource):
                 return None
 
     def match(self, pod):
-        selector = LabelSelector(self.spec['podSelector'])
+        return self.pod_selector.match(pod.metadata.labels or {})
 
-        return selector.match(pod.metadata.labels)
-
-    def update(self, new_profile: Profile):
+    def update(self, new_profile: Profile, batch: NftBatch):
         self.logger.info('Updating profile %s', self.name)
 
         if self == new_profile:
@@ -142,19 +201,26 @@ class Profile(Resource):
         if self.interface != new_profile.interface:
             raise RuntimeError('Changing the interface of a profile is not supported')
 
+        changes = self.diff(new_profile)
+        changed = {path[0] for path in changes}
+
         for d in DIRECTIONS:
             direction = getattr(self, d)
             new_direction = getattr(new_profile, d)
 
+            # Direction is unchanged
+            if d not in changed:
+                continue
+
             # Direction is updated
-            if direction and new_direction:
-                direction.update(new_direction)
+            elif direction and new_direction:
+                direction.update(new_direction, batch)
 
             # Direction has been removed
             elif direction and not new_direction:
                 direction = getattr(self, d)
 
-                direction.deinit()
+                direction.deinit(batch)
 
                 setattr(self, d, None)
 
@@ -163,11 +229,18 @@ class Profile(Resource):
                 new_direction = getattr(new_profile, d)
 
                 new_direction.profile = self
-                new_direction.init()
+                new_direction.init(batch)
 
                 setattr(self, d, new_direction)
 
-        if compare_dicts(self.parameters, new_profile.parameters):
+        self.spec = new_profile.spec
+        self.meta = new_profile.meta
+        self.ressource = new_profile.ressource
+
+        # Paths within the parameters which have changed
+        self.changes = [path[1:] for path in changes if path[0] == 'parameters']
+
+        if len(self.changes) == 0:
             self.logger.info('Profile parameters of %s have not changed', self.name)
 
             return False
@@ -176,29 +249,25 @@ class Profile(Resource):
 
             return True
 
-    @classmethod
-    def list(cls) -> Iterable[Profile]:
-        api = client.CustomObjectsApi()
 
-        ret = api.list_cluster_custom_object(
-                group='k8s-netem.riasc.eu',
-                version='v1',
-                plural='trafficprofiles')
+class ProfileInformer(Informer):
+    """ Shared informer for TrafficProfiles
 
-        return map(cls, ret['items'])
+    Unless resolve is False, a Profile is constructed for every event.
+    """
 
-    @classmethod
-    def watch(cls):
+    def __init__(self, resolve: bool = True):
         api = client.CustomObjectsApi()
-        w = watch.Watch()
 
-        for event in w.stream(api.list_cluster_custom_object,
-                              group='k8s-netem.riasc.eu',
-                              version='v1',
-                              plural='trafficprofiles'):
+        super().__init__('profiles', api.list_cluster_custom_object,
+                         group='k8s-netem.riasc.eu',
+                         version='v1',
+                         plural='trafficprofiles')
 
-            obj = event['object']
+        self.resolve = resolve
 
-            event['profile'] = cls(obj)
+    def convert(self, event: Dict) -> Dict:
+        if self.resolve:
+            event['profile'] = Profile(event['object'])
 
-            yield event
+        return event
@@ -0,0 +1,496 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Set
+
+import logging
+import subprocess
+
+from k8s_netem.controller import Controller
+from k8s_netem.profile import Profile
+from k8s_netem.match import SelectorIndex
+from k8s_netem.nftables import NftablesError, NftBatch, list_ruleset
+from k8s_netem.classifier import get_classifiers
+from k8s_netem.marks import get_allocator
+from k8s_netem.tc import TcError
+from k8s_netem.config import NFT_TABLE_PREFIX, NFT_COMPILED, NFT_CONNTRACK
+from k8s_netem import netns
+
+FAILURES = (NftablesError, subprocess.CalledProcessError, RuntimeError)
+
+
+class Reconciler:
+    """ Converge the kernel towards the set of profiles matching our pod
+
+    Watch events only update the desired state. reconcile() then compares
+    the desired profiles with the applied ones and with what is actually
+    found in the kernel, and applies only the difference. Repeated events
+    and resyncs therefore leave working nftables rules and qdiscs untouched.
+
+    The kernel is only fully observed by the first reconciliation and by
+    resyncs. Reconciliations for single events only apply the difference
+    between the desired and applied profiles.
+
+    All nftables changes of a reconciliation are committed as a single
+    transaction. Controllers are only updated once it has been committed.
+    If the kernel rejects the transaction, each profile is retried in its
+    own one. Updated profiles whose transaction has failed are rebuilt
+    from scratch by a later reconciliation, as their kernel state no
+    longer matches their in-memory state.
+    """
+
+    def __init__(self, pod):
+        self.logger = logging.getLogger('reconciler')
+
+        self.pod = pod
+
+        # Uid -> Profile
+        self.desired: Dict[str, Profile] = {}
+
+        # All known profiles regardless of whether they match our pod
+        self.profiles: Dict[str, Profile] = {}
+        self.index = SelectorIndex()
+
+        # InterfaceName -> Controller
+        self.interfaces: Dict[str, Controller] = {}
+
+        # The kernel state has been fully observed at least once
+        self.observed = False
+
+        # Uids of applied profiles whose kernel state is unknown after a failed transaction
+        self.dirty: Set[str] = set()
+
+    @property
+    def applied(self) -> Dict[str, Profile]:
+        return {uid: profile
+                for ctrl in self.interfaces.values()
+                for uid, profile in ctrl.profiles.items()}
+
+    def handle_event(self, event):
+        profile = event['profile']
+        type = event['type']
+
+        if type == 'DELETED':
+            self.profiles.pop(profile.uid, None)
+            self.index.remove(profile.uid)
+        else:
+            self.profiles[profile.uid] = profile
+            self.index.add(profile.uid, profile.pod_selector)
+
+        if type == 'DELETED' or not profile.match(self.pod):
+            self.desired.pop(profile.uid, None)
+        else:
+            self._desire(profile)
+
+    def update_pod(self, pod):
+        """ Re-match all known profiles after the labels of our pod have changed """
+
+        self.pod = pod
+        self.desired = {}
+
+        for uid in self.index.match(pod.metadata.labels):
+            self._desire(self.profiles[uid])
+
+    def _desire(self, profile: Profile):
+        if profile.interface is None:
+            self.logger.error('Failed to identify network interface for profile %s', profile)
+            self.desired.pop(profile.uid, None)
+        else:
+            self.desired[profile.uid] = profile
+
+    def reconcile(self, full: bool = False):
+        """ Apply the difference between the desired and the applied profiles
+
+        With full, the kernel state is observed as well and drift is repaired.
+        """
+
+        # Pod events of the rules are flushed by other threads
+        with netns.current().lock:
+            self._reconcile(full)
+
+    def _reconcile(self, full: bool):
+        applied = self.applied
+
+        ruleset: Optional[Dict] = None
+        observed: Dict = {}
+
+        if full or not self.observed:
+            ruleset = list_ruleset()
+            observed = {intf: ctrl.observe() for intf, ctrl in self.interfaces.items()}
+
+        steps = self._steps(applied, ruleset, observed)
+
+        batch = NftBatch()
+        for step in steps:
+            step(batch)
+
+        if len(batch) == 0 and len(batch.commit_hooks) == 0:
+            return
+
+        try:
+            batch.commit()
+        except NftablesError:
+            self.logger.error('Reconciliation failed. Retrying each profile in its own transaction...')
+
+            # Rollback hooks have restored the bookkeeping, so the steps can be built again
+            for step in steps:
+                batch = NftBatch()
+                step(batch)
+
+                try:
+                    batch.commit()
+                except NftablesError:
+                    pass
+
+    def _steps(self, applied: Dict[str, Profile], ruleset: Optional[Dict], observed: Dict) -> List[Callable[[NftBatch], None]]:
+        """ Get the changes of a reconciliation as steps which can be committed together or separately """
+
+        steps: List[Callable[[NftBatch], None]] = [lambda batch: self._build_shared(batch, applied, ruleset, observed)]
+
+        # Removed profiles
+        for uid in applied.keys() - self.desired.keys():
+            steps.append(lambda batch, current=applied[uid]: self._build(batch, self._remove, current))
+
+        for uid, profile in self.desired.items():
+            steps.append(lambda batch, profile=profile, current=applied.get(uid):
+                         self._build(batch, self._reconcile_profile, profile, current, ruleset, observed))
+
+        # Kernel state of a previous run which has not been claimed by any profile
+        steps.append(self._release_unadopted)
+
+        return steps
+
+    def _build_shared(self, batch: NftBatch, applied: Dict[str, Profile], ruleset: Optional[Dict], observed: Dict):
+        if ruleset is not None:
+            self._observe(batch, applied, ruleset, observed)
+
+            batch.on_commit(self._observed)
+
+        if NFT_COMPILED:
+            # The refcounts of the shared map can not be restored for single profiles
+            if len(self.dirty) > 0:
+                self.logger.warn('Rebuilding shared classification table after a failed transaction')
+
+                self._rebuild_classifiers(batch, applied)
+
+            # Elements left by a previous run are replaced within this transaction
+            for classifier in get_classifiers().values():
+                if classifier.stale:
+                    batch.add(classifier.cmd_flush())
+                    classifier.delete_stale_chains(batch)
+                    batch.on_commit(classifier.adopted)
+
+                    # Connections might still carry marks of the previous run
+                    classifier.bump_generation(batch)
+
+    def _release_unadopted(self, batch: NftBatch):
+        for ctrl in self.interfaces.values():
+            batch.on_commit(ctrl.release_unadopted)
+
+    def _observed(self):
+        self.observed = True
+
+    def _observe(self, batch: NftBatch, applied: Dict[str, Profile], ruleset: Dict, observed: Dict):
+        """ Repair the state shared by all profiles and remove orphaned tables """
+
+        # Shared qdiscs are repaired before the profiles which depend on them
+        for intf, ctrl in self.interfaces.items():
+            batch.on_commit(lambda ctrl=ctrl, obs=observed[intf]: ctrl.repair(obs))
+
+        # Tables which are not backed by any profile
+        if NFT_COMPILED:
+            expected = {NFT_TABLE_PREFIX}
+
+            # Rebuilt anyway
+            if not self._classifiers_in_sync(ruleset) and len(self.dirty) == 0:
+                self.logger.warn('Shared classification table has drifted. Repairing...')
+
+                self._rebuild_classifiers(batch, applied)
+        else:
+            # Tables of desired profiles are adopted
+            expected = {p.table_name for p in applied.values()} | \
+                       {p.table_name for p in self.desired.values()}
+
+        for table_name in ruleset.keys() - expected:
+            self.logger.info('Removing orphaned table %s', table_name)
+
+            batch.add(self.cmd_delete_table(table_name))
+
+    def _rebuild_classifiers(self, batch: NftBatch, applied: Dict[str, Profile]):
+        """ Refill the shared table from the rules of all applied profiles """
+
+        for classifier in get_classifiers().values():
+            classifier.reset()
+            batch.add(classifier.cmd_init())
+            batch.add(classifier.cmd_flush())
+            classifier.delete_stale_chains(batch)
+            classifier.bump_generation(batch)
+
+        for profile in applied.values():
+            self._build(batch, self._repair_nftables, profile)
+
+    def _build(self, batch: NftBatch, func, profile: Profile, *args):
+        """ Add the changes for a single profile to the batch
+
+        Changes are only merged if they could be completely determined,
+        so that a single broken profile does not block all others.
+        """
+
+        profile_batch = NftBatch()
+
+        try:
+            func(profile_batch, profile, *args)
+        except FAILURES as e:
+            self.logger.error('Failed to reconcile profile %s: %s', profile, e)
+
+            profile_batch.abort()
+        else:
+            batch.merge(profile_batch)
+
+    def _build_and_commit(self, func, profile: Profile, *args):
+        batch = NftBatch()
+
+        self._build(batch, func, profile, *args)
+
+        batch.commit()
+
+    def _reconcile_profile(self, batch: NftBatch, profile: Profile, current: Profile, ruleset: Optional[Dict], observed: Dict):
+        # Profiles left in the kernel by a previous run
+        if current is None and not NFT_COMPILED and ruleset is not None and profile.table_name in ruleset:
+            self._adopt(batch, profile, ruleset[profile.table_name])
+
+        # Added profiles
+        elif current is None:
+            self._add(batch, profile)
+
+        # Profiles which can not be updated in-place
+        elif current.type != profile.type or current.interface != profile.interface:
+            self._remove(batch, current)
+
+            # The old controller might only be released once the removal
+            # has been committed. So the new profile needs its own transaction.
+            batch.on_commit(lambda: self._build_and_commit(self._add, profile))
+
+        # Profiles whose last transaction has failed
+        elif current.uid in self.dirty:
+            self._rebuild(batch, current)
+
+            # Further changes need the rebuilt state
+            if current != profile:
+                batch.on_commit(lambda: self._build_and_commit(self._update, current, profile))
+
+        # Modified profiles
+        elif current != profile:
+            self._update(batch, current, profile)
+
+        # Unchanged profiles which have drifted away in the kernel
+        elif ruleset is not None:
+            ctrl = self.interfaces[current.interface]
+
+            if not self._nftables_in_sync(current, ruleset):
+                self.logger.warn('nftables state of profile %s has drifted. Repairing...', current)
+                self._repair_nftables(batch, current)
+
+            if not ctrl.in_sync(current, observed.get(current.interface)):
+                self.logger.warn('Controller state of profile %s has drifted. Repairing...', current)
+                batch.on_commit(lambda: self._repair_controller(ctrl, current))
+
+    def _get_controller(self, profile: Profile) -> Controller:
+        ctrl = self.interfaces.get(profile.interface)
+        if ctrl is not None:
+            if ctrl.type != profile.type:
+                raise RuntimeError(f'Conflicting controllers: interface {profile.interface} is already managed by a {ctrl.type} controller')
+
+            self.logger.info('Using existing %s controller for profile %s', profile.type, profile)
+        else:
+            self.logger.info('Creating new %s controller for profile %s', profile.type, profile)
+            ctrl = Controller.from_type(profile.type, profile.interface)
+            self.interfaces[profile.interface] = ctrl
+
+        return ctrl
+
+    def _add(self, batch: NftBatch, profile: Profile):
+        ctrl = self._get_controller(profile)
+
+        mark = self._allocate_mark(batch, profile)
+
+        # Initialize nftables to classify traffic with fwmark
+        profile.init(mark, batch)
+
+        # Pass new profile to controller
+        batch.on_commit(lambda: ctrl.add_profile(profile))
+
+    def _adopt(self, batch: NftBatch, profile: Profile, table: Dict):
+        ctrl = self._get_controller(profile)
+
+        # Marks are derived from the uid and therefore usually
+        # match the ones of the tc filters of the previous run
+        mark = self._allocate_mark(batch, profile)
+
+        profile.adopt(mark, batch, table)
+
+        batch.on_commit(lambda: ctrl.add_profile(profile))
+
+    def _allocate_mark(self, batch: NftBatch, profile: Profile) -> int:
+        # Get a unused fwmark unless the resolver has already assigned one
+        allocator = get_allocator()
+        if profile.planned_mark is not None:
+            mark = allocator.reserve(profile.uid, profile.planned_mark)
+        else:
+            mark = allocator.allocate(profile.uid)
+
+        batch.on_rollback(lambda: allocator.release(mark))
+
+        return mark
+
+    def _update(self, batch: NftBatch, current: Profile, profile: Profile):
+        ctrl = self.interfaces[current.interface]
+
+        # The update is applied to the in-memory state right away
+        batch.on_rollback(lambda: self.dirty.add(current.uid))
+
+        params_changed = current.update(profile, batch)
+        if params_changed:
+            batch.on_commit(lambda: ctrl.update_profile(current))
+
+    def _rebuild(self, batch: NftBatch, profile: Profile):
+        """ Recreate the kernel state of a profile from its in-memory state """
+
+        self.logger.warn('Rebuilding kernel state of profile %s after a failed transaction', profile)
+
+        ctrl = self.interfaces[profile.interface]
+
+        # The classifiers are rebuilt by the shared step
+        if not NFT_COMPILED:
+            self._repair_nftables(batch, profile)
+
+        # Peers added by the failed update have not been started yet
+        for direction in [profile.ingress, profile.egress]:
+            if direction is None:
+                continue
+
+            for rule in direction.rules.values():
+                for peer in rule.peers:
+                    batch.on_commit(peer.init)
+
+        batch.on_commit(lambda: self._repair_controller(ctrl, profile))
+        batch.on_commit(lambda: self.dirty.discard(profile.uid))
+
+    def _remove(self, batch: NftBatch, profile: Profile):
+        # The in-memory state of a failed update does not match the kernel.
+        # So the whole table is dropped instead of its individual rules.
+        if profile.uid in self.dirty and not NFT_COMPILED:
+            for direction in [profile.ingress, profile.egress]:
+                if direction is None:
+                    continue
+
+                for rule in direction.rules.values():
+                    for peer in rule.peers:
+                        peer.deinit()
+
+                    if rule.aggregator.topology is not None:
+                        rule.aggregator.topology.remove_listener(rule.handle_topology_change)
+
+                    rule.pod_events.cancel()
+
+            # Adding the table first lets it be deleted whether it exists or not
+            profile.init_nftables(batch)
+            batch.add(self.cmd_delete_table(profile.table_name))
+        else:
+            profile.deinit(batch)
+
+        batch.on_commit(lambda: self._remove_from_controller(profile))
+
+    def _remove_from_controller(self, profile: Profile):
+        ctrl = self.interfaces[profile.interface]
+
+        self.dirty.discard(profile.uid)
+
+        ctrl.remove_profile(profile)
+
+        get_allocator().release(profile.mark)
+
+        # Deinitialize and remove controller once the last
+        # Profile has been removed. This allows new Profiles
+        # with a different type to target this interface.
+        if len(ctrl.profiles) == 0:
+            self.logger.info('Removing controller %s from interface %s', ctrl, profile.interface)
+            ctrl.deinit()
+            del self.interfaces[profile.interface]
+
+    def _classifiers_in_sync(self, ruleset: Dict) -> bool:
+        table = ruleset.get(NFT_TABLE_PREFIX)
+        if table is None:
+            return False
+
+        for classifier in get_classifiers().values():
+            if classifier.chain_name not in table['chains'] or \
+               classifier.map_name not in table['sets']:
+                return False
+
+            if NFT_CONNTRACK and classifier.restore_map_name not in table['sets']:
+                return False
+
+            if any(classifier.mark_chain_name(mark) not in table['chains'] for mark in classifier.marks):
+                return False
+
+        return True
+
+    def _nftables_in_sync(self, profile: Profile, ruleset: Dict) -> bool:
+        # Checked for all profiles at once by _classifiers_in_sync()
+        if NFT_COMPILED:
+            return True
+
+        table = ruleset.get(profile.table_name)
+        if table is None:
+            return False
+
+        for direction in [profile.ingress, profile.egress]:
+            if direction is None:
+                continue
+
+            if direction.chain_name not in table['chains']:
+                return False
+
+            for rule in direction.rules.values():
+                if rule.name not in table['rules']:
+                    return False
+
+        return True
+
+    def cmd_delete_table(self, table_name: str):
+        return [
+          {
+            'delete': {
+              'table': {
+                'family': 'ip',
+                'name': table_name
+              }
+            }
+          }
+        ]
+
+    def _repair_nftables(self, batch: NftBatch, profile: Profile):
+        # Rebuild the table from scratch while keeping the
+        # peer watches of the rules running
+        if not NFT_COMPILED:
+            # Adding the table first lets it be deleted whether it exists or not
+            profile.init_nftables(batch)
+            batch.add(self.cmd_delete_table(profile.table_name))
+
+        profile.init_nftables(batch)
+
+        for direction in [profile.ingress, profile.egress]:
+            if direction is None:
+                continue
+
+            direction.init_nftables(batch)
+
+            for rule in direction.rules.values():
+                rule.init_nftables(batch)
+
+    def _repair_controller(self, ctrl: Controller, profile: Profile):
+        try:
+            ctrl.remove_profile(profile)
+        except (subprocess.CalledProcessError, TcError):
+            pass
+
+        ctrl.add_profile(profile)
@@ -0,0 +1,293 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+
+import os
+import logging
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from k8s_netem.cache import POD_CACHE, Selection, selection_key
+from k8s_netem.coalesce import Coalescer
+from k8s_netem.marks import MarkAllocator, effective_mask
+from k8s_netem.match import LabelSelector, SelectorIndex
+from k8s_netem.plan import PlanInformer, GROUP, VERSION, PLURAL, LABEL_NODE, LABEL_POD_UID
+from k8s_netem.profile import ProfileInformer
+from k8s_netem.resource import compare_dicts
+from k8s_netem.config import RESOLVE_WINDOW
+
+import k8s_netem.log as log
+
+LOGGER = logging.getLogger('resolver')
+
+HTTP_NOT_FOUND = 404
+HTTP_CONFLICT = 409
+
+
+class Resolver:
+    """ Evaluate all profiles once for the whole cluster
+
+    For every pod matched by at least one profile, a TrafficPlan with the
+    matching profiles, their marks and the resolved networks of their peers
+    is published. Sidecars and agents only watch their own plans instead of
+    all profiles and peer pods.
+
+    The plans are recomputed after a short window whenever a profile,
+    pod or namespace changes. Only plans whose content has changed are
+    written.
+
+    Marks are unique across the cluster. So the bits of NETEM_MARK_MASK
+    limit the number of profiles, e.g. to 255 by default. Profiles beyond
+    that limit are left out of all plans.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('resolver')
+
+        self.api = client.CustomObjectsApi()
+
+        self.profiles = ProfileInformer(resolve=False)
+        self.plans = PlanInformer()
+
+        # Marks are unique across the cluster
+        self.marks = MarkAllocator(effective_mask())
+
+        # (Namespace, Name) -> Spec of published plans
+        self.published: Dict[Tuple[str, str], Dict] = {}
+
+        self.selections: Dict[Tuple, Selection] = {}
+
+        # Pod selectors of all profiles by profile uid
+        self.index = SelectorIndex()
+
+        self.coalescer = Coalescer('resolve', lambda _: self.resolve(), RESOLVE_WINDOW)
+
+    def trigger(self, event=None):
+        self.coalescer.put('resolve', None)
+
+    def run(self):
+        for event in self.profiles.list():
+            self.handle_profile_event(event)
+
+        # Existing plans keep their marks stable across restarts
+        for event in self.plans.list():
+            plan = event['object']
+            meta = plan['metadata']
+
+            self.published[(meta['namespace'], meta['name'])] = plan.get('spec', {})
+
+            for entry in plan.get('spec', {}).get('profiles', []):
+                self.marks.reserve(entry['uid'], entry['mark'])
+
+        POD_CACHE.add_listener(self.trigger)
+        POD_CACHE.add_namespace_listener(self.trigger)
+
+        self.resolve()
+
+        for event in self.profiles.watch():
+            obj = event['object']
+
+            self.logger.debug('%s %s %s',
+                              event['type'].capitalize(),
+                              obj['kind'],
+                              obj['metadata']['name'])
+
+            self.handle_profile_event(event)
+            self.trigger()
+
+    def handle_profile_event(self, event):
+        obj = event['object']
+        uid = obj['metadata']['uid']
+
+        if event['type'] == 'DELETED':
+            self.index.remove(uid)
+        else:
+            self.index.add(uid, LabelSelector.compile(obj['spec'].get('podSelector', {})))
+
+    def selection(self, pod_selector: Dict, namespace_selector: Optional[Dict]) -> Selection:
+        key = selection_key(pod_selector, namespace_selector)
+
+        sel = self.selections.get(key)
+        if sel is None:
+            sel = Selection(pod_selector, namespace_selector)
+            self.selections[key] = sel
+
+        return sel
+
+    def resolve_rule(self, rule: Dict, pods: List, namespaces: Dict, key: str = 'to') -> Dict:
+        """ Replace the peers of a rule by their networks
+
+        Peers are listed under 'to' for egress and under 'from' for ingress rules.
+        """
+
+        peers = rule.get(key, [])
+
+        resolved = {k: v for k, v in rule.items() if k != key}
+
+        # Rules without peers match all destinations or sources
+        if len(peers) == 0:
+            return resolved
+
+        cidrs = set()
+        for peer in peers:
+            if 'ipBlock' in peer:
+                cidrs.add(peer['ipBlock']['cidr'])
+
+            if 'podSelector' not in peer and 'namespaceSelector' not in peer:
+                continue
+
+            sel = self.selection(peer.get('podSelector', {}), peer.get('namespaceSelector'))
+
+            for pod, match in zip(pods, sel.match_many(pods, namespaces)):
+                if match and pod.status.pod_ip is not None:
+                    cidrs.add(f'{pod.status.pod_ip}/32')
+
+        resolved['cidrs'] = sorted(cidrs)
+
+        return resolved
+
+    def resolve_profile(self, profile: Dict, pods: List, namespaces: Dict) -> Dict:
+        meta = profile['metadata']
+        spec = profile['spec']
+
+        entry = {
+            'name': meta['name'],
+            'uid': meta['uid'],
+            'type': spec.get('type', 'Builtin'),
+            'parameters': spec.get('parameters', {}),
+            'mark': self.marks.allocate(meta['uid'])
+        }
+
+        if 'interfaceFilter' in spec:
+            entry['interfaceFilter'] = spec['interfaceFilter']
+
+        if 'ingress' in spec:
+            entry['ingress'] = [self.resolve_rule(r, pods, namespaces, 'from') for r in spec['ingress']]
+
+        if 'egress' in spec:
+            entry['egress'] = [self.resolve_rule(r, pods, namespaces, 'to') for r in spec['egress']]
+
+        return entry
+
+    def resolve(self):
+        profiles = list(self.profiles.store.values())
+
+        with POD_CACHE.lock:
+            namespaces = dict(POD_CACHE.namespaces)
+            pods = [pod for p in POD_CACHE.pods.values() for pod in p.values()]
+
+        # Release marks of deleted profiles
+        uids = {p['metadata']['uid'] for p in profiles}
+        for mark, uid in list(self.marks.used.items()):
+            if uid not in uids:
+                self.marks.release(mark)
+
+        # Peers are resolved only once per profile
+        entries = {}
+        for profile in profiles:
+            try:
+                entries[profile['metadata']['uid']] = self.resolve_profile(profile, pods, namespaces)
+            except RuntimeError as e:
+                self.logger.error('Failed to resolve profile %s: %s', profile['metadata']['name'], e)
+
+        plans = {}
+        for pod in pods:
+            if pod.spec.node_name is None or pod.spec.host_network:
+                continue
+
+            # Only the candidates of the index are evaluated
+            matched = [entries[uid] for uid in self.index.match(pod.metadata.labels) if uid in entries]
+            if len(matched) == 0:
+                continue
+
+            plans[(pod.metadata.namespace, pod.metadata.name)] = (pod, {
+                'profiles': sorted(matched, key=lambda e: e['uid'])
+            })
+
+        for key, (pod, spec) in plans.items():
+            old_spec = self.published.get(key)
+            if old_spec is not None and compare_dicts(old_spec, spec):
+                continue
+
+            self.publish(pod, spec, old_spec is None)
+
+        for key in self.published.keys() - plans.keys():
+            self.withdraw(*key)
+
+        self.logger.info('Resolved %d profiles into %d plans', len(profiles), len(plans))
+
+    def publish(self, pod, spec: Dict, create: bool):
+        namespace = pod.metadata.namespace
+        name = pod.metadata.name
+
+        body = {
+            'apiVersion': f'{GROUP}/{VERSION}',
+            'kind': 'TrafficPlan',
+            'metadata': {
+                'name': name,
+                'namespace': namespace,
+                'labels': {
+                    LABEL_NODE: pod.spec.node_name,
+                    LABEL_POD_UID: pod.metadata.uid
+                },
+                # Plans get garbage collected together with their pod
+                'ownerReferences': [
+                    {
+                        'apiVersion': 'v1',
+                        'kind': 'Pod',
+                        'name': name,
+                        'uid': pod.metadata.uid
+                    }
+                ]
+            },
+            'spec': spec
+        }
+
+        self.logger.info('Publishing plan for pod %s/%s', namespace, name)
+
+        try:
+            try:
+                if create:
+                    self.api.create_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, body)
+                else:
+                    self.api.replace_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, name, body)
+            except ApiException as e:
+                if e.status not in [HTTP_NOT_FOUND, HTTP_CONFLICT]:
+                    raise
+
+                # Our view of the published plans was outdated
+                if create:
+                    self.api.replace_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, name, body)
+                else:
+                    self.api.create_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, body)
+        except ApiException as e:
+            self.logger.error('Failed to publish plan for pod %s/%s: %s', namespace, name, e.reason)
+            return
+
+        self.published[(namespace, name)] = spec
+
+    def withdraw(self, namespace: str, name: str):
+        self.logger.info('Withdrawing plan for pod %s/%s', namespace, name)
+
+        try:
+            self.api.delete_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, name)
+        except ApiException as e:
+            if e.status != HTTP_NOT_FOUND:
+                self.logger.error('Failed to withdraw plan for pod %s/%s: %s', namespace, name, e.reason)
+                return
+
+        del self.published[(namespace, name)]
+
+
+def main():
+    log.setup()
+
+    LOGGER.info('Started netem profile resolver')
+
+    if os.environ.get('KUBECONFIG'):
+        config.load_kube_config()
+    else:
+        config.load_incluster_config()
+
+    resolver = Resolver()
+    resolver.run()
@@ -1,4 +1,7 @@
-from typing import Dict
+from __future__ import annotations
+from typing import Any, Dict, List, Tuple, Union
+
+import hashlib
 import json
 
 
@@ -6,17 +9,81 @@ def hash_dict(d: Dict):
     return hash(json.dumps(d, sort_keys=True))
 
 
+def digest_dict(d: Dict) -> str:
+    """ Get a digest of the canonical serialization which is stable across processes """
+
+    return hashlib.sha1(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+
 def compare_dicts(a: Dict, b: Dict):
     return hash_dict(a) == hash_dict(b)
 
 
+Path = Tuple[Union[str, int], ...]
+
+
+def diff_dicts(a: Any, b: Any, path: Path = ()) -> List[Path]:
+    """ Get the paths of all subtrees which differ
+
+    Lists of different lengths are reported as a whole.
+    """
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        paths = []
+        for key in sorted(a.keys() | b.keys(), key=str):
+            if key not in a or key not in b:
+                paths.append(path + (key,))
+            else:
+                paths += diff_dicts(a[key], b[key], path + (key,))
+
+        return paths
+
+    if isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        paths = []
+        for i, (x, y) in enumerate(zip(a, b)):
+            paths += diff_dicts(x, y, path + (i,))
+
+        return paths
+
+    return [] if a == b else [path]
+
+
 class Resource:
+    """ A resource which is identified by the digest of its spec
+
+    The digest is only computed once for every spec which is assigned.
+    Specs must therefore be replaced instead of modified in place.
+    """
 
     def __init__(self, spec: Dict):
         self.spec = spec
 
+    @property
+    def spec(self) -> Dict:
+        return self._spec
+
+    @spec.setter
+    def spec(self, spec: Dict):
+        self._spec = spec
+        self._digest = None
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = digest_dict(self._spec)
+
+        return self._digest
+
+    def diff(self, other: Resource) -> List[Path]:
+        """ Get the paths within the spec which differ from the other resource """
+
+        if self.digest == other.digest:
+            return []
+
+        return diff_dicts(self._spec, other._spec)
+
     def __hash__(self):
-        return hash_dict(self.spec)
+        return hash(self.digest)
 
     def __eq__(self, other):
-        return self.__hash__() == other.__hash__()
+        return isinstance(other, Resource) and self.digest == other.digest
@@ -1,14 +1,20 @@
 from __future__ import annotations
-from typing import Dict, Set, Any, TYPE_CHECKING
+from typing import Dict, Hashable, Set, Tuple, Any, TYPE_CHECKING
 
 import logging
 import ipaddress
 import random
-import json
 
 from k8s_netem.resource import Resource
-from k8s_netem.nftables import NftablesError, nft
+from k8s_netem.aggregate import NetAggregator, TOPOLOGY
+from k8s_netem.cache import POD_CACHE
+from k8s_netem.coalesce import Coalescer
+from k8s_netem.classifier import Key
+from k8s_netem.nftables import NftBatch, HANDLES
 from k8s_netem.peer import Peer
+from k8s_netem.marks import get_allocator
+from k8s_netem.config import NODE_CIDR_AGGREGATION
+from k8s_netem import aio
 
 if TYPE_CHECKING:
     from k8s_netem.direction import Direction
@@ -24,12 +30,11 @@ class Rule(Resource):
         self.direction = dir
         self.index = index
 
+        # Rules are matched up by their key when a direction is updated
+        self.key: Hashable = spec.get('name', index)
+
         self.generation = random.randint(0, 1 << 16)
-        self.name = f'{self.direction.direction}-{self.index}-{self.generation}'
-        self.set_ports_name = f'{self.name}-ports'
-        self.set_nets_name = f'{self.name}-nets'
-        self.set_ether_types_name = f'{self.name}-ether-types'
-        self.set_inet_protos_name = f'{self.name}-inet-protos'
+        self.rename(f'{self.direction.direction}-{self.index}-{self.generation}')
 
         peer_specs = spec.get('from' if self.direction.direction == 'ingress' else 'to', [])
 
@@ -38,24 +43,134 @@ class Rule(Resource):
         self.ether_types = self.spec.get('etherTypes', [])
         self.inet_protos = self.spec.get('inetProtos', [])
 
+        # Networks of ipBlock peers
+        self.static_nets: Set[ipaddress.IPv4Network] = {
+            ipaddress.IPv4Network(p['ipBlock']['cidr']) for p in peer_specs if 'ipBlock' in p
+        }
+
+        # Rules of resolved plans carry the networks of their peers instead
+        self.resolved = 'cidrs' in spec
+        if self.resolved:
+            self.static_nets |= {ipaddress.IPv4Network(c) for c in spec['cidrs']}
+
+        # (Peer index, Pod uid) -> (Network, Comment) of pods selected by peers
+        self.pod_nets: Dict[Tuple[int, str], Tuple[ipaddress.IPv4Network, str]] = {}
+
+        # Smallest set of prefixes covering the pod networks
+        self.aggregator = NetAggregator(TOPOLOGY if NODE_CIDR_AGGREGATION else None)
+
+        # Networks currently in the nets set
         self.nets: Set[ipaddress.IPv4Network] = set()
 
-    def init(self):
+        # Pod events of all peers are applied in batches
+        self.pod_events = Coalescer(f'{dir.name}-{index}', self.handle_pod_events)
+
+    def rename(self, name: str):
+        self.name = name
+        self.set_ports_name = f'{self.name}-ports'
+        self.set_nets_name = f'{self.name}-nets'
+        self.set_ether_types_name = f'{self.name}-ether-types'
+        self.set_inet_protos_name = f'{self.name}-inet-protos'
+
+    def init(self, batch: NftBatch):
         self.logger.info('Initializing rule %d of %s of %s', self.index, self.direction, self.direction.profile)
 
-        self.init_nftables()
+        self.init_nftables(batch)
+        self.start(batch)
+
+    def adopt(self, batch: NftBatch, name: str):
+        """ Take over the rule and sets which a previous run has left in the kernel
+
+        The sets are refilled and the rule is replaced within the same
+        transaction, so traffic is classified without interruption.
+        """
+
+        self.logger.info('Adopting rule %s of %s of %s', name, self.direction, self.direction.profile)
+
+        self.rename(name)
 
-        # Start synchronization threads
+        # The sets are flushed. So they need to hold the pods right away
+        self.prefill()
+        self.nets |= self.desired_nets()
+
+        cmds = []
+
+        cmds += self.cmd_create_sets()
+        cmds += self.cmd_flush_sets()
+        cmds += self.cmd_populate_set_ether_types()
+        cmds += self.cmd_populate_set_inet_protos()
+        cmds += self.cmd_populate_set_nets()
+        cmds += self.cmd_populate_set_ports()
+        cmds += self.cmd_update_rule()
+
+        batch.add(cmds)
+
+        self.start(batch)
+
+    def start(self, batch: NftBatch):
+        if self.aggregator.topology is not None and any(p.selects_pods for p in self.peers):
+            batch.on_commit(self.init_topology)
+
+        # Start synchronization threads once the sets exist
         for peer in self.peers:
-            peer.init()
+            batch.on_commit(peer.init)
 
-    def deinit(self):
+    def deinit(self, batch: NftBatch):
         self.logger.info('Deinitializing rule %d of %s of %s', self.index, self.direction, self.direction.profile)
 
         for peer in self.peers:
             peer.deinit()
 
-        self.deinit_nftables()
+        if self.aggregator.topology is not None:
+            self.aggregator.topology.remove_listener(self.handle_topology_change)
+
+        self.pod_events.cancel()
+
+        self.deinit_nftables(batch)
+
+    def init_topology(self):
+        self.aggregator.topology.add_listener(self.handle_topology_change)
+
+        # Starting the topology lists all nodes and pods
+        aio.offload(self.aggregator.topology.init)
+
+    def handle_topology_change(self, cidr: ipaddress.IPv4Network):
+        self.pod_events.put(('topology', cidr), {
+            'type': 'TOPOLOGY',
+            'cidr': cidr
+        })
+
+    @property
+    def has_peers(self) -> bool:
+        return len(self.peers) > 0 or self.resolved
+
+    @property
+    def is_inet(self) -> bool:
+        return len(self.ether_types) == 0 or any(x in ['ip', 'ip6', 0x800, 0x86DD] for x in self.ether_types)
+
+    def map_keys(self, nets: Set[ipaddress.IPv4Network]) -> Set[Key]:
+        """ Get the elements of the verdict map for the compiled nftables mode """
+
+        if not self.is_inet:
+            self.logger.warn('Rules for non-IPv4 etherTypes are not supported in the compiled nftables mode')
+            return set()
+
+        # Without peers, a rule matches all destinations
+        if not self.has_peers:
+            nets = {ipaddress.IPv4Network('0.0.0.0/0')}
+
+        if len(self.ports) > 0:
+            protos_ports = [(p.get('protocol', 'TCP').lower(), int(p.get('port'))) for p in self.ports]
+            if len(self.inet_protos) > 0:
+                protos_ports = [(proto, port) for proto, port in protos_ports if proto in self.inet_protos]
+        elif len(self.inet_protos) > 0:
+            protos_ports = [(proto, None) for proto in self.inet_protos]
+        else:
+            protos_ports = [(None, None)]
+
+        ifindex = self.direction.profile.interface_index
+
+        return {(ifindex, net, proto, port) for net in nets for proto, port in protos_ports}
 
     def cmd_create_sets(self):
         return [
@@ -98,6 +213,18 @@ class Rule(Resource):
           }
         ]
 
+    def cmd_flush_sets(self):
+        return [
+          {
+            'flush': {
+              'set': {
+                **self.direction.profile.table,
+                'name': name
+              }
+            }
+          } for name in [self.set_nets_name, self.set_ports_name, self.set_ether_types_name, self.set_inet_protos_name]
+        ]
+
     def cmd_populate_set_ether_types(self):
         cmds = []
 
@@ -115,20 +242,10 @@ class Rule(Resource):
         return cmds
 
     def cmd_populate_set_nets(self):
-        cmds = []
-
-        for peer in self.peers:
-            ip_block = peer.spec.get('ipBlock')
-
-            if ip_block is not None:
-                cidr = ip_block.get('cidr')
-                cidr = ipaddress.IPv4Network(cidr)
+        self.nets |= self.static_nets
 
-                self.nets.add(cidr)
-
-                cmds += self.cmd_modify_set_net('add', cidr)
-
-        return cmds
+        # Also includes networks of already discovered peer pods
+        return self.cmd_modify_set_nets('add', {cidr: None for cidr in self.nets})
 
     def cmd_populate_set_ports(self):
         cmds = []
@@ -187,12 +304,12 @@ class Rule(Resource):
               }
             ]
 
-        is_inet = len(self.ether_types) == 0 or any(x in ['ip', 'ip6', 0x800, 0x86DD] for x in self.ether_types)
+        is_inet = self.is_inet
 
         # If at least one peer is provided in the spec,
         # we will match against the associated networks
         # even if the selectors are not matching any pods
-        if len(self.peers) > 0:
+        if self.has_peers:
             if is_inet:
                 exprs += [
                   {
@@ -241,6 +358,9 @@ class Rule(Resource):
             else:
                 self.logger.warn('Attempted to filter based-on port number on non-UDP/TCP/UDPlite/SCTP transport protocol')
 
+        # Bits outside of the mask belong to the CNI
+        mask = get_allocator().mask
+
         exprs += [
           {
             'mangle': {
@@ -249,7 +369,21 @@ class Rule(Resource):
                   'key': 'mark'
                 }
               },
-              'value': self.direction.profile.mark
+              'value': {
+                '|': [
+                  {
+                    '&': [
+                      {
+                        'meta': {
+                          'key': 'mark'
+                        }
+                      },
+                      ~mask & 0xffffffff
+                    ]
+                  },
+                  self.direction.profile.mark
+                ]
+              }
             }
           }
         ]
@@ -304,25 +438,26 @@ class Rule(Resource):
         ]
 
     def cmd_delete_rule(self):
-        handle = self.find_handle(self.name)
-        if handle is None:
-            raise RuntimeError(f'Failed to find rule by comment: {self.name}')
-
         return [
           {
             'delete': {
               'rule': {
                 **self.direction.profile.table,
                 'chain': self.direction.chain_name,
-                'handle': handle
+                'handle': self.handle
               }
             }
           }
         ]
 
     def cmd_update_rule(self):
-        return self.rule.cmd_delete_rule() + \
-               self.rule.cmd_create_rule()
+        cmds = self.cmd_create_rule()
+
+        # Swap the rule in-place without a window in which it is missing
+        cmds[0]['replace'] = cmds[0].pop('add')
+        cmds[0]['replace']['rule']['handle'] = self.handle
+
+        return cmds
 
     def cmd_modify_set_ether_type(self, op: str, ether_type: str | int):
         return [
@@ -376,22 +511,36 @@ class Rule(Resource):
         ]
 
     def cmd_modify_set_net(self, op: str, cidr: ipaddress.IPv4Network, comment: str = None):
-        if cidr.prefixlen >= ipaddress.IPV4LENGTH:  # IPv6
-            val: str | dict = str(cidr.network_address)
-        else:
-            val = {
-              'prefix': {
-                'addr': str(cidr.network_address),
-                'len': cidr.prefixlen
-              }
+        return self.cmd_modify_set_nets(op, {cidr: comment})
+
+    def cmd_modify_set_nets(self, op: str, cidrs: Dict[ipaddress.IPv4Network, str]):
+        """ Add or remove many networks with a single element command """
+
+        if len(cidrs) == 0:
+            return []
+
+        elems = []
+        for cidr, comment in cidrs.items():
+            if cidr.prefixlen >= ipaddress.IPV4LENGTH:  # IPv6
+                val: str | dict = str(cidr.network_address)
+            else:
+                val = {
+                  'prefix': {
+                    'addr': str(cidr.network_address),
+                    'len': cidr.prefixlen
+                  }
+                }
+
+            elem = {
+                'val': val
             }
 
-        elem = {
-            'val': val
-        }
+            if comment is not None:
+                elem['comment'] = comment
 
-        if comment is not None:
-            elem['comment'] = comment
+            elems.append({
+              'elem': elem
+            })
 
         return [
           {
@@ -399,17 +548,24 @@ class Rule(Resource):
               'element': {
                 **self.direction.profile.table,
                 'name': self.set_nets_name,
-                'elem': [
-                  {
-                    'elem': elem
-                  }
-                ]
+                'elem': elems
               }
             }
           }
         ]
 
-    def init_nftables(self):
+    def init_nftables(self, batch: NftBatch):
+        classifier = self.direction.classifier
+        if classifier is not None:
+            # The elements of a previous run are flushed within this transaction
+            if classifier.stale:
+                self.prefill()
+
+            self.nets |= self.desired_nets()
+
+            classifier.add(batch, self.map_keys(self.nets), self.direction.profile.mark)
+            return
+
         cmds = []
 
         cmds += self.cmd_create_sets()
@@ -419,58 +575,216 @@ class Rule(Resource):
         cmds += self.cmd_populate_set_ports()
         cmds += self.cmd_create_rule()
 
-        try:
-            nft(cmds)
-        except NftablesError as e:
-            self.logger.error('Failed to apply nftables rules: %s', e)
-            self.logger.error('  Commands: %s', json.dumps(e.cmds, indent=2))
+        batch.add(cmds)
+
+    def deinit_nftables(self, batch: NftBatch):
+        classifier = self.direction.classifier
+        if classifier is not None:
+            classifier.delete(batch, self.map_keys(self.nets), self.direction.profile.mark)
+            return
 
-    def deinit_nftables(self):
         cmds = []
 
         cmds += self.cmd_delete_rule()
         cmds += self.cmd_delete_sets()
 
-        nft(cmds)
+        batch.add(cmds)
 
-    def find_handle(self, comment):
-        """ Find rule handle in chain by using the nftables comment """
+    @property
+    def handle(self) -> int:
+        """ Kernel handle of the rule as captured when it has been created """
 
-        cmds = [
-          {
-            'list': {
-                'chain': {
-                    **self.direction.profile.table,
-                    'name': self.direction.chain_name
-                }
-            }
-          }
-        ]
+        handle = HANDLES.rule(self.direction.profile.table_name, self.direction.chain_name, self.name)
+        if handle is None:
+            raise RuntimeError(f'Failed to find handle of rule: {self.name}')
+
+        return handle
 
-        output = nft(cmds)
+    def prefill(self):
+        """ Take the pods selected by the peers from the pod cache
 
-        elms = output.get('nftables', [])
-        for elm in elms:
-            rule = elm.get('rule')
-            if rule is None:
+        The peers replay the same pods once they have been subscribed.
+        """
+
+        for peer in self.peers:
+            if not peer.selects_pods:
                 continue
 
-            handle = rule.get('handle')
-            if handle is None:
+            for pod in POD_CACHE.select(peer.spec.get('podSelector', {}), peer.spec.get('namespaceSelector')):
+                if pod.status.pod_ip is None:
+                    continue
+
+                cidr = ipaddress.IPv4Network(pod.status.pod_ip)
+
+                self.pod_nets[(peer.index, pod.metadata.uid)] = (cidr, f'{pod.metadata.namespace}/{pod.metadata.name}')
+                self.aggregator.add(cidr)
+
+    def handle_pod_events(self, events: Dict[Hashable, Dict]):
+        """ Apply the net result of a batch of pod events in a single transaction """
+
+        ns = self.direction.profile.netns
+
+        # Might be called from threads outside of the namespace of the profile
+        # while the reconciler changes the same rule and classifier
+        with ns.enter(), ns.lock:
+            self._handle_pod_events(events)
+
+    def _handle_pod_events(self, events: Dict[Hashable, Dict]):
+        for key, event in events.items():
+            if event['type'] == 'TOPOLOGY':
+                self.aggregator.refresh(event['cidr'])
+                continue
+
+            pod = event['object']
+
+            # Pending events of peers which have been replaced by an update
+            index = key[0]
+            if index >= len(self.peers) or event.get('peer') is not self.peers[index]:
+                continue
+
+            old = self.pod_nets.pop(key, None)
+            if old is not None:
+                self.aggregator.remove(old[0])
+
+            if event['type'] != 'DELETED' and pod.status.pod_ip is not None:
+                cidr = ipaddress.IPv4Network(pod.status.pod_ip)
+                self.pod_nets[key] = (cidr, f'{pod.metadata.namespace}/{pod.metadata.name}')
+
+                self.aggregator.add(cidr)
+
+        self.sync_nets()
+
+    def desired_nets(self) -> Set[ipaddress.IPv4Network]:
+        # Prefixes already covered by an ipBlock would collide in the interval set
+        return self.static_nets | {
+            prefix for prefix in self.aggregator
+            if not any(prefix.subnet_of(net) for net in self.static_nets)
+        }
+
+    def sync_nets(self):
+        nets = self.desired_nets()
+
+        added = nets - self.nets
+        removed = self.nets - nets
+
+        if len(added) == 0 and len(removed) == 0:
+            return
+
+        batch = NftBatch()
+
+        classifier = self.direction.classifier
+        if classifier is not None:
+            mark = self.direction.profile.mark
+
+            classifier.delete(batch, self.map_keys(removed), mark)
+            classifier.add(batch, self.map_keys(added), mark)
+        else:
+            self._modify_set_nets(batch, added, removed)
+
+        self.logger.info('Updating nets of rule %s: %d added, %d removed', self.name, len(added), len(removed))
+
+        batch.commit()
+
+        self.nets = nets
+
+    def _modify_set_nets(self, batch: NftBatch, added: Set[ipaddress.IPv4Network], removed: Set[ipaddress.IPv4Network]):
+        comments = {cidr: comment for cidr, comment in self.pod_nets.values()}
+
+        batch.add(self.cmd_modify_set_nets('delete', {cidr: None for cidr in removed}))
+        batch.add(self.cmd_modify_set_nets('add', {cidr: comments.get(cidr) for cidr in added}))
+
+    def update(self, new_rule: Rule, batch: NftBatch):
+        """ Patch the live rule towards the spec of the new one
+
+        The rule keeps its name, its sets and the subscriptions of all
+        unchanged peers. Changed ports, protocols, ether types and networks
+        become element changes of the existing sets. The rule itself is
+        only replaced in-place if its expressions have changed.
+        """
+
+        self.logger.info('Updating rule %s', self.name)
+
+        classifier = self.direction.classifier
+
+        old_keys = self.map_keys(self.nets) if classifier is not None else set()
+        old_cmds = self.cmd_create_rule() if classifier is None else []
+        old_ports = self.port_elements
+        old_ether_types = set(self.ether_types)
+        old_inet_protos = set(self.inet_protos)
+        had_pod_peers = any(p.selects_pods for p in self.peers)
+
+        # Peers are compared by their position
+        peers = []
+        for i, new_peer in enumerate(new_rule.peers):
+            peer = self.peers[i] if i < len(self.peers) else None
+            if peer is not None and peer == new_peer:
+                peers.append(peer)
                 continue
 
-            cmt = rule.get('comment')
-            if cmt == comment:
-                return handle
+            if peer is not None:
+                self._remove_peer(peer)
+
+            new_peer.rule = self
+            peers.append(new_peer)
+
+            batch.on_commit(new_peer.init)
+
+        for peer in self.peers[len(new_rule.peers):]:
+            self._remove_peer(peer)
+
+        self.peers = peers
+
+        self.spec = new_rule.spec
+        self.ports = new_rule.ports
+        self.ether_types = new_rule.ether_types
+        self.inet_protos = new_rule.inet_protos
+        self.static_nets = new_rule.static_nets
+        self.resolved = new_rule.resolved
+
+        if self.aggregator.topology is not None and not had_pod_peers and any(p.selects_pods for p in self.peers):
+            batch.on_commit(self.init_topology)
+
+        nets = self.desired_nets()
+
+        if classifier is not None:
+            mark = self.direction.profile.mark
+            new_keys = self.map_keys(nets)
+
+            classifier.delete(batch, old_keys - new_keys, mark)
+            classifier.add(batch, new_keys - old_keys, mark)
+        else:
+            ports = self.port_elements
+
+            for protocol, port in old_ports - ports:
+                batch.add(self.cmd_modify_set_port('delete', protocol, port))
+            for protocol, port in ports - old_ports:
+                batch.add(self.cmd_modify_set_port('add', protocol, port))
+
+            for ether_type in old_ether_types - set(self.ether_types):
+                batch.add(self.cmd_modify_set_ether_type('delete', ether_type))
+            for ether_type in set(self.ether_types) - old_ether_types:
+                batch.add(self.cmd_modify_set_ether_type('add', ether_type))
+
+            for inet_proto in old_inet_protos - set(self.inet_protos):
+                batch.add(self.cmd_modify_set_inet_proto('delete', inet_proto))
+            for inet_proto in set(self.inet_protos) - old_inet_protos:
+                batch.add(self.cmd_modify_set_inet_proto('add', inet_proto))
+
+            self._modify_set_nets(batch, nets - self.nets, self.nets - nets)
+
+            # Set matches are only part of the rule while their sets are non-empty
+            if self.cmd_create_rule() != old_cmds:
+                batch.add(self.cmd_update_rule())
+
+        self.nets = nets
 
-        return None
+    def _remove_peer(self, peer: Peer):
+        peer.deinit()
 
-    def add_net(self, cidr: ipaddress.IPv4Network, comment: str = None):
-        if cidr not in self.nets:
-            nft(self.cmd_modify_set_net('add', cidr, comment))
-            self.nets.add(cidr)
+        for key in [k for k in self.pod_nets if k[0] == peer.index]:
+            cidr, _ = self.pod_nets.pop(key)
+            self.aggregator.remove(cidr)
 
-    def delete_net(self, cidr: ipaddress.IPv4Network):
-        if cidr in self.nets:
-            nft(self.cmd_modify_set_net('delete', cidr))
-            self.nets.remove(cidr)
+    @property
+    def port_elements(self) -> Set[Tuple[str, int]]:
+        return {(p.get('protocol', 'TCP').lower(), int(p.get('port'))) for p in self.ports}
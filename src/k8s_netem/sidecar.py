@@ -1,20 +1,28 @@
 import os
-import sys
 import signal
+import asyncio
 import logging
 import json
 
-from typing import Dict
+from typing import Dict, Iterable, List
 
 from kubernetes import client, config
 from kubernetes.config.incluster_config import InClusterConfigLoader, SERVICE_CERT_FILENAME
 
-from k8s_netem.controller import Controller
+from k8s_netem.aggregate import TOPOLOGY
+from k8s_netem.cache import POD_CACHE
+from k8s_netem.coalesce import Coalescer
+from k8s_netem.informer import Informer
 from k8s_netem.json import CustomEncoder
+from k8s_netem.reconciler import Reconciler
 
-from k8s_netem.profile import Profile
-from k8s_netem.config import POD_NAME, POD_NAMESPACE
-from k8s_netem.nftables import nft
+from k8s_netem.profile import Profile, ProfileInformer
+from k8s_netem.plan import PlanInformer, PlanTracker
+from k8s_netem.classifier import get_classifiers
+from k8s_netem.config import POD_NAME, POD_NAMESPACE, NFT_COMPILED, NFT_CONNTRACK, NFT_TABLE_PREFIX, USE_PLANS, RESYNC_INTERVAL
+from k8s_netem.config import POD_CACHE_NAMESPACES, NODE_CIDR_AGGREGATION
+from k8s_netem.nftables import nft, list_ruleset, HANDLES
+from k8s_netem import aio
 
 from k8s_netem.controllers.builtin import BuiltinController  # noqa F041
 from k8s_netem.controllers.script import ScriptController  # noqa F041
@@ -36,20 +44,6 @@ def dump_nftables():
     LOGGER.debug(rulset)
 
 
-def init_signals(netem):
-    '''Catch signals in order to stop network impairment before exiting.'''
-
-    # pylint: disable=unused-argument
-    def signal_action(signum, frame):
-        '''To be executed upon exit signal.'''
-        netem.teardown()
-        sys.exit(5)
-
-    # Catch SIGINT and SIGTERM so that we can clean up
-    for sig in [signal.SIGINT, signal.SIGTERM]:
-        signal.signal(sig, signal_action)
-
-
 def load_incluster_config_with_token(token: str):
     token_filename = '/tmp/token'
     with open(token_filename, 'w') as token_file:
@@ -77,64 +71,137 @@ def main():
 
     # Get my own pod resource
     v1 = client.CoreV1Api()
-    ret = v1.list_namespaced_pod(namespace=POD_NAMESPACE,
-                                 field_selector=f'metadata.name={POD_NAME}')
-    my_pod = ret.items[0]
+    pods = Informer('pods:self', v1.list_namespaced_pod,
+                    namespace=POD_NAMESPACE,
+                    field_selector=f'metadata.name={POD_NAME}')
+    my_pod = pods.list()[0]['object']
+
+    # Aggregating pod IPs by node requires all pods of the cluster
+    if POD_CACHE_NAMESPACES != '*':
+        if NODE_CIDR_AGGREGATION:
+            LOGGER.warn('Ignoring POD_CACHE_NAMESPACES as NODE_CIDR_AGGREGATION requires a cluster-wide pod cache')
+        else:
+            POD_CACHE.restrict([ns.strip() for ns in POD_CACHE_NAMESPACES.split(',')])
 
-    # InterfaceName -> Controller
-    interfaces: Dict[str, Controller] = {}
+    asyncio.run(run(my_pod, pods))
 
-    init_nftables()
 
-    # Initial list of profiles
-    for profile in Profile.list():
-        if not profile.match(my_pod):
-            continue
+async def run(my_pod, pods: Informer):
+    loop = asyncio.get_running_loop()
+    aio.set_loop(loop)
 
-        if profile.interface is None:
-            LOGGER.error('Failed to identify network interface')
-            continue
+    # Cancel the main task on SIGINT and SIGTERM so that we can clean up
+    task = asyncio.current_task()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, task.cancel)
+
+    leftover = await aio.kernel(init_nftables)
+
+    reconciler = Reconciler(my_pod)
+
+    try:
+        if USE_PLANS:
+            plans = PlanInformer(POD_NAMESPACE, POD_NAME)
+            tracker = PlanTracker()
 
-        if profile.interface in interfaces:
-            ctrl = interfaces[profile.interface]
-            if ctrl.type != profile.type:
-                LOGGER.error('Conflicing controllers')
-                continue
+            events = await aio.blocking(plans.list)
+            await aio.kernel(apply, reconciler, plan_events(tracker, events))
 
-            LOGGER.info('Using existing %s controller for profile %s', profile.type, profile)
+            # Keep watching for changes of the plan of our pod
+            await asyncio.gather(watch_plans(reconciler, plans, tracker),
+                                 resync(reconciler))
         else:
-            try:
-                LOGGER.info('Creating new %s controller for profile %s', profile.type, profile)
-                ctrl = Controller.from_type(profile.type, profile.interface)
-                interfaces[profile.interface] = ctrl
-            except RuntimeError as e:
-                LOGGER.error('Failed to get controller for profile %s: %s. Ignoring...', profile, e)
-                continue
+            informer = ProfileInformer()
+
+            # Adopted sets are refilled with the pods of their peers within
+            # the first reconciliation. So the pods need to be known before.
+            if leftover:
+                await aio.blocking(POD_CACHE.init)
+
+            # Initial list of profiles
+            events = await aio.blocking(informer.list)
+            await aio.kernel(apply, reconciler, events)
+
+            # Keep watching for added/removed/modified profiles
+            # and for label changes of our own pod
+            await asyncio.gather(watch(reconciler, informer),
+                                 watch_pod(reconciler, pods),
+                                 resync(reconciler))
+    except asyncio.CancelledError:
+        LOGGER.info('Stopping netem sidecar')
+    finally:
+        await aio.kernel(teardown, reconciler)
+
+        aio.set_loop(None)
+
+
+def teardown(reconciler: Reconciler):
+    """ Remove all applied profiles and stop their watchers """
+
+    reconciler.desired = {}
+    reconciler.reconcile()
+
+    for ctrl in reconciler.interfaces.values():
+        ctrl.deinit()
+
+    POD_CACHE.deinit()
+    TOPOLOGY.deinit()
+
+
+def init_nftables():
+    """ Prepare nftables without disturbing the state of a previous run
 
-        # Get a unused fwmark
-        mark = Controller.get_mark()
+    Tables and map elements which are left in the kernel are adopted
+    by the first reconciliation. Returns whether there are any.
+    """
 
-        # Initialize nftables to classify traffic with fwmark
-        profile.init(mark)
+    ruleset = list_ruleset()
 
-        # Pass new profile to controller
-        ctrl.add_profile(profile)
+    if NFT_COMPILED:
+        cmds = []
+        for classifier in get_classifiers().values():
+            cmds += classifier.cmd_init()
+
+            classifier.stale = NFT_TABLE_PREFIX in ruleset
+            if classifier.stale:
+                classifier.stale_chains = set(filter(classifier.is_mark_chain, ruleset[NFT_TABLE_PREFIX]['chains']))
+
+        nft(cmds)
+    elif NFT_CONNTRACK:
+        LOGGER.warn('Conntrack-assisted classification requires NFT_MODE=compiled. Ignoring NFT_CONNTRACK')
+
+    # Handles of later changes are tracked from the echoed commands
+    HANDLES.reindex()
+
+    return len(ruleset) > 0
+
+
+def apply(reconciler: Reconciler, events: Iterable[Dict]):
+    for event in events:
+        reconciler.handle_event(event)
+
+    reconciler.reconcile()
 
     # Show current nftables rulset
     dump_nftables()
 
-    # Keep watching for added/removed/modified profiles
-    watch(interfaces, my_pod)
 
-    ctrl.deinit()
+async def resync(reconciler: Reconciler):
+    """ Periodically observe the kernel and repair drifted state """
 
+    while True:
+        await asyncio.sleep(RESYNC_INTERVAL)
+
+        await aio.kernel(reconciler.reconcile, True)
 
-def init_nftables():
-    nft([{'flush': {'ruleset': None}}])
 
+async def watch(reconciler: Reconciler, informer: ProfileInformer):
+    # Bursts of events are collected and applied with a single reconciliation
+    coalescer = Coalescer('profiles', lambda events: apply(reconciler, events.values()))
 
-def watch(interfaces: Dict[str, Controller], my_pod):
-    for event in Profile.watch():
+    # Resumes from the resourceVersion of the initial list. After a relist
+    # the informer passes the difference to its store as synthetic events.
+    async for event in aio.watch(informer):
         profile = event['profile']
         type = event['type']
         obj = event['object']
@@ -145,50 +212,56 @@ def watch(interfaces: Dict[str, Controller], my_pod):
                      obj['metadata']['name'])
         LOGGER.debug('%s', json.dumps(profile, indent=2, cls=CustomEncoder))
 
-        if profile.interface is None:
-            LOGGER.error('Failed to identify network interface')
+        coalescer.put(profile.uid, event)
+
+    await aio.kernel(coalescer.flush)
+
+
+async def watch_pod(reconciler: Reconciler, informer: Informer):
+    async for event in aio.watch(informer):
+        pod = event['object']
+
+        if event['type'] == 'DELETED' or pod.metadata.labels == reconciler.pod.metadata.labels:
+            reconciler.pod = pod
             continue
 
-        if profile.interface in interfaces:
-            ctrl = interfaces[profile.interface]
-            LOGGER.info('Using existing %s controller for profile %s', profile.type, profile)
-        else:
-            try:
-                LOGGER.info('Creating new %s controller for profile %s', profile.type, profile)
-                ctrl = Controller.from_type(profile.type, profile.interface)
-                interfaces[profile.interface] = ctrl
-            except RuntimeError as e:
-                LOGGER.error('Failed to get controller for profile %s: %s. Ignoring...', profile, e)
-                continue
+        LOGGER.info('Labels of pod have changed. Re-matching profiles...')
+
+        await aio.kernel(update_pod, reconciler, pod)
+
+
+def update_pod(reconciler: Reconciler, pod):
+    reconciler.update_pod(pod)
+    reconciler.reconcile()
+
+    # Show current nftables rulset
+    dump_nftables()
+
 
-        old_profile = ctrl.profiles.get(profile.uid)
+def plan_events(tracker: PlanTracker, events: Iterable[Dict]) -> List[Dict]:
+    """ Convert events of the plan of our pod into events of its profiles """
 
-        if type in ['ADDED', 'MODIFIED']:
-            if old_profile:
-                params_changed = old_profile.update(profile)
+    profile_events = []
 
-                if params_changed:
-                    ctrl.update_profile(old_profile)
+    for event in events:
+        plan = event['object'] if event['type'] != 'DELETED' else None
 
-            elif profile.match(my_pod):
-                mark = ctrl.get_mark()
-                profile.init(int(mark))
+        for profile_event in tracker.events(plan):
+            profile_event['profile'] = Profile(profile_event['object'])
+            profile_events.append(profile_event)
 
-                ctrl.add_profile(profile)
+    return profile_events
 
-        elif type == 'DELETED':
-            if old_profile:
-                old_profile.deinit()
 
-                ctrl.remove_profile(old_profile)
+async def watch_plans(reconciler: Reconciler, informer: PlanInformer, tracker: PlanTracker):
+    # Plans already contain the resolved networks of all peers
+    coalescer = Coalescer('plans', lambda events: apply(reconciler, plan_events(tracker, events.values())))
+
+    async for event in aio.watch(informer):
+        obj = event['object']
+
+        LOGGER.debug('%s plan %s', event['type'].capitalize(), obj['metadata']['name'])
 
-                # Deinitialize and remove controller once the last
-                # Profile has been removed. This allows new Profiles
-                # with a different type to target this interface.
-                if len(ctrl.profiles) == 0:
-                    LOGGER.info("Removing controller %s from interface %s", ctrl, profile.interface)
-                    ctrl.deinit()
-                    del interfaces[profile.interface]
+        coalescer.put(obj['metadata']['uid'], event)
 
-        # Show current nftables rulset
-        dump_nftables()
+    await aio.kernel(coalescer.flush)
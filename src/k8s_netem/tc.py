@@ -0,0 +1,520 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional
+
+import json
+import logging
+import re
+
+from k8s_netem.caller import Caller, TcBatch
+from k8s_netem.config import TC_BACKEND
+from k8s_netem import netns
+
+try:
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+except ImportError:
+    IPRoute = None
+    NetlinkError = OSError
+
+LOGGER = logging.getLogger('tc')
+
+TC_H_ROOT = 0xffffffff
+
+ETH_P_ALL = 0x0003
+
+# Avoids warnings about the quantum derived from high rates
+HTB_QUANTUM = 65536
+
+# Required by tc, but the queue of a TBF is kept by its fq_codel child
+TBF_LATENCY = '50ms'
+
+# Units of rates accepted by tc in bit/s
+RATE_UNITS = {
+    'bit': 1,
+    'kbit': 1e3,
+    'mbit': 1e6,
+    'gbit': 1e9,
+    'tbit': 1e12,
+    'bps': 8,
+    'kbps': 8e3,
+    'mbps': 8e6,
+    'gbps': 8e9,
+    'tbps': 8e12
+}
+
+
+class TcError(RuntimeError):
+    """ A tc operation has been rejected by the kernel """
+
+
+def parse_handle(handle: str) -> int:
+    """ Convert a handle like '1:3' into its numeric form like tc does (hexadecimal) """
+
+    major, _, minor = handle.partition(':')
+
+    return (int(major or '0', 16) << 16) | int(minor or '0', 16)
+
+
+def parse_parent(parent: str) -> int:
+    return TC_H_ROOT if parent == 'root' else parse_handle(parent)
+
+
+def qdisc_parent(parent: str) -> str:
+    """ Arguments of tc for the parent of a qdisc """
+
+    return 'root' if parent == 'root' else f'parent {parent}'
+
+
+def format_handle(handle: int) -> str:
+    major = handle >> 16
+    minor = handle & 0xffff
+
+    return f'{major:x}:{minor:x}' if minor else f'{major:x}:'
+
+
+def parse_rate(rate: str) -> float:
+    """ Convert a rate like '100mbit' into bit/s """
+
+    m = re.match(r'^([0-9.]+)([a-z]*)$', str(rate).strip().lower())
+    if m is None or m.group(2) not in RATE_UNITS and m.group(2) != '':
+        raise RuntimeError(f'Invalid rate: {rate}')
+
+    return float(m.group(1)) * RATE_UNITS.get(m.group(2), 1)
+
+
+def htb_burst(rate: str) -> int:
+    """ Burst in bytes which lets an HTB class or TBF send at its rate with a timer resolution of 1ms
+
+    tc computes a burst of zero for rates of several Gbit/s.
+    """
+
+    return max(int(parse_rate(rate) / 8 / 1000), 2 * 1514)
+
+
+class TcBackend(Caller):
+    """ Manage the qdiscs and filters of the builtin controller with the tc command
+
+    The tree is read back in the JSON format of tc. Other backends return
+    the same structure.
+    """
+
+    def qdiscs(self, intf: str) -> List[Dict]:
+        return json.loads(self._check_output(f'tc -j qdisc show dev {intf}') or '[]')
+
+    def filters(self, intf: str, parent: str) -> List[Dict]:
+        return json.loads(self._check_output(f'tc -j filter show dev {intf} parent {parent}') or '[]')
+
+    def classes(self, intf: str) -> List[Dict]:
+        # Older versions of tc ignore -j for classes
+        classes = []
+
+        for line in self._check_output(f'tc class show dev {intf}').splitlines():
+            words = line.split()
+            if len(words) < 3 or words[0] != 'class':
+                continue
+
+            cls = {
+                'class': words[1],
+                'handle': words[2]
+            }
+
+            if 'root' in words[3:5]:
+                cls['root'] = True
+            elif words[3:4] == ['parent']:
+                cls['parent'] = words[4]
+
+            classes.append(cls)
+
+        return classes
+
+    def mq(self, operation: str, intf: str):
+        self._check_call(f'tc qdisc {operation} dev {intf} root handle 1: mq')
+
+    def prio(self, operation: str, intf: str, bands: int, parent: str = 'root', handle: str = '1:'):
+        self._check_call(f'tc qdisc {operation} dev {intf} {qdisc_parent(parent)} handle {handle} prio bands {bands}')
+
+    def htb(self, operation: str, intf: str, parent: str = 'root', handle: str = '1:'):
+        # Unclassified traffic bypasses the classes
+        self._check_call(f'tc qdisc {operation} dev {intf} {qdisc_parent(parent)} handle {handle} htb default 0')
+
+    def htb_classes(self, operation: str, intf: str, minors: Iterable[int], rate: str, parent: str = '1:', burst: Optional[int] = None):
+        burst = burst or htb_burst(rate)
+
+        with TcBatch() as batch:
+            for minor in minors:
+                batch.add(f'tc class {operation} dev {intf} parent {parent} classid {parent}{minor:x} htb rate {rate} '
+                          f'burst {burst} cburst {burst} quantum {HTB_QUANTUM}')
+
+    def netem(self, operation: str, intf: str, parent: str, handle: str, params: Dict):
+        self._check_call(f'tc qdisc {operation} dev {intf} parent {parent} handle {handle} netem {netem_args(**params)}')
+
+    def tbf(self, operation: str, intf: str, parent: str, handle: str, rate: str, burst: Optional[int] = None):
+        burst = burst or htb_burst(rate)
+
+        self._check_call(f'tc qdisc {operation} dev {intf} parent {parent} handle {handle} tbf rate {rate} burst {burst} latency {TBF_LATENCY}')
+
+    def fq_codel(self, operation: str, intf: str, parent: str, handle: str):
+        self._check_call(f'tc qdisc {operation} dev {intf} parent {parent} handle {handle} fq_codel')
+
+    def delete_qdisc(self, intf: str, parent: str, handle: Optional[str] = None):
+        """ Delete a qdisc which might have already vanished """
+
+        if parent == 'root':
+            self._call(f'tc qdisc delete dev {intf} root')
+        else:
+            self._call(f'tc qdisc delete dev {intf} parent {parent} handle {handle}')
+
+    def add_fw_filter(self, intf: str, prio: int, mark: int, mask: int, flowid: str, parent: str = '1:'):
+        # All fw filters of a prio are kept in a single hash table
+        self._check_call(f'tc filter add dev {intf} parent {parent} prio {prio} handle {mark}/0x{mask:x} fw flowid {flowid}')
+
+    def delete_fw_filter(self, intf: str, prio: int, mark: int, mask: int, parent: str = '1:'):
+        """ Delete a filter which might have already vanished """
+
+        self._call(f'tc filter delete dev {intf} parent {parent} prio {prio} handle {mark}/0x{mask:x} fw')
+
+    def dump(self, intf: str):
+        # Each show command requires its own process
+        if not LOGGER.isEnabledFor(logging.DEBUG):
+            return
+
+        self._call(f'tc qdisc show dev {intf}')
+        self._call(f'tc filter show dev {intf}')
+        self._call(f'tc -g class show dev {intf}')
+
+
+class NetlinkBackend(TcBackend):
+    """ Manage qdiscs and filters via rtnetlink without forking tc
+
+    Requires pyroute2. A netlink socket is opened per network namespace.
+    netem options which can not be expressed by pyroute2 (distributions,
+    rate and slots) are still applied with the tc command.
+    """
+
+    # netem options which are supported by pyroute2
+    NETLINK_OPTIONS = {
+        'loss_ratio', 'loss_correlation',
+        'duplication_ratio', 'duplication_correlation',
+        'delay', 'jitter', 'delay_jitter_correlation',
+        'reorder_ratio', 'reorder_correlation', 'reorder_gap',
+        'limit'
+    }
+
+    def __init__(self):
+        # Network namespace -> Socket
+        self.sockets: Dict[Optional[int], IPRoute] = {}
+
+    @property
+    def ipr(self) -> IPRoute:
+        # Sockets are bound to the namespace of the thread which opens them
+        key = netns.current().key
+
+        ipr = self.sockets.get(key)
+        if ipr is None:
+            ipr = self.sockets.setdefault(key, IPRoute())
+
+        return ipr
+
+    def forget(self, ns: netns.NetNS):
+        ipr = self.sockets.pop(ns.key, None)
+        if ipr is not None:
+            ipr.close()
+
+    def index(self, intf: str) -> int:
+        indices = self.ipr.link_lookup(ifname=intf)
+        if len(indices) == 0:
+            raise TcError(f'Unknown interface: {intf}')
+
+        return indices[0]
+
+    def _tc(self, *args, **kwargs):
+        LOGGER.info('Netlink: tc %s %s', ' '.join(str(a) for a in args), kwargs)
+
+        try:
+            return self.ipr.tc(*args, **kwargs)
+        except NetlinkError as e:
+            raise TcError(f'tc {args[0]} {args[1]} failed: {e}')
+
+    def qdiscs(self, intf: str) -> List[Dict]:
+        qdiscs = []
+
+        for msg in self.ipr.get_qdiscs(index=self.index(intf)):
+            qdisc = {
+                'kind': msg.get_attr('TCA_KIND'),
+                'handle': format_handle(msg['handle']),
+                'options': {}
+            }
+
+            if msg['parent'] == TC_H_ROOT:
+                qdisc['root'] = True
+            else:
+                qdisc['parent'] = format_handle(msg['parent'])
+
+            if qdisc['kind'] == 'prio':
+                options = msg.get_attr('TCA_OPTIONS')
+                if options is not None:
+                    qdisc['options']['bands'] = options['bands']
+
+            qdiscs.append(qdisc)
+
+        return qdiscs
+
+    def filters(self, intf: str, parent: str) -> List[Dict]:
+        filters = []
+
+        for msg in self.ipr.get_filters(index=self.index(intf), parent=parse_handle(parent)):
+            filter = {
+                'kind': msg.get_attr('TCA_KIND'),
+                'pref': msg['info'] >> 16
+            }
+
+            # The first message of each prio only describes the classifier itself
+            if msg['handle'] != 0:
+                filter['options'] = {
+                    'handle': f'0x{msg["handle"]:x}'
+                }
+
+                options = msg.get_attr('TCA_OPTIONS')
+                classid = options.get_attr('TCA_FW_CLASSID') if options is not None else None
+                if classid is not None:
+                    filter['options']['classid'] = format_handle(classid)
+
+            filters.append(filter)
+
+        return filters
+
+    def classes(self, intf: str) -> List[Dict]:
+        classes = []
+
+        for msg in self.ipr.get_classes(index=self.index(intf)):
+            cls = {
+                'class': msg.get_attr('TCA_KIND'),
+                'handle': format_handle(msg['handle'])
+            }
+
+            if msg['parent'] == TC_H_ROOT:
+                cls['root'] = True
+            else:
+                cls['parent'] = format_handle(msg['parent'])
+
+            classes.append(cls)
+
+        return classes
+
+    def mq(self, operation: str, intf: str):
+        self._tc(operation, 'mq', self.index(intf),
+                 parent=TC_H_ROOT,
+                 handle=parse_handle('1:'))
+
+    def htb(self, operation: str, intf: str, parent: str = 'root', handle: str = '1:'):
+        self._tc(operation, 'htb', self.index(intf),
+                 parent=parse_parent(parent),
+                 handle=parse_handle(handle),
+                 default=0)
+
+    def htb_classes(self, operation: str, intf: str, minors: Iterable[int], rate: str, parent: str = '1:', burst: Optional[int] = None):
+        index = self.index(intf)
+
+        for minor in minors:
+            self._tc(f'{operation}-class', 'htb', index,
+                     parent=parse_handle(parent),
+                     handle=parse_handle(parent) | minor,
+                     rate=rate,
+                     ceil=rate,
+                     burst=burst or htb_burst(rate),
+                     quantum=HTB_QUANTUM)
+
+    def prio(self, operation: str, intf: str, bands: int, parent: str = 'root', handle: str = '1:'):
+        self._tc(operation, 'prio', self.index(intf),
+                 parent=parse_parent(parent),
+                 handle=parse_handle(handle),
+                 bands=bands,
+                 priomap=[1, 2, 2, 2, 1, 2, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1])
+
+    def netem(self, operation: str, intf: str, parent: str, handle: str, params: Dict):
+        active = {k for k, v in params.items() if v and not isinstance(v, str)}
+        if not active <= self.NETLINK_OPTIONS or params.get('distribution', 'normal') != 'normal':
+            return super().netem(operation, intf, parent, handle, params)
+
+        # pyroute2 expects times in microseconds and ratios in percent
+        kwargs = {
+            'limit': params.get('limit') or 20000,
+            'delay': int(params.get('delay', 0) * 1e6),
+            'jitter': int(params.get('jitter', 0) * 1e6),
+            'loss': params.get('loss_ratio', 0) * 1e2,
+            'duplicate': params.get('duplication_ratio', 0) * 1e2
+        }
+
+        # pyroute2 raises a plain Exception for correlations without their base parameters
+        if kwargs['delay'] and kwargs['jitter']:
+            kwargs['delay_corr'] = int(params.get('delay_jitter_correlation', 0) * 1e2)
+        if kwargs['loss']:
+            kwargs['loss_corr'] = int(params.get('loss_correlation', 0) * 1e2)
+        if kwargs['duplicate']:
+            kwargs['dup_corr'] = int(params.get('duplication_correlation', 0) * 1e2)
+
+        # The same applies to the gap and correlation of reordering
+        if params.get('reorder_ratio'):
+            kwargs['prob_reorder'] = params['reorder_ratio'] * 1e2
+            kwargs['corr_reorder'] = int(params.get('reorder_correlation', 0) * 1e2)
+            kwargs['gap'] = params.get('reorder_gap', 0)
+
+        self._tc(operation, 'netem', self.index(intf),
+                 parent=parse_handle(parent),
+                 handle=parse_handle(handle),
+                 **kwargs)
+
+    def tbf(self, operation: str, intf: str, parent: str, handle: str, rate: str, burst: Optional[int] = None):
+        self._tc(operation, 'tbf', self.index(intf),
+                 parent=parse_handle(parent),
+                 handle=parse_handle(handle),
+                 rate=rate,
+                 burst=burst or htb_burst(rate),
+                 latency=TBF_LATENCY)
+
+    def fq_codel(self, operation: str, intf: str, parent: str, handle: str):
+        self._tc(operation, 'fq_codel', self.index(intf),
+                 parent=parse_handle(parent),
+                 handle=parse_handle(handle))
+
+    def delete_qdisc(self, intf: str, parent: str, handle: Optional[str] = None):
+        try:
+            if parent == 'root':
+                self._tc('del', None, self.index(intf), parent=TC_H_ROOT)
+            else:
+                self._tc('del', None, self.index(intf), parent=parse_handle(parent), handle=parse_handle(handle))
+        except TcError as e:
+            LOGGER.debug('%s', e)
+
+    def add_fw_filter(self, intf: str, prio: int, mark: int, mask: int, flowid: str, parent: str = '1:'):
+        self._tc('add-filter', 'fw', self.index(intf),
+                 parent=parse_handle(parent),
+                 protocol=ETH_P_ALL,
+                 prio=prio,
+                 handle=mark,
+                 mask=mask,
+                 classid=parse_handle(flowid))
+
+    def delete_fw_filter(self, intf: str, prio: int, mark: int, mask: int, parent: str = '1:'):
+        try:
+            self._tc('del-filter', 'fw', self.index(intf),
+                     parent=parse_handle(parent),
+                     protocol=ETH_P_ALL,
+                     prio=prio,
+                     handle=mark)
+        except TcError as e:
+            LOGGER.debug('%s', e)
+
+    def dump(self, intf: str):
+        if not LOGGER.isEnabledFor(logging.DEBUG):
+            return
+
+        LOGGER.debug('Qdiscs of %s: %s', intf, json.dumps(self.qdiscs(intf)))
+        LOGGER.debug('Filters of %s: %s', intf, json.dumps(self.filters(intf, '1:')))
+
+
+def netem_args(limit: int = 0,
+               loss_ratio: float = 0,
+               loss_correlation: int = 0,
+               duplication_ratio: int = 0,
+               duplication_correlation: int = 0,
+               delay: float = 0,
+               jitter: float = 0,
+               delay_jitter_correlation: int = 0,
+               reorder_ratio: int = 0,
+               reorder_correlation: int = 0,
+               reorder_gap: int = 0,
+               distribution: str = 'normal',
+               rate: int = 0,
+               rate_packetoverhead: int = 0,
+               rate_cellsize: int = 0,
+               rate_celloverhead: int = 0,
+               slot_min_delay: float = 0,
+               slot_max_delay: float = 0,
+               slot_distribution: str = 'normal',
+               slot_delay: float = 0,
+               slot_jitter: float = 0,
+               slot_packets: int = 0,
+               slot_bytes: int = 0) -> str:
+    """ Convert the netem parameters of a profile into arguments of tc """
+
+    if limit == 0:
+        limit = 20000
+
+    cmd = f'limit {limit}'
+
+    if loss_ratio > 0:
+        cmd += f' loss random {int(loss_ratio*1e2)}%'
+        if loss_correlation > 0:
+            cmd += f' {int(loss_correlation*1e2)}%'
+
+    if duplication_ratio > 0:
+        cmd += f' duplicate {int(duplication_ratio*1e2)}%'
+        if duplication_correlation > 0:
+            cmd += f' {int(duplication_correlation*1e2)}%'
+
+    if delay > 0:
+        cmd += f' delay {int(delay*1e3)}ms'
+        if jitter > 0:
+            cmd += f' {int(jitter*1e3)}ms'
+            if delay_jitter_correlation:
+                cmd += f' {int(delay_jitter_correlation*1e2)}%'
+
+        if distribution != 'normal':
+            cmd += f' distribution {distribution}'
+
+        if reorder_ratio > 0:
+            cmd += f' reorder {int(reorder_ratio*1e2)}%'
+            if reorder_correlation > 0:
+                cmd += f' {int(reorder_correlation*1e2)}%'
+            if reorder_gap > 0:
+                cmd += f' gap {reorder_gap}'
+
+    if rate > 0:
+        cmd += f' rate {rate}kbit'
+        if rate_packetoverhead != 0:
+            cmd += f' {rate_packetoverhead}'
+            if rate_cellsize > 0:
+                cmd += f' {rate_cellsize}'
+                if rate_celloverhead > 0:
+                    cmd += f' {rate_celloverhead}'
+
+    if slot_min_delay > 0 or (slot_delay > 0 and slot_jitter > 0):
+        cmd += ' slot'
+        if slot_min_delay > 0:
+            cmd += f' {int(slot_min_delay*1e3)}ms'
+            if slot_max_delay:
+                cmd += f' {int(slot_max_delay*1e3)}ms'
+        else:
+            cmd += f' distribution {slot_distribution} {int(slot_delay*1e3)}ms {int(slot_jitter*1e3)}ms'
+
+        if slot_packets > 0:
+            cmd += f' packets {slot_packets}'
+
+        if slot_bytes > 0:
+            cmd += f' bytes {slot_bytes}'
+
+    return cmd
+
+
+_backend: Optional[TcBackend] = None
+
+
+def get_backend() -> TcBackend:
+    global _backend
+
+    if _backend is None:
+        if TC_BACKEND == 'netlink' and IPRoute is None:
+            LOGGER.warn('The netlink tc backend requires pyroute2. Falling back to the tc command')
+            _backend = TcBackend()
+        elif TC_BACKEND == 'netlink':
+            _backend = NetlinkBackend()
+        else:
+            _backend = TcBackend()
+
+    return _backend
+
+
+def forget(ns: netns.NetNS):
+    if isinstance(_backend, NetlinkBackend):
+        _backend.forget(ns)
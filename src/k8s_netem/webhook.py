@@ -12,22 +12,49 @@ from kubernetes.config.incluster_config import SERVICE_TOKEN_FILENAME
 from flask import Flask, jsonify, request
 from werkzeug.exceptions import HTTPException
 
-from k8s_netem.config import INJECT_TO_ALL, DEBUG, SSL_CERT_FILE, SSL_KEY_FILE
-from k8s_netem.profile import Profile
+from k8s_netem.config import INJECT_TO_ALL, AGENT_MODE, DEBUG, SSL_CERT_FILE, SSL_KEY_FILE
+from k8s_netem.aio import Watcher
+from k8s_netem.match import LabelSelector, SelectorIndex
+from k8s_netem.profile import ProfileInformer
 import k8s_netem.log as log
 
 LOGGER = logging.getLogger('webhook')
 
 app = Flask(__name__)
 
+# Pod selectors of all profiles by profile uid
+PROFILES = SelectorIndex()
+
+
+def handle_profile_event(event):
+    obj = event['object']
+    uid = obj['metadata']['uid']
+
+    if event['type'] == 'DELETED':
+        PROFILES.remove(uid)
+    else:
+        PROFILES.add(uid, LabelSelector.compile(obj.get('spec', {}).get('podSelector', {})))
+
+
+def watch_profiles():
+    informer = ProfileInformer(resolve=False)
+
+    for event in informer.list():
+        handle_profile_event(event)
+
+    watcher = Watcher(informer, handle_profile_event)
+    watcher.start()
+
 
 def mutate_pod(pod):
+    # The network namespaces of all pods are managed by the node agents
+    if AGENT_MODE:
+        return
+
     with open(SERVICE_TOKEN_FILENAME) as f:
         token = f.read().strip()
 
-    profiles = Profile.list()
-
-    has_profiles = len([p for p in profiles if p.match(pod)]) > 0
+    has_profiles = len(PROFILES.match(pod.metadata.labels)) > 0
     has_netem_container = len([c for c in pod.spec.containers
                               if c.name == 'k8s-netem']) > 0
 
@@ -134,6 +161,9 @@ def main():
     else:
         config.load_incluster_config()
 
+    # Profiles are matched against the index instead of listing them for every pod
+    watch_profiles()
+
     opts = {
         'host': '0.0.0.0',
         'port': 5000
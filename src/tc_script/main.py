@@ -4,7 +4,7 @@ import sys
 import os
 import inotify.adapters
 
-from k8s_netem.caller import call, check_call
+from k8s_netem.caller import TcBatch, call
 
 import k8s_netem.log as log
 
@@ -20,26 +20,29 @@ def configure(config):
         raise RuntimeError('missing device')
 
     priomap = [str(0)] * 16
-    call(f'tc qdisc delete dev {dev} root')
-    check_call(f'tc qdisc add dev {dev} root handle 1: prio bands {len(flows)+2} priomap ' + ' '.join(priomap))
 
-    i = 2  # band 1 is for non-filtered flows
-    for flow in flows:
-        filter = flow.get('filter')
-        if filter is None:
-            raise RuntimeError('missing filter')
+    # All changes are passed to tc at once
+    with TcBatch() as batch:
+        batch.add(f'tc qdisc delete dev {dev} root', check=False)
+        batch.add(f'tc qdisc add dev {dev} root handle 1: prio bands {len(flows)+2} priomap ' + ' '.join(priomap))
 
-        fwmark = filter.get('fwmark')
-        if type(fwmark) is not int:
-            raise RuntimeError('missing fwmark')
+        i = 2  # band 1 is for non-filtered flows
+        for flow in flows:
+            filter = flow.get('filter')
+            if filter is None:
+                raise RuntimeError('missing filter')
 
-        parameters = flow.get('parameters')
-        delay = parameters['netem']['delay']
+            fwmark = filter.get('fwmark')
+            if type(fwmark) is not int:
+                raise RuntimeError('missing fwmark')
 
-        check_call(f'tc filter add dev {dev} handle {fwmark} fw classid 1:{i}')
-        check_call(f'tc qdisc add dev {dev} parent 1:{i} netem delay {delay} ')
+            parameters = flow.get('parameters')
+            delay = parameters['netem']['delay']
 
-        i += 1
+            batch.add(f'tc filter add dev {dev} handle {fwmark} fw classid 1:{i}')
+            batch.add(f'tc qdisc add dev {dev} parent 1:{i} netem delay {delay} ')
+
+            i += 1
 
     call(f'tc qdisc show dev {dev}')
     call(f'tc filter show dev {dev}')